@@ -9,13 +9,19 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
+import sys
+import json
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 import torch
 import time
 import math
 from tqdm import tqdm
 import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import data_utils
 
 
 class DataLoader:
@@ -31,7 +37,8 @@ class DataLoader:
             batch_size,
             max_ind_range=-1,
             split="train",
-            drop_last_batch=False
+            drop_last_batch=False,
+            prefetch_days=0
     ):
         self.data_filename = data_filename
         self.data_directory = data_directory
@@ -51,12 +58,14 @@ class DataLoader:
             self.length = int(np.ceil(self.length / 2.))
         self.split = split
         self.drop_last_batch = drop_last_batch
+        self.prefetch_days = prefetch_days
 
     def __iter__(self):
         return iter(
             _batch_generator(
                 self.data_filename, self.data_directory, self.days,
-                self.batch_size, self.split, self.drop_last_batch, self.max_ind_range
+                self.batch_size, self.split, self.drop_last_batch, self.max_ind_range,
+                self.prefetch_days
             )
         )
 
@@ -67,6 +76,143 @@ class DataLoader:
             return math.ceil(self.length / self.batch_size)
 
 
+class CriteoDayDataset(IterableDataset):
+    """
+    Iterable version of DataLoader, for several DataLoader workers and ranks.
+
+    Batches are numbered as in DataLoader (they may span two days). Given a
+    seed, the order of the days and of the batches within each day is shuffled
+    (deterministically for a seed and epoch, see set_epoch). The order is cut
+    into world_size contiguous ranges of the same number of batches (the
+    remaining batches are dropped), one per rank, and the range of a rank into
+    num_workers contiguous ranges, one per worker. A worker thus reads only its
+    own days (or rows of a day), and keeps at most two days in memory (with a
+    seed, the last batch of a day that spans into the next day also reads the
+    start of that day, although it comes later in the order). Workers read the
+    days on their own, so a day in the npz format is decompressed whole even
+    if a worker needs only some of its rows (the npy format, memory mapped,
+    reads only the rows needed).
+    """
+
+    def __init__(
+            self,
+            data_filename,
+            data_directory,
+            days,
+            batch_size,
+            max_ind_range=-1,
+            split="train",
+            drop_last_batch=False,
+            seed=None,
+            rank=0,
+            world_size=1
+    ):
+        self.data_filename = data_filename
+        self.data_directory = data_directory
+        self.days = days
+        self.batch_size = batch_size
+        self.max_ind_range = max_ind_range
+        self.split = split
+        self.drop_last_batch = drop_last_batch
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+        total_file = os.path.join(
+            data_directory,
+            data_filename + "_day_count.npz"
+        )
+        with np.load(total_file) as data:
+            total_per_file = data["total_per_file"][np.array(days)]
+
+        # range of samples used in each day (test and val split the days)
+        self.day_start = np.zeros(len(days), dtype=np.int64)
+        self.day_end = np.array(total_per_file, dtype=np.int64)
+        if split == "test" or split == "val":
+            length = (self.day_end + 1) // 2
+            if split == "test":
+                self.day_end = length
+            else:
+                self.day_start = self.day_end - length
+        # position of the first sample of each day in the sequence of all samples
+        self.offsets = np.zeros(len(days) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(self.day_end - self.day_start)
+        self.length = int(self.offsets[-1])
+
+        if drop_last_batch:
+            self.num_batches = self.length // batch_size
+        else:
+            self.num_batches = math.ceil(self.length / batch_size)
+
+        self.day_cache = {}
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batch_order(self):
+        batches = np.arange(self.num_batches)
+        if self.seed is None:
+            return batches
+        rs = np.random.RandomState([self.seed, self.epoch])
+        # day in which each batch starts
+        batch_day = np.searchsorted(self.offsets, batches * self.batch_size, "right") - 1
+        return np.concatenate(
+            [rs.permutation(batches[batch_day == d])
+             for d in rs.permutation(len(self.days))]
+        )
+
+    def _get_day(self, d):
+        if d not in self.day_cache:
+            # keep the (at most) two days a batch may span
+            if len(self.day_cache) >= 2:
+                self.day_cache.pop(next(iter(self.day_cache)))
+            filepath = os.path.join(
+                self.data_directory,
+                self.data_filename + "_{}_reordered.npz".format(self.days[d])
+            )
+            self.day_cache[d] = _load_day(filepath)
+        return self.day_cache[d]
+
+    def _get_batch(self, k):
+        lo = k * self.batch_size
+        hi = min(lo + self.batch_size, self.length)
+        parts = []
+        d = np.searchsorted(self.offsets, lo, "right") - 1
+        while lo < hi:
+            start = self.day_start[d] + lo - self.offsets[d]
+            end = self.day_start[d] + min(hi, self.offsets[d + 1]) - self.offsets[d]
+            parts.append([a[start:end] for a in self._get_day(d)])
+            lo += end - start
+            d += 1
+        if len(parts) == 1:
+            x_int, x_cat, y = parts[0]
+        else:
+            x_int, x_cat, y = [np.concatenate(a, axis=0) for a in zip(*parts)]
+        return _transform_features(x_int, x_cat, y, self.max_ind_range)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        n = len(self)
+        order = self._batch_order()[self.rank * n : (self.rank + 1) * n]
+        for k in np.array_split(order, num_workers)[worker_id]:
+            yield self._get_batch(k)
+
+    def __len__(self):
+        # every rank gets the same number of batches
+        return self.num_batches // self.world_size
+
+    def __getstate__(self):
+        # do not send the loaded days to DataLoader workers
+        state = self.__dict__.copy()
+        state['day_cache'] = {}
+        return state
+
+
 def _transform_features(
         x_int_batch, x_cat_batch, y_batch, max_ind_range, flag_input_torch_tensor=False
 ):
@@ -89,21 +235,69 @@ def _transform_features(
     return x_int_batch, lS_o, x_cat_batch.t(), y_batch.view(-1, 1)
 
 
+def _load_day(filepath):
+    # decompresses the arrays of a day in parallel (each from its own file handle),
+    # or memory maps them if the day is stored in the (uncompressed) npy format
+    def load(key):
+        with data_utils.loadCriteoArrays(filepath, mmap_mode="r") as data:
+            return data[key]
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        return tuple(executor.map(load, ["X_int", "X_cat", "y"]))
+
+
+def _read_days(filepaths, prefetch_days):
+    # yields the arrays of days in order, while a background thread reads
+    # ahead the next prefetch_days days. A day is read (or waits in the queue)
+    # only while it holds one of prefetch_days slots, released when the day is
+    # handed over, so at most prefetch_days + 1 days are in memory: the day
+    # being consumed and the prefetch_days days read ahead (about 30 GB each
+    # for Terabyte days decompressed from npz).
+    if prefetch_days <= 0:
+        for filepath in filepaths:
+            yield _load_day(filepath)
+        return
+
+    days_queue = queue.Queue()
+    slots = threading.Semaphore(prefetch_days)
+    stop = threading.Event()
+
+    def read_ahead():
+        try:
+            for filepath in filepaths:
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                days_queue.put(_load_day(filepath))
+        except Exception as e:
+            days_queue.put(e)
+
+    thread = threading.Thread(target=read_ahead, daemon=True)
+    thread.start()
+    try:
+        for _ in filepaths:
+            item = days_queue.get()
+            if isinstance(item, Exception):
+                raise item
+            slots.release()
+            yield item
+            del item
+    finally:
+        stop.set()
+
+
 def _batch_generator(
-        data_filename, data_directory, days, batch_size, split, drop_last, max_ind_range
+        data_filename, data_directory, days, batch_size, split, drop_last, max_ind_range,
+        prefetch_days=0
 ):
+    filepaths = [
+        os.path.join(data_directory, data_filename + "_{}_reordered.npz".format(day))
+        for day in days
+    ]
     previous_file = None
-    for day in days:
-        filepath = os.path.join(
-            data_directory,
-            data_filename + "_{}_reordered.npz".format(day)
-        )
-
-        # print('Loading file: ', filepath)
-        with np.load(filepath) as data:
-            x_int = data["X_int"]
-            x_cat = data["X_cat"]
-            y = data["y"]
+    for x_int, x_cat, y in _read_days(filepaths, prefetch_days):
 
         samples_in_file = y.shape[0]
         batch_start_idx = 0
@@ -159,11 +353,14 @@ def _batch_generator(
                     'y' : np.concatenate([previous_file['y'], y[current_slice]], axis=0)
                 }
             else:
+                # copies, so that the day is not kept in memory by the rest
                 previous_file = {
-                    'x_int' : x_int[current_slice],
-                    'x_cat' : x_cat[current_slice],
-                    'y' : y[current_slice]
+                    'x_int' : x_int[current_slice].copy(),
+                    'x_cat' : x_cat[current_slice].copy(),
+                    'y' : y[current_slice].copy()
                 }
+        # release the day (and views of it) before the next one is read
+        x_int = x_cat = y = x_int_batch = x_cat_batch = y_batch = None
 
     if not drop_last:
         yield _transform_features(
@@ -196,6 +393,71 @@ def _test():
         )
 
 
+# compact binary format, a header followed by packed sample records
+BIN_MAGIC = b"DLRMBIN\0"
+BIN_VERSION = 1
+BIN_ALIGNMENT = 64
+
+
+def _compact_bin_dtype(header):
+    # the record of a sample: label, log-transformed dense features and the
+    # sparse features (each in the narrowest type fitting its table)
+    return np.dtype(
+        [("y", header["label_dtype"]),
+         ("x_int", header["dense_dtype"], (header["num_dense"],))]
+        + [("c{}".format(j), t) for j, t in enumerate(header["sparse_dtypes"])]
+    )
+
+
+def _compact_bin_header(counts, max_ind_range=-1):
+    counts = np.asarray(counts, dtype=np.int64)
+    if max_ind_range > 0:
+        counts = np.minimum(counts, max_ind_range)
+    return {
+        "version": BIN_VERSION,
+        "num_dense": 13,
+        "label_dtype": "uint8",
+        "dense_dtype": "float16",
+        "sparse_dtypes": [np.min_scalar_type(max(n - 1, 0)).name for n in counts],
+        "max_ind_range": int(max_ind_range),
+    }
+
+
+def _write_bin_header(output_file, header):
+    # magic, version, length of the json header, json header, padding
+    header_bytes = json.dumps(header).encode()
+    size = len(BIN_MAGIC) + 8 + len(header_bytes)
+    padding = -size % BIN_ALIGNMENT
+    output_file.write(BIN_MAGIC)
+    output_file.write(np.array([BIN_VERSION, len(header_bytes) + padding],
+                               dtype="<u4").tobytes())
+    output_file.write(header_bytes + b" " * padding)
+
+
+def _read_bin_header(data_file):
+    # returns the header and the offset of the data, or (None, 0) for the
+    # original format (int32 values without a header)
+    with open(data_file, 'rb') as f:
+        if f.read(len(BIN_MAGIC)) != BIN_MAGIC:
+            return None, 0
+        version, length = np.frombuffer(f.read(8), dtype="<u4")
+        if version > BIN_VERSION:
+            sys.exit("ERROR: unsupported binary format version %d" % version)
+        header = json.loads(f.read(int(length)).decode())
+        return header, len(BIN_MAGIC) + 8 + int(length)
+
+
+def _compact_bin_records(y, X_int, X_cat, header):
+    records = np.empty(y.shape[0], dtype=_compact_bin_dtype(header))
+    records["y"] = y
+    records["x_int"] = np.log(X_int.astype(np.float32) + 1)
+    max_ind_range = header["max_ind_range"]
+    for j in range(len(header["sparse_dtypes"])):
+        x = X_cat[:, j]
+        records["c{}".format(j)] = x % max_ind_range if max_ind_range > 0 else x
+    return records
+
+
 class CriteoBinDataset(Dataset):
     """Binary version of criteo dataset."""
 
@@ -210,12 +472,25 @@ class CriteoBinDataset(Dataset):
 
         self.batch_size = batch_size
         self.max_ind_range = max_ind_range
-        self.bytes_per_entry = (bytes_per_feature * self.tot_fea * batch_size)
 
-        self.num_entries = math.ceil(os.path.getsize(data_file) / self.bytes_per_entry)
+        # the compact format is recognized by its header
+        self.header, self.offset = _read_bin_header(data_file)
+        if self.header is None:
+            self.dtype = np.dtype(np.int32)
+            bytes_per_sample = bytes_per_feature * self.tot_fea
+        else:
+            self.dtype = _compact_bin_dtype(self.header)
+            bytes_per_sample = self.dtype.itemsize
+        self.bytes_per_entry = (bytes_per_sample * batch_size)
+
+        data_size = os.path.getsize(data_file) - self.offset
+        self.num_entries = math.ceil(data_size / self.bytes_per_entry)
+        self.num_samples = data_size // bytes_per_sample
 
         print('data file:', data_file, 'number of batches:', self.num_entries)
-        self.file = open(data_file, 'rb')
+        # the file is memory mapped lazily, by each process using the dataset
+        self.data_file = data_file
+        self.data = None
 
         with np.load(counts_file) as data:
             self.counts = data["counts"]
@@ -226,11 +501,19 @@ class CriteoBinDataset(Dataset):
     def __len__(self):
         return self.num_entries
 
-    def __getitem__(self, idx):
-        self.file.seek(idx * self.bytes_per_entry, 0)
-        raw_data = self.file.read(self.bytes_per_entry)
-        array = np.frombuffer(raw_data, dtype=np.int32)
-        tensor = torch.from_numpy(array).view((-1, self.tot_fea))
+    def _get_data(self):
+        if self.data is None:
+            # copy-on-write mapping, so that torch accepts it (without a copy)
+            self.data = np.memmap(self.data_file, dtype=self.dtype, mode='c',
+                                  offset=self.offset)
+            if self.header is None:
+                self.data = self.data.reshape((-1, self.tot_fea))
+        return self.data
+
+    def _transform_array(self, array):
+        if self.header is not None:
+            return self._transform_records(array)
+        tensor = torch.from_numpy(array)
 
         return _transform_features(x_int_batch=tensor[:, 1:14],
                                    x_cat_batch=tensor[:, 14:],
@@ -238,35 +521,138 @@ class CriteoBinDataset(Dataset):
                                    max_ind_range=self.max_ind_range,
                                    flag_input_torch_tensor=True)
 
-    def __del__(self):
-        self.file.close()
+    def _transform_records(self, records):
+        # the records are already transformed, only the types are widened
+        # (and ids reduced again if a smaller range than stored is requested)
+        x_int_batch = torch.from_numpy(records["x_int"].astype(np.float32))
+        x_cat_batch = np.empty((self.spa_fea, records.shape[0]), dtype=np.int64)
+        for j in range(self.spa_fea):
+            x_cat_batch[j] = records["c{}".format(j)]
+        stored_range = self.header["max_ind_range"]
+        if self.max_ind_range > 0 and (
+            stored_range <= 0 or self.max_ind_range < stored_range
+        ):
+            x_cat_batch %= self.max_ind_range
+        x_cat_batch = torch.from_numpy(x_cat_batch)
+        y_batch = torch.from_numpy(records["y"].astype(np.float32)).view(-1, 1)
+
+        batch_size = x_cat_batch.shape[1]
+        lS_o = torch.arange(batch_size).reshape(1, -1).repeat(self.spa_fea, 1)
+
+        return x_int_batch, lS_o, x_cat_batch, y_batch
+
+    def __getitem__(self, idx):
+        data = self._get_data()
+        return self._transform_array(
+            data[idx * self.batch_size:(idx + 1) * self.batch_size]
+        )
 
+    def __getstate__(self):
+        # do not send the mapping to DataLoader workers (they map the file again)
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
 
-def numpy_to_binary(input_files, output_file_path, split='train'):
-    """Convert the data to a binary format to be read with CriteoBinDataset."""
+
+class CriteoBinShuffleDataset(CriteoBinDataset, IterableDataset):
+    """Binary version of criteo dataset, shuffled through a bounded buffer.
+
+    Every epoch the file is read as contiguous blocks of block_batches batches
+    in random order, buffer_blocks blocks at a time, and the samples in the
+    buffer are shuffled before being split into batches. The buffer holds at
+    most buffer_blocks * block_batches * batch_size samples. The number of
+    batches per epoch is the same as for CriteoBinDataset.
+
+    The order depends only on the seed and the epoch. The epoch advances after
+    every iteration in the process, but DataLoader workers iterate over copies
+    of the dataset, so with workers it must be set with set_epoch.
+    """
+
+    def __init__(self, data_file, counts_file,
+                 batch_size=1, max_ind_range=-1, bytes_per_feature=4,
+                 buffer_blocks=1, block_batches=1, seed=0):
+        super(CriteoBinShuffleDataset, self).__init__(
+            data_file, counts_file, batch_size, max_ind_range, bytes_per_feature
+        )
+        self.buffer_blocks = buffer_blocks
+        self.block_batches = block_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        data = self._get_data()
+        worker_info = torch.utils.data.get_worker_info()
+        epoch_seed = self.epoch
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            self.epoch += 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+        # all workers draw the same permutation of blocks, each takes its buffers
+        rs = np.random.RandomState([self.seed, epoch_seed])
+        block_size = self.block_batches * self.batch_size
+        num_blocks = math.ceil(self.num_entries / self.block_batches)
+        blocks = rs.permutation(num_blocks)
+        buffer_size = self.buffer_blocks
+        for i, k in enumerate(range(0, num_blocks, buffer_size)):
+            if i % num_workers != worker_id:
+                continue
+            buffer = np.concatenate(
+                [data[b * block_size:(b + 1) * block_size]
+                 for b in np.sort(blocks[k:k + buffer_size])]
+            )
+            p = np.random.RandomState([self.seed, epoch_seed, i]).permutation(
+                buffer.shape[0]
+            )
+            for j in range(0, buffer.shape[0], self.batch_size):
+                yield self._transform_array(buffer[p[j:j + self.batch_size]])
+
+
+def numpy_to_binary(input_files, output_file_path, split='train',
+                    counts_file=None, max_ind_range=-1):
+    """Convert the data to a binary format to be read with CriteoBinDataset.
+
+    If counts_file is given, the compact format is written: a versioned header
+    followed by records with a uint8 label, log-transformed float16 dense
+    features and sparse features (reduced by max_ind_range) in the narrowest
+    integer type their counts allow.
+    """
 
     # WARNING - both categorical and numerical data must fit into int32 for
     # the following code to work correctly
 
+    header = None
+    if counts_file is not None:
+        with np.load(counts_file) as data:
+            header = _compact_bin_header(data["counts"], max_ind_range)
+
+    def convert(np_data):
+        if header is not None:
+            return _compact_bin_records(np_data['y'], np_data['X_int'],
+                                        np_data['X_cat'], header)
+        np_data = np.concatenate([np_data['y'].reshape(-1, 1),
+                                  np_data['X_int'],
+                                  np_data['X_cat']], axis=1)
+        return np_data.astype(np.int32)
+
     with open(output_file_path, 'wb') as output_file:
+        if header is not None:
+            _write_bin_header(output_file, header)
         if split == 'train':
             for input_file in input_files:
                 print('Processing file: ', input_file)
 
-                np_data = np.load(input_file)
-                np_data = np.concatenate([np_data['y'].reshape(-1, 1),
-                                          np_data['X_int'],
-                                          np_data['X_cat']], axis=1)
-                np_data = np_data.astype(np.int32)
+                np_data = data_utils.loadCriteoArrays(input_file, mmap_mode="r")
+                np_data = convert(np_data)
 
                 output_file.write(np_data.tobytes())
         else:
             assert len(input_files) == 1
-            np_data = np.load(input_files[0])
-            np_data = np.concatenate([np_data['y'].reshape(-1, 1),
-                                      np_data['X_int'],
-                                      np_data['X_cat']], axis=1)
-            np_data = np_data.astype(np.int32)
+            np_data = data_utils.loadCriteoArrays(input_files[0], mmap_mode="r")
+            np_data = convert(np_data)
 
             samples_in_file = np_data.shape[0]
             midpoint = int(np.ceil(samples_in_file / 2.))
@@ -283,10 +669,13 @@ def numpy_to_binary(input_files, output_file_path, split='train'):
 
 
 def _preprocess(args):
+    # the last day (including appended days) is used for testing
+    with np.load(args.input_data_prefix + '_day_count.npz') as data:
+        days = len(data['total_per_file'])
     train_files = ['{}_{}_reordered.npz'.format(args.input_data_prefix, day) for
-                   day in range(0, 23)]
+                   day in range(0, days - 1)]
 
-    test_valid_file = args.input_data_prefix + '_23_reordered.npz'
+    test_valid_file = args.input_data_prefix + '_{}_reordered.npz'.format(days - 1)
 
     os.makedirs(args.output_directory, exist_ok=True)
     for split in ['train', 'val', 'test']:
@@ -6,7 +6,10 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import sys
-# import os
+import time
+import os
+import json
+import gzip
 from os import path
 from multiprocessing import Process, Manager
 # import io
@@ -77,7 +80,529 @@ def convertUStringToDistinctIntsUnique(mat, mat_uni, counts):
     return out, mat_uni, counts
 
 
-def processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, pre_comp_counts):
+# ASCII code to digit value (characters that are not digits map to 0)
+criteo_digit_lut = np.zeros(256, dtype=np.uint8)
+criteo_digit_lut[ord("0"):ord("9") + 1] = np.arange(10)
+criteo_digit_lut[ord("a"):ord("f") + 1] = np.arange(10, 16)
+criteo_digit_lut[ord("A"):ord("F") + 1] = np.arange(10, 16)
+
+
+def convertCriteoFields(buf, starts, lengths, base):
+    # Converts text fields stored in a byte buffer into integers, all at once.
+    # Fields of up to 8 characters (almost all of them) are loaded as a single
+    # 64-bit word each and converted with bitwise operations on all words in
+    # parallel; longer fields fall back to a loop over character positions.
+    #
+    # Inputs:
+    #     buf (np.array): uint8 view of the raw text, followed by at least
+    #                     8 bytes of padding
+    #     starts (np.array): offset of the first character of each field
+    #     lengths (np.array): number of characters in each field
+    #     base (int): 10 for decimal (dense) or 16 for hex (categorical) fields
+    #
+    # Outputs:
+    #     out (np.array): int64 values (missing fields are converted to 0)
+
+    u64 = np.uint64
+    shape = starts.shape
+    starts = starts.ravel()
+    lengths = lengths.ravel()
+    # the sign (if any) is the first character of the field
+    neg = (lengths > 0) & (buf[starts] == ord("-"))
+    starts = starts + neg
+    lengths = lengths - neg
+
+    # load 8 characters per field and align them on the last character,
+    # leaving zero bytes in front of the shorter fields
+    words = np.ndarray(
+        shape=(buf.size - 7,), dtype="<u8", buffer=buf, strides=(1,)
+    )[starts]
+    short = lengths <= 8
+    words[np.logical_not(short) | (lengths == 0)] = 0
+    shift = ((8 - np.clip(lengths, 1, 8)) * 8).astype(u64)
+    words <<= shift
+
+    if base == 16:
+        # ASCII to nibbles (letters have bit 6 set), then pack nibbles
+        d = (words & u64(0x0F0F0F0F0F0F0F0F)) + (
+            (words >> u64(6)) & u64(0x0101010101010101)
+        ) * u64(9)
+        d = ((d & u64(0x000F000F000F000F)) << u64(4)) | (
+            (d >> u64(8)) & u64(0x000F000F000F000F)
+        )
+        out = (
+            ((d & u64(0xFF)) << u64(24))
+            | (((d >> u64(16)) & u64(0xFF)) << u64(16))
+            | (((d >> u64(32)) & u64(0xFF)) << u64(8))
+            | ((d >> u64(48)) & u64(0xFF))
+        )
+    else:
+        # ASCII to digits, then combine pairs of digits, pairs of pairs, ...
+        d = words & u64(0x0F0F0F0F0F0F0F0F)
+        d = (d & u64(0x00FF00FF00FF00FF)) * u64(10) + (
+            (d >> u64(8)) & u64(0x00FF00FF00FF00FF)
+        )
+        d = (d & u64(0x0000FFFF0000FFFF)) * u64(100) + (
+            (d >> u64(16)) & u64(0x0000FFFF0000FFFF)
+        )
+        out = (d & u64(0xFFFFFFFF)) * u64(10000) + (d >> u64(32))
+    out = out.astype(np.int64)
+
+    # long fields, one character position at a time
+    if not np.all(short):
+        long_fields = np.flatnonzero(np.logical_not(short))
+        ends = starts[long_fields] + lengths[long_fields]
+        val = np.zeros(long_fields.shape, dtype=np.int64)
+        for k in range(int(lengths.max()), 0, -1):
+            d = criteo_digit_lut[np.take(buf, ends - k, mode="clip")]
+            d *= lengths[long_fields] >= k
+            val *= base
+            val += d
+        out[long_fields] = val
+
+    np.negative(out, out=out, where=neg)
+
+    return out.reshape(shape)
+
+
+def parseCriteoBlock(block, max_ind_range=-1):
+    # Parses a block of complete lines of Criteo text data at once.
+    #
+    # Inputs:
+    #     block (bytes): raw text consisting of one or more complete lines
+    #     max_ind_range (int): if positive, categorical values are taken
+    #                          modulo max_ind_range
+    #
+    # Outputs:
+    #     y (np.array): int32 targets
+    #     X_int (np.array): int32 dense features
+    #     X_cat (np.array): int32 categorical features
+
+    if not block.endswith(b"\n"):
+        block += b"\n"
+    # pad the text so that 8 characters can be loaded from any field
+    buf = np.frombuffer(block + b"\0" * 8, dtype=np.uint8)
+
+    # each line has 40 fields: 1 target, 13 dense and 26 categorical features
+    sep = np.flatnonzero((buf == ord("\t")) | (buf == ord("\n")))
+    if sep.size % 40 != 0 or np.any(buf[sep[39::40]] != ord("\n")):
+        sys.exit("ERROR: malformed line, expected 40 tab separated fields")
+    starts = np.empty_like(sep)
+    starts[0] = 0
+    starts[1:] = sep[:-1] + 1
+    lengths = sep - starts
+    # drop the carriage return of CRLF line endings
+    lengths[39::40] -= buf[sep[39::40] - 1] == ord("\r")
+    lengths = lengths.reshape(-1, 40)
+    starts = starts.reshape(-1, 40)
+
+    y = convertCriteoFields(buf, starts[:, 0], lengths[:, 0], 10)
+    X_int = convertCriteoFields(buf, starts[:, 1:14], lengths[:, 1:14], 10)
+    X_cat = convertCriteoFields(buf, starts[:, 14:], lengths[:, 14:], 16)
+    if max_ind_range > 0:
+        X_cat %= max_ind_range
+
+    return y.astype(np.int32), X_int.astype(np.int32), X_cat.astype(np.int32)
+
+
+def readCriteoBlocks(datfile, block_size=1 << 24, start=0, end=None):
+    # Reads a text file (or its byte range [start, end) starting and ending on
+    # line boundaries) in blocks of (approximately) block_size bytes,
+    # which always end on a line boundary. Files ending in .gz are decompressed
+    # on the fly (byte ranges then refer to the decompressed text).
+    opener = gzip.open if str(datfile).endswith(".gz") else open
+    with opener(str(datfile), "rb") as f:
+        f.seek(start)
+        pos = start
+        while end is None or pos < end:
+            block = f.read(block_size if end is None else min(block_size, end - pos))
+            if not block:
+                break
+            if not block.endswith(b"\n"):
+                block += f.readline()
+            pos += len(block)
+            yield block
+
+
+def getCriteoOffsets(datfile, splits, start=0, end=None):
+    # Splits a text file (or its byte range [start, end) starting and ending on
+    # line boundaries) into byte ranges of (approximately) equal size,
+    # which start and end on line boundaries.
+    #
+    # Inputs:
+    #     datfile (str): path to the text file
+    #     splits (int): number of ranges
+    #
+    # Outputs:
+    #     offsets (list): splits + 1 byte offsets, range i is [offsets[i], offsets[i + 1])
+    if end is None:
+        end = path.getsize(str(datfile))
+    size = end - start
+    offsets = [start]
+    with open(str(datfile), "rb") as f:
+        for k in range(1, splits):
+            pos = max(start + k * size // splits, offsets[-1])
+            if pos > start:
+                # move to the beginning of the next line
+                f.seek(pos - 1)
+                f.readline()
+                pos = f.tell()
+            offsets.append(pos)
+    offsets.append(end)
+    return offsets
+
+
+def sortCriteoDict(unique):
+    # Converts a dictionary, given as an array of unique values in the order
+    # of their ids, into sorted values and matching ids (for vectorized lookups).
+    #
+    # Inputs:
+    #     unique (np.array): unique values of a categorical feature
+    #
+    # Outputs:
+    #     keys (np.array): sorted unique values
+    #     ids (np.array): int32 id of each value in keys
+    ids = np.argsort(unique, kind="stable").astype(np.int32)
+    return unique[ids], ids
+
+
+def convertCriteoCategories(x, keys, ids, oov=None):
+    # Maps all values of a categorical feature to their ids at once.
+    #
+    # Inputs:
+    #     x (np.array): values of a categorical feature
+    #     keys, ids (np.array): dictionary as returned by sortCriteoDict
+    #     oov (int): id of values missing from the dictionary (if any)
+    #
+    # Outputs:
+    #     out (np.array): int32 ids
+    pos = np.searchsorted(keys, x)
+    if oov is None:
+        return ids[pos]
+    if keys.size == 0:
+        return np.full(x.shape, oov, dtype=np.int32)
+    pos = np.minimum(pos, keys.size - 1)
+    return np.where(keys[pos] == x, ids[pos], np.int32(oov))
+
+
+def uniqueCriteoCategories(X_cat):
+    # Finds the unique values of all categorical features of a day (or split),
+    # together with the position of their first appearance and their counts.
+    #
+    # Inputs:
+    #     X_cat (np.array): categorical features, one row per data point
+    #
+    # Outputs:
+    #     uniques (dict): sorted unique values "unique_j", the positions
+    #                     "first_j" of their first appearance and the number
+    #                     of their occurrences "count_j", for each feature j
+    uniques = {}
+    for j in range(X_cat.shape[1]):
+        unique, first, count = np.unique(
+            X_cat[:, j], return_index=True, return_counts=True
+        )
+        uniques["unique_{0}".format(j)] = unique
+        uniques["first_{0}".format(j)] = first.astype(np.int64)
+        uniques["count_{0}".format(j)] = count.astype(np.int64)
+    return uniques
+
+
+def mergeCriteoUniques(uniques, firsts, counts):
+    # Merges the sorted unique values of several days (or splits) at once,
+    # with a single stable sort of all of them. Values seen in several days
+    # keep their first appearance and add up their counts.
+    # The values are int32 (the hex categories above 2^31 are negative), which
+    # is fine as only sortCriteoDict has to agree with their order: the ids are
+    # assigned by appearance or count, so a uint32 order gives the same ids.
+    #
+    # Inputs:
+    #     uniques, firsts, counts (list): sorted values, positions and counts
+    #                                     (np.array) of each day, at least one
+    #
+    # Outputs:
+    #     unique, first, count (np.array): merged sorted values, positions and counts
+    unique = np.concatenate(uniques)
+    order = np.argsort(unique, kind="stable")
+    unique = unique[order]
+    first = np.concatenate(firsts)[order]
+    count = np.concatenate(counts)[order]
+    if unique.size == 0:
+        return unique, first, count
+    start = np.flatnonzero(np.concatenate(([True], unique[1:] != unique[:-1])))
+    return (
+        unique[start],
+        np.minimum.reduceat(first, start),
+        np.add.reduceat(count, start),
+    )
+
+
+def orderCriteoUniques(unique, first, count=None, frequency_ids=False, min_count=0):
+    # Assigns ids to the sorted unique values in the order of their first
+    # appearance (the same order a dictionary of values would be built in),
+    # or in descending order of their counts (ties in order of appearance).
+    # Values occurring less than min_count times share a single (last) OOV id.
+    #
+    # Inputs:
+    #     unique, first, count (np.array): sorted values, positions and counts
+    #     frequency_ids (bool): assign ids in descending order of counts
+    #     min_count (int): minimum count of values with their own id
+    #
+    # Outputs:
+    #     unique_ordered (np.array): values with their own id, in the order of ids
+    #     ids (np.array): int32 id of each value in unique
+    #     oov (int): id shared by the remaining values (None if min_count is 0)
+    if frequency_ids:
+        order = np.lexsort((first, -count))
+    else:
+        order = np.argsort(first, kind="stable")
+    if min_count > 0:
+        order = order[count[order] >= min_count]
+        oov = order.size
+    else:
+        oov = None
+    ids = np.full(unique.shape, -1 if oov is None else oov, dtype=np.int32)
+    ids[order] = np.arange(order.size, dtype=np.int32)
+    return unique[order], ids, oov
+
+
+def getCriteoSketchHashes(depth=4, seed=123):
+    # Draws the parameters of depth multiply-shift hash functions (used by the
+    # count-min sketch), with a local random state to leave the global one intact.
+    #
+    # Outputs:
+    #     hashes (tuple): odd multipliers a and increments b (np.uint64 arrays)
+    rng = np.random.RandomState(seed)
+    a = rng.randint(0, 1 << 63, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.randint(0, 1 << 63, size=depth, dtype=np.uint64) * np.uint64(2)
+    return a, b
+
+
+def hashCriteoSketch(x, hashes, bits):
+    # Hashes values into 2^bits buckets, with each of the hash functions.
+    #
+    # Outputs:
+    #     h (np.array): bucket of each value for each hash function (depth, n)
+    a, b = hashes
+    x = np.asarray(x, dtype=np.int32).view(np.uint32).astype(np.uint64)
+    h = a[:, None] * x[None, :] + b[:, None]
+    return (h >> np.uint64(64 - bits)).astype(np.intp)
+
+
+def sketchCriteoCategories(X_cat, hashes, bits, chunk_size=1 << 22):
+    # Builds a count-min sketch of the values of each categorical feature.
+    #
+    # Inputs:
+    #     X_cat (np.array): categorical features, one row per data point
+    #     hashes (tuple): hash functions as returned by getCriteoSketchHashes
+    #     bits (int): log2 of the width of the sketch
+    #
+    # Outputs:
+    #     sketch (np.array): uint32 counters of shape (features, depth, 2^bits)
+    depth = hashes[0].size
+    sketch = np.zeros((X_cat.shape[1], depth, 1 << bits), dtype=np.uint32)
+    for j in range(X_cat.shape[1]):
+        for k in range(0, X_cat.shape[0], chunk_size):
+            h = hashCriteoSketch(X_cat[k:k + chunk_size, j], hashes, bits)
+            for d in range(depth):
+                sketch[j, d] += np.bincount(h[d], minlength=1 << bits).astype(np.uint32)
+    return sketch
+
+
+def mergeCriteoSketches(sketch, sketch_new):
+    # Adds up two count-min sketches (saturating the uint32 counters).
+    total = sketch.astype(np.uint64) + sketch_new
+    return np.minimum(total, np.iinfo(np.uint32).max).astype(np.uint32)
+
+
+def queryCriteoSketch(sketch_j, x, hashes, bits, chunk_size=1 << 22):
+    # Estimates the counts of values of a categorical feature from its sketch
+    # (the estimates never underestimate the true counts).
+    #
+    # Inputs:
+    #     sketch_j (np.array): sketch of the feature (depth, 2^bits)
+    #     x (np.array): values of the feature
+    #
+    # Outputs:
+    #     est (np.array): estimated count of each value
+    est = np.zeros(x.shape[0], dtype=np.uint32)
+    for k in range(0, x.shape[0], chunk_size):
+        h = hashCriteoSketch(x[k:k + chunk_size], hashes, bits)
+        est[k:k + chunk_size] = np.min(
+            sketch_j[np.arange(h.shape[0])[:, None], h], axis=0
+        )
+    return est
+
+
+class CriteoArrays:
+    # Arrays of a day (or of the whole dataset) stored in the "npy" format,
+    # one raw .npy file per array together with a small json manifest.
+    # Supports the subset of the np.load(npz) interface used by the loaders.
+
+    def __init__(self, filename, mmap_mode=None):
+        with open(filename) as f:
+            self.manifest = json.load(f)
+        self.d_path = path.dirname(filename)
+        self.mmap_mode = mmap_mode
+        self.files = list(self.manifest["arrays"])
+
+    def __getitem__(self, key):
+        if key not in self.manifest["arrays"]:
+            raise KeyError("%s is not a file in the archive" % key)
+        fi = path.join(self.d_path, self.manifest["arrays"][key]["file"])
+        return np.load(fi, mmap_mode=self.mmap_mode)
+
+    def __contains__(self, key):
+        return key in self.manifest["arrays"]
+
+    def keys(self):
+        return self.files
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def getCriteoManifest(filename):
+    # Returns the manifest file name that replaces filename (*.npz) in "npy" format
+    if filename.endswith(".npz"):
+        filename = filename[:-4]
+    return filename + ".json"
+
+
+def existsCriteoArrays(filename):
+    # Checks if arrays saved under filename (*.npz) exist in any of the formats
+    return path.exists(filename) or path.exists(getCriteoManifest(filename))
+
+
+def saveCriteoArrays(filename, data_format="npz", **arrays):
+    # Saves arrays under filename (*.npz) in the given format.
+    #
+    # Inputs:
+    #     filename (str): file name (with .npz extension)
+    #     data_format (str): "npz" for a compressed archive or "npy" for raw
+    #                        (memory-mappable) .npy files and a json manifest
+    #     arrays (np.array): arrays to be saved
+    if data_format == "npz":
+        np.savez_compressed(filename, **arrays)
+    elif data_format == "npy":
+        manifest_file = getCriteoManifest(filename)
+        base = path.basename(manifest_file)[:-len(".json")]
+        manifest = {"format": "npy", "version": 1, "arrays": {}}
+        for key, x in arrays.items():
+            x = np.ascontiguousarray(x)
+            fi = base + "_" + key + ".npy"
+            np.save(path.join(path.dirname(manifest_file), fi), x)
+            manifest["arrays"][key] = {
+                "file": fi,
+                "dtype": x.dtype.str,
+                "shape": list(x.shape),
+            }
+        # the manifest is written last, its existence marks complete data
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=1)
+    else:
+        sys.exit("ERROR: unknown data format " + str(data_format))
+
+
+def saveCriteoArraysPermuted(filename, indices, data_format="npz", chunk_size=1 << 20, **arrays):
+    # Saves the rows indices of arrays (x[indices] for each array) like
+    # saveCriteoArrays. The rows are gathered in chunks into memory-mapped .npy
+    # files, so that the (memory-mapped) inputs are never permuted in memory.
+    #
+    # Inputs:
+    #     filename (str): file name (with .npz extension)
+    #     indices (np.array): permutation of the rows
+    #     data_format (str): "npz" or "npy" (see saveCriteoArrays)
+    #     chunk_size (int): number of rows gathered at a time
+    #     arrays (np.array): arrays to be saved (with len(indices) rows)
+    if data_format == "npz":
+        # permute into temporary .npy files, then compress them from disk
+        tmp_filename = filename[:-len(".npz")] + "_tmp.npz"
+        saveCriteoArraysPermuted(tmp_filename, indices, "npy", chunk_size, **arrays)
+        tmp = CriteoArrays(getCriteoManifest(tmp_filename), mmap_mode="r")
+        np.savez_compressed(filename, **{key: tmp[key] for key in tmp.keys()})
+        for key in tmp.keys():
+            os.remove(path.join(tmp.d_path, tmp.manifest["arrays"][key]["file"]))
+        os.remove(getCriteoManifest(tmp_filename))
+    elif data_format == "npy":
+        manifest_file = getCriteoManifest(filename)
+        base = path.basename(manifest_file)[:-len(".json")]
+        manifest = {"format": "npy", "version": 1, "arrays": {}}
+        for key, x in arrays.items():
+            fi = base + "_" + key + ".npy"
+            out = np.lib.format.open_memmap(
+                path.join(path.dirname(manifest_file), fi),
+                mode="w+",
+                dtype=x.dtype,
+                shape=(len(indices),) + x.shape[1:],
+            )
+            for k in range(0, len(indices), chunk_size):
+                out[k:k + chunk_size] = x[indices[k:k + chunk_size]]
+            out.flush()
+            del out
+            manifest["arrays"][key] = {
+                "file": fi,
+                "dtype": x.dtype.str,
+                "shape": [len(indices)] + list(x.shape[1:]),
+            }
+        # the manifest is written last, its existence marks complete data
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=1)
+    else:
+        sys.exit("ERROR: unknown data format " + str(data_format))
+
+
+def replaceCriteoArrays(filename, new_filename):
+    # Replaces the arrays saved under filename (*.npz), in any format, by the
+    # ones saved under new_filename, which are moved (renamed) into their place
+    manifest_file = getCriteoManifest(filename)
+    for fi in [filename, manifest_file]:
+        if path.exists(fi):
+            os.remove(fi)
+    if path.exists(new_filename):
+        os.replace(new_filename, filename)
+        return
+    new_manifest_file = getCriteoManifest(new_filename)
+    with open(new_manifest_file) as f:
+        manifest = json.load(f)
+    d_path = path.dirname(manifest_file)
+    base = path.basename(manifest_file)[:-len(".json")]
+    for key, meta in manifest["arrays"].items():
+        fi = base + "_" + key + ".npy"
+        os.replace(path.join(d_path, meta["file"]), path.join(d_path, fi))
+        meta["file"] = fi
+    # the manifest is written last, its existence marks complete data
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.remove(new_manifest_file)
+
+
+def loadCriteoArrays(filename, mmap_mode=None):
+    # Opens arrays saved under filename (*.npz) by saveCriteoArrays, in either
+    # format. Arrays in "npy" format are memory mapped if mmap_mode is given.
+    #
+    # Outputs:
+    #     data (NpzFile or CriteoArrays): arrays accessed by name
+    manifest_file = getCriteoManifest(filename)
+    if not path.exists(filename) and path.exists(manifest_file):
+        return CriteoArrays(manifest_file, mmap_mode)
+    return np.load(filename)
+
+
+def processCriteoAdData(
+        d_path,
+        d_file,
+        npzfile,
+        i,
+        convertDicts,
+        pre_comp_counts,
+        data_format="npz"
+):
     # Process Kaggle Display Advertising Challenge or Terabyte Dataset
     # by converting unicode strings in X_cat to integers and
     # converting negative integer values in X_int.
@@ -87,15 +612,18 @@ def processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, pre_comp_count
     # Inputs:
     #   d_path (str): path for {kaggle|terabyte}_day_i.npz files
     #   i (int): splits in the dataset (typically 0 to 7 or 0 to 24)
+    #   convertDicts (list): (keys, ids, oov) for each categorical feature,
+    #                        see sortCriteoDict and convertCriteoCategories
+    #   data_format (str): format of the processed file, npz or npy
 
     # process data if not all files exist
     filename_i = npzfile + "_{0}_processed.npz".format(i)
 
-    if path.exists(filename_i):
+    if existsCriteoArrays(filename_i):
         print("Using existing " + filename_i, end="\n")
     else:
         print("Not existing " + filename_i)
-        with np.load(npzfile + "_{0}.npz".format(i)) as data:
+        with loadCriteoArrays(npzfile + "_{0}.npz".format(i), mmap_mode="c") as data:
             # categorical features
             '''
             # Approach 1a: using empty dictionaries
@@ -109,25 +637,39 @@ def processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, pre_comp_count
                 data["X_cat"], convertDicts, counts
             )
             '''
+            '''
             # Approach 2a: using pre-computed dictionaries
             X_cat_t = np.zeros(data["X_cat_t"].shape)
             for j in range(26):
                 for k, x in enumerate(data["X_cat_t"][j, :]):
                     X_cat_t[j, k] = convertDicts[j][x]
+            '''
+            # Approach 2b: using pre-computed dictionaries (vectorized lookup)
+            t_start = time.time()
+            X_cat_t = data["X_cat_t"]
+            for j in range(26):
+                X_cat_t[j, :] = convertCriteoCategories(
+                    X_cat_t[j, :], *convertDicts[j]
+                )
             # continuous features
             X_int = data["X_int"]
             X_int[X_int < 0] = 0
             # targets
             y = data["y"]
+            t_map = time.time() - t_start
 
-        np.savez_compressed(
+        saveCriteoArrays(
             filename_i,
+            data_format,
             # X_cat = X_cat,
             X_cat=np.transpose(X_cat_t),  # transpose of the data
             X_int=X_int,
             y=y,
         )
-        print("Processed " + filename_i, end="\n")
+        print(
+            "Processed %s: mapped %d rows in %.2f s (%.0f rows/s)"
+            % (filename_i, len(y), t_map, len(y) / max(t_map, 1e-9))
+        )
     # sanity check (applicable only if counts have been pre-computed & are re-computed)
     # for j in range(26):
     #    if pre_comp_counts[j] != counts[j]:
@@ -148,7 +690,8 @@ def concatCriteoAdData(
         total_per_file,
         total_count,
         memory_map,
-        o_filename
+        o_filename,
+        data_format="npz"
 ):
     # Concatenates different days and saves the result.
     #
@@ -156,6 +699,7 @@ def concatCriteoAdData(
     #   days (int): total number of days in the dataset (typically 7 or 24)
     #   d_path (str): path for {kaggle|terabyte}_day_i.npz files
     #   o_filename (str): output file name
+    #   data_format (str): format of the output files, npz or npy
     #
     # Output:
     #   o_file (str): output file path
@@ -543,19 +1087,12 @@ def concatCriteoAdData(
                 recreate_flag = True
         # reorder across buckets using sampling
         if recreate_flag:
-            # init intermediate files (.npy appended automatically)
-            for j in range(days):
-                filename_j_y = npzfile + "_{0}_intermediate_y".format(j)
-                filename_j_d = npzfile + "_{0}_intermediate_d".format(j)
-                filename_j_s = npzfile + "_{0}_intermediate_s".format(j)
-                np.save(filename_j_y, np.zeros((total_per_file[j])))
-                np.save(filename_j_d, np.zeros((total_per_file[j], den_fea)))
-                np.save(filename_j_s, np.zeros((total_per_file[j], spa_fea)))
             # start processing files
-            total_counter = [0] * days
+            fj_y, fj_d, fj_s = [], [], []
+            total_counter = np.zeros(days, dtype=np.int64)
             for i in range(days):
                 filename_i = npzfile + "_{0}_processed.npz".format(i)
-                with np.load(filename_i) as data:
+                with loadCriteoArrays(filename_i, mmap_mode="r") as data:
                     X_cat = data["X_cat"]
                     X_int = data["X_int"]
                     y = data["y"]
@@ -566,82 +1103,90 @@ def concatCriteoAdData(
                 # debug prints
                 print("Reordering (1st pass) " + filename_i)
 
-                # create buckets using sampling of random ints
-                # from (discrete) uniform distribution
-                buckets = []
-                for _j in range(days):
-                    buckets.append([])
-                counter = [0] * days
+                # init intermediate files (with the dtypes of the processed data,
+                # the shapes must be python ints to give valid .npy headers)
+                if i == 0:
+                    for j in range(days):
+                        size_j = int(total_per_file[j])
+                        fj_y.append(np.lib.format.open_memmap(
+                            npzfile + "_{0}_intermediate_y.npy".format(j),
+                            mode="w+", dtype=y.dtype, shape=(size_j,)
+                        ))
+                        fj_d.append(np.lib.format.open_memmap(
+                            npzfile + "_{0}_intermediate_d.npy".format(j),
+                            mode="w+", dtype=X_int.dtype, shape=(size_j, den_fea)
+                        ))
+                        fj_s.append(np.lib.format.open_memmap(
+                            npzfile + "_{0}_intermediate_s.npy".format(j),
+                            mode="w+", dtype=X_cat.dtype, shape=(size_j, spa_fea)
+                        ))
+
+                # assign samples to buckets: each sample (in order) goes to a
+                # bucket drawn uniformly among the buckets that are not yet full
+                # (as retrying uniform draws until a bucket with space is hit).
+                # The draws are done in phases, while the set of buckets that
+                # are not full is fixed the counts of a phase are multinomial
+                # and the phase ends (at the latest) when the first bucket fills.
+                counter = np.zeros(days, dtype=np.int64)
                 days_to_sample = days if data_split == "none" else days - 1
-                if randomize == "total":
-                    rand_u = np.random.randint(low=0, high=days_to_sample, size=size)
-                    for k in range(size):
-                        # sample and make sure elements per buckets do not overflow
-                        if data_split == "none" or i < days - 1:
-                            # choose bucket
-                            p = rand_u[k]
-                            # retry of the bucket is full
-                            while total_counter[p] + counter[p] >= total_per_file[p]:
-                                p = np.random.randint(low=0, high=days_to_sample)
-                        else:  # preserve the last day/bucket if needed
-                            p = i
-                        buckets[p].append(k)
-                        counter[p] += 1
-                else:  # randomize is day or none
-                    for k in range(size):
-                        # do not sample, preserve the data in this bucket
-                        p = i
-                        buckets[p].append(k)
-                        counter[p] += 1
+                if randomize == "total" and (data_split == "none" or i < days - 1):
+                    space = np.array(total_per_file[:days_to_sample]) \
+                        - total_counter[:days_to_sample]
+                    left = size
+                    buckets = [np.zeros(0, dtype=np.int64)]
+                    while left > 0:
+                        free = np.flatnonzero(space > 0)
+                        if len(free) == 0:
+                            sys.exit("ERROR: sanity check on number of samples failed")
+                        m = min(left, np.min(space[free]))
+                        counts = np.random.multinomial(m, [1.0 / len(free)] * len(free))
+                        phase = np.repeat(free, counts)
+                        np.random.shuffle(phase)
+                        buckets.append(phase)
+                        space[free] -= counts
+                        left -= m
+                    buckets = np.concatenate(buckets)
+                    counter[:days_to_sample] = np.bincount(
+                        buckets, minlength=days_to_sample
+                    )
+                    # samples of a bucket keep their relative order
+                    order = np.argsort(buckets, kind="stable")
+                else:  # randomize is day or none (or preserve the last day/bucket)
+                    # do not sample, preserve the data in this bucket
+                    counter[i] = size
+                    order = np.arange(size)
 
                 # sanity check
-                if np.sum(counter) != size:
+                if np.sum(counter) != size or np.any(
+                    total_counter + counter > np.array(total_per_file[:days])
+                ):
                     sys.exit("ERROR: sanity check on number of samples failed")
-                # debug prints
-                # print(counter)
-                # print(str(np.sum(counter)) + " = " + str(size))
-                # print([len(x) for x in buckets])
-                # print(total_counter)
 
-                # partially feel the buckets
+                # partially fill the buckets
+                k = 0
                 for j in range(days):
-                    filename_j_y = npzfile + "_{0}_intermediate_y.npy".format(j)
-                    filename_j_d = npzfile + "_{0}_intermediate_d.npy".format(j)
-                    filename_j_s = npzfile + "_{0}_intermediate_s.npy".format(j)
+                    if counter[j] == 0:
+                        continue
                     start = total_counter[j]
                     end = total_counter[j] + counter[j]
-                    # target buckets
-                    fj_y = np.load(filename_j_y, mmap_mode='r+')
-                    # print("start=" + str(start) + " end=" + str(end)
-                    #       + " end - start=" + str(end - start) + " "
-                    #       + str(fj_y[start:end].shape) + " "
-                    #       + str(len(buckets[j])))
-                    fj_y[start:end] = y[buckets[j]]
-                    del fj_y
-                    # dense buckets
-                    fj_d = np.load(filename_j_d, mmap_mode='r+')
-                    # print("start=" + str(start) + " end=" + str(end)
-                    #       + " end - start=" + str(end - start) + " "
-                    #       + str(fj_d[start:end, :].shape) + " "
-                    #       + str(len(buckets[j])))
-                    fj_d[start:end, :] = X_int[buckets[j], :]
-                    del fj_d
-                    # sparse buckets
-                    fj_s = np.load(filename_j_s, mmap_mode='r+')
-                    # print("start=" + str(start) + " end=" + str(end)
-                    #       + " end - start=" + str(end - start) + " "
-                    #       + str(fj_s[start:end, :].shape) + " "
-                    #       + str(len(buckets[j])))
-                    fj_s[start:end, :] = X_cat[buckets[j], :]
-                    del fj_s
+                    bucket = order[k:k + counter[j]]
+                    fj_y[j][start:end] = y[bucket]
+                    fj_d[j][start:end, :] = X_int[bucket, :]
+                    fj_s[j][start:end, :] = X_cat[bucket, :]
                     # update counters for next step
                     total_counter[j] += counter[j]
+                    k += counter[j]
+            for j in range(days):
+                fj_y[j].flush()
+                fj_d[j].flush()
+                fj_s[j].flush()
+            del fj_y, fj_d, fj_s
 
         # 2nd pass of FYR shuffle
         # check if data already exists
         for j in range(days):
             filename_j = npzfile + "_{0}_reordered.npz".format(j)
-            if path.exists(filename_j):
+            if existsCriteoArrays(filename_j):
                 print("Using existing " + filename_j)
             else:
                 recreate_flag = True
@@ -651,23 +1196,33 @@ def concatCriteoAdData(
                 filename_j_y = npzfile + "_{0}_intermediate_y.npy".format(j)
                 filename_j_d = npzfile + "_{0}_intermediate_d.npy".format(j)
                 filename_j_s = npzfile + "_{0}_intermediate_s.npy".format(j)
-                fj_y = np.load(filename_j_y)
-                fj_d = np.load(filename_j_d)
-                fj_s = np.load(filename_j_s)
-
-                indices = range(total_per_file[j])
-                if randomize == "day" or randomize == "total":
-                    if data_split == "none" or j < days - 1:
-                        indices = np.random.permutation(range(total_per_file[j]))
+                fj_y = np.load(filename_j_y, mmap_mode="r")
+                fj_d = np.load(filename_j_d, mmap_mode="r")
+                fj_s = np.load(filename_j_s, mmap_mode="r")
 
                 filename_r = npzfile + "_{0}_reordered.npz".format(j)
                 print("Reordering (2nd pass) " + filename_r)
-                np.savez_compressed(
-                    filename_r,
-                    X_cat=fj_s[indices, :],
-                    X_int=fj_d[indices, :],
-                    y=fj_y[indices],
-                )
+                if (randomize == "day" or randomize == "total") and (
+                    data_split == "none" or j < days - 1
+                ):
+                    indices = np.random.permutation(total_per_file[j])
+                    saveCriteoArraysPermuted(
+                        filename_r,
+                        indices,
+                        data_format,
+                        X_cat=fj_s,
+                        X_int=fj_d,
+                        y=fj_y,
+                    )
+                else:
+                    saveCriteoArrays(
+                        filename_r,
+                        data_format,
+                        X_cat=fj_s,
+                        X_int=fj_d,
+                        y=fj_y,
+                    )
+                del fj_y, fj_d, fj_s
 
         '''
         # sanity check (under no reordering norms should be zero)
@@ -695,7 +1250,7 @@ def concatCriteoAdData(
         # load and concatenate data
         for i in range(days):
             filename_i = npzfile + "_{0}_processed.npz".format(i)
-            with np.load(filename_i) as data:
+            with loadCriteoArrays(filename_i) as data:
                 if i == 0:
                     X_cat = data["X_cat"]
                     X_int = data["X_int"]
@@ -710,8 +1265,9 @@ def concatCriteoAdData(
             counts = data["counts"]
         print("Loaded counts!")
 
-        np.savez_compressed(
+        saveCriteoArrays(
             d_path + o_filename + ".npz",
+            data_format,
             X_cat=X_cat,
             X_int=X_int,
             y=y,
@@ -852,6 +1408,11 @@ def getCriteoAdData(
         criteo_kaggle=True,
         memory_map=False,
         dataset_multiprocessing=False,
+        dataset_hashing=False,
+        data_format="npz",
+        frequency_ids=False,
+        min_count=0,
+        sketch_size=0,
 ):
     # Passes through entire dataset and defines dictionaries for categorical
     # features and determines the number of total categories.
@@ -859,10 +1420,31 @@ def getCriteoAdData(
     # Inputs:
     #    datafile : path to downloaded raw data file
     #    o_filename (str): saves results under o_filename if filename is not ""
+    #    dataset_hashing (bool): skip the dictionaries and use the categorical
+    #                            values modulo max_ind_range as ids directly
+    #    data_format (str): format of the day files, compressed "npz" or raw
+    #                       (memory-mappable) "npy"
+    #    frequency_ids (bool): assign ids of categorical features in descending
+    #                          order of frequency (instead of order of appearance)
+    #    min_count (int): values occurring less than min_count times are mapped
+    #                     to a single out-of-vocabulary (OOV) id of their feature
+    #    sketch_size (int): if positive, estimate the counts (for min_count) with
+    #                       count-min sketches of sketch_size MB per split
+    #                       instead of counting all unique values exactly
     #
     # Output:
     #   o_file (str): output file path
 
+    if dataset_hashing and max_ind_range <= 0:
+        sys.exit("ERROR: dataset hashing requires a positive max_ind_range")
+    if sketch_size > 0 and min_count <= 0:
+        sys.exit("ERROR: count-min sketches require a positive min_count")
+    if sketch_size > 0:
+        # 26 sketches of depth 4 with uint32 counters fit into sketch_size MB
+        sketch_hashes = getCriteoSketchHashes()
+        sketch_bits = int(np.log2(sketch_size * (1 << 20) / (26 * 4 * 4)))
+        sketch_bits = min(max(sketch_bits, 1), 32)
+
     #split the datafile into path and filename
     lstr = datafile.split("/")
     d_path = "/".join(lstr[0:-1]) + "/"
@@ -887,28 +1469,8 @@ def getCriteoAdData(
             # missing and will be interpreted as 0).
             if path.exists(datafile):
                 print("Reading data from path=%s" % (datafile))
-                with open(str(datafile)) as f:
-                    for _ in f:
-                        total_count += 1
-                total_per_file.append(total_count)
-                # reset total per file due to split
-                num_data_per_split, extras = divmod(total_count, days)
-                total_per_file = [num_data_per_split] * days
-                for j in range(extras):
-                    total_per_file[j] += 1
-                # split into days (simplifies code later on)
-                file_id = 0
-                boundary = total_per_file[file_id]
-                nf = open(npzfile + "_" + str(file_id), "w")
-                with open(str(datafile)) as f:
-                    for j, line in enumerate(f):
-                        if j == boundary:
-                            nf.close()
-                            file_id += 1
-                            nf = open(npzfile + "_" + str(file_id), "w")
-                            boundary += total_per_file[file_id]
-                        nf.write(line)
-                nf.close()
+                # the number of samples per split is only known after parsing
+                total_per_file = [None] * days
             else:
                 sys.exit("ERROR: Criteo Kaggle Display Ad Challenge Dataset path is invalid; please download from https://labs.criteo.com/2014/02/kaggle-display-advertising-challenge-dataset")
         else:
@@ -938,141 +1500,172 @@ def getCriteoAdData(
             split,
             num_data_in_split,
             dataset_multiprocessing,
-            convertDictsDay=None,
-            resultDay=None
+            resultDay=None,
+            maxDay=None,
+            start=0,
+            end=None
     ):
-        if dataset_multiprocessing:
-            convertDicts_day = [{} for _ in range(26)]
-
-        with open(str(datfile)) as f:
+        # the split is the byte range [start, end) of datfile, if the number
+        # of data points in it is not known (None) the blocks are accumulated
+        if num_data_in_split is not None:
             y = np.zeros(num_data_in_split, dtype="i4")  # 4 byte int
             X_int = np.zeros((num_data_in_split, 13), dtype="i4")  # 4 byte int
             X_cat = np.zeros((num_data_in_split, 26), dtype="i4")  # 4 byte int
-            if sub_sample_rate == 0.0:
-                rand_u = 1.0
+        else:
+            y = [np.zeros(0, dtype="i4")]
+            X_int = [np.zeros((0, 13), dtype="i4")]
+            X_cat = [np.zeros((0, 26), dtype="i4")]
+        size = (path.getsize(str(datfile)) if end is None else end) - start
+
+        i = 0  # number of stored lines (data points)
+        k = 0  # number of read lines (data points)
+        b = 0  # number of read bytes
+        t_start = time.time()
+        for block in readCriteoBlocks(datfile, start=start, end=end):
+            # process a block of lines (data points)
+            y_b, X_int_b, X_cat_b = parseCriteoBlock(block, max_ind_range)
+            n = y_b.shape[0]
+            # sub-sample data by dropping zero targets, if needed
+            if sub_sample_rate != 0.0:
+                rand_u = np.random.uniform(low=0.0, high=1.0, size=n)
+                keep = (y_b != 0) | (rand_u >= sub_sample_rate)
+                y_b, X_int_b, X_cat_b = y_b[keep], X_int_b[keep], X_cat_b[keep]
+            m = y_b.shape[0]
+
+            if num_data_in_split is not None:
+                y[i:i + m] = y_b
+                X_int[i:i + m] = X_int_b
+                X_cat[i:i + m] = X_cat_b
             else:
-                rand_u = np.random.uniform(low=0.0, high=1.0, size=num_data_in_split)
-
-            i = 0
-            percent = 0
-            for k, line in enumerate(f):
-                # process a line (data point)
-                line = line.split('\t')
-                # set missing values to zero
-                for j in range(len(line)):
-                    if (line[j] == '') or (line[j] == '\n'):
-                        line[j] = '0'
-                # sub-sample data by dropping zero targets, if needed
-                target = np.int32(line[0])
-                if target == 0 and \
-                   (rand_u if sub_sample_rate == 0.0 else rand_u[k]) < sub_sample_rate:
-                    continue
-
-                y[i] = target
-                X_int[i] = np.array(line[1:14], dtype=np.int32)
-                if max_ind_range > 0:
-                    X_cat[i] = np.array(
-                        list(map(lambda x: int(x, 16) % max_ind_range, line[14:])),
-                        dtype=np.int32
-                    )
-                else:
-                    X_cat[i] = np.array(
-                        list(map(lambda x: int(x, 16), line[14:])),
-                        dtype=np.int32
-                    )
+                y.append(y_b)
+                X_int.append(X_int_b)
+                X_cat.append(X_cat_b)
+            k += n
+            i += m
+            b += len(block)
+
+            # debug prints
+            percent = b * 100 // max(size, 1)
+            print(
+                "Load %d (%d%%) Split: %d  Stored: %d" % (k, percent, split, i),
+                end="\n" if dataset_multiprocessing else "\r",
+            )
+        if num_data_in_split is None:
+            y = np.concatenate(y)
+            X_int = np.concatenate(X_int)
+            X_cat = np.concatenate(X_cat)
+        t_parse = time.time() - t_start
+        print(
+            "\nParsed split %d: %d rows in %.2f s (%.0f rows/s)"
+            % (split, k, t_parse, k / max(t_parse, 1e-9))
+        )
 
-                # count uniques
-                if dataset_multiprocessing:
-                    for j in range(26):
-                        convertDicts_day[j][X_cat[i][j]] = 1
-                    # debug prints
-                    if float(i)/num_data_in_split*100 > percent+1:
-                        percent = int(float(i)/num_data_in_split*100)
-                        print(
-                            "Load %d/%d (%d%%) Split: %d  Label True: %d  Stored: %d"
-                            % (
-                                i,
-                                num_data_in_split,
-                                percent,
-                                split,
-                                target,
-                                y[i],
-                            ),
-                            end="\n",
-                        )
-                else:
-                    for j in range(26):
-                        convertDicts[j][X_cat[i][j]] = 1
-                    # debug prints
-                    print(
-                        "Load %d/%d  Split: %d  Label True: %d  Stored: %d"
-                        % (
-                            i,
-                            num_data_in_split,
-                            split,
-                            target,
-                            y[i],
-                        ),
-                        end="\r",
-                    )
-                i += 1
-
-            # store num_data_in_split samples or extras at the end of file
-            # count uniques
-            # X_cat_t  = np.transpose(X_cat)
-            # for j in range(26):
-            #     for x in X_cat_t[j,:]:
-            #         convertDicts[j][x] = 1
-            # store parsed
+        # store num_data_in_split samples or extras at the end of file
+        if dataset_hashing:
+            # categorical features are already hashed by the parser, therefore
+            # the split is stored in its final (processed) form right away
+            filename_s = npzfile + "_{0}_processed.npz".format(split)
+        else:
             filename_s = npzfile + "_{0}.npz".format(split)
-            if path.exists(filename_s):
-                print("\nSkip existing " + filename_s)
-            else:
-                np.savez_compressed(
-                    filename_s,
-                    X_int=X_int[0:i, :],
-                    # X_cat=X_cat[0:i, :],
-                    X_cat_t=np.transpose(X_cat[0:i, :]),  # transpose of the data
-                    y=y[0:i],
-                )
-                print("\nSaved " + npzfile + "_{0}.npz!".format(split))
+        if existsCriteoArrays(filename_s):
+            print("Skip existing " + filename_s)
+        elif dataset_hashing:
+            t_start = time.time()
+            X_int[X_int < 0] = 0
+            saveCriteoArrays(
+                filename_s,
+                data_format,
+                X_cat=X_cat[0:i, :],
+                X_int=X_int[0:i, :],
+                y=y[0:i],
+            )
+            t_save = time.time() - t_start
+            print(
+                "Saved %s in %.2f s (%.0f rows/s)"
+                % (filename_s, t_save, i / max(t_save, 1e-9))
+            )
+        else:
+            t_start = time.time()
+            saveCriteoArrays(
+                filename_s,
+                data_format,
+                X_int=X_int[0:i, :],
+                # X_cat=X_cat[0:i, :],
+                X_cat_t=np.transpose(X_cat[0:i, :]),  # transpose of the data
+                y=y[0:i],
+            )
+            t_save = time.time() - t_start
+            print(
+                "Saved %s in %.2f s (%.0f rows/s)"
+                % (filename_s, t_save, i / max(t_save, 1e-9))
+            )
+
+        if dataset_hashing:
+            # keep track of the largest hashed value of each feature
+            maxDay[split] = X_cat[0:i, :].max(axis=0, initial=0)
+        elif sketch_size > 0:
+            # spill count-min sketches of this split to disk, they are merged
+            # (added up) once all splits are done
+            np.save(
+                npzfile + "_{0}_sketch.npy".format(split),
+                sketchCriteoCategories(X_cat[0:i, :], sketch_hashes, sketch_bits)
+            )
+        else:
+            # spill unique values (and their first appearance) of this split to
+            # disk, they are merged into the dictionaries once all splits are done
+            np.savez(
+                npzfile + "_{0}_unique.npz".format(split),
+                **uniqueCriteoCategories(X_cat[0:i, :])
+            )
 
         if dataset_multiprocessing:
             resultDay[split] = i
-            convertDictsDay[split] = convertDicts_day
             return
         else:
             return i
 
     # create all splits (reuse existing files if possible)
     recreate_flag = False
-    convertDicts = [{} for _ in range(26)]
+    convertDicts = [None for _ in range(26)]
     # WARNING: to get reproducable sub-sampling results you must reset the seed below
     # np.random.seed(123)
     # in this case there is a single split in each day
     for i in range(days):
         npzfile_i = npzfile + "_{0}.npz".format(i)
         npzfile_p = npzfile + "_{0}_processed.npz".format(i)
-        if path.exists(npzfile_i):
+        if existsCriteoArrays(npzfile_i):
             print("Skip existing " + npzfile_i)
-        elif path.exists(npzfile_p):
+        elif existsCriteoArrays(npzfile_p):
             print("Skip existing " + npzfile_p)
         else:
             recreate_flag = True
+    # the number of samples per split is only known after parsing
+    if None in total_per_file:
+        recreate_flag = True
 
+    maxDay = {}
     if recreate_flag:
+        # raw data of each split, the Kaggle train.txt is split into days
+        # at line boundaries (simplifies code later on)
+        if criteo_kaggle:
+            offsets = getCriteoOffsets(datafile, days)
+            split_ranges = [(datafile, offsets[i], offsets[i + 1]) for i in range(days)]
+        else:
+            split_ranges = [(datafile + "_" + str(i), 0, None) for i in range(days)]
         if dataset_multiprocessing:
             resultDay = Manager().dict()
-            convertDictsDay = Manager().dict()
+            maxDay = Manager().dict()
             processes = [Process(target=process_one_file,
                                  name="process_one_file:%i" % i,
-                                 args=(npzfile + "_{0}".format(i),
+                                 args=(split_ranges[i][0],
                                        npzfile,
                                        i,
                                        total_per_file[i],
                                        dataset_multiprocessing,
-                                       convertDictsDay,
                                        resultDay,
+                                       maxDay,
+                                       split_ranges[i][1],
+                                       split_ranges[i][2],
                                        )
                                  ) for i in range(0, days)]
             for process in processes:
@@ -1081,19 +1674,17 @@ def getCriteoAdData(
                 process.join()
             for day in range(days):
                 total_per_file[day] = resultDay[day]
-                print("Constructing convertDicts Split: {}".format(day))
-                convertDicts_tmp = convertDictsDay[day]
-                for i in range(26):
-                    for j in convertDicts_tmp[i]:
-                        convertDicts[i][j] = 1
         else:
             for i in range(days):
                 total_per_file[i] = process_one_file(
-                    npzfile + "_{0}".format(i),
+                    split_ranges[i][0],
                     npzfile,
                     i,
                     total_per_file[i],
                     dataset_multiprocessing,
+                    maxDay=maxDay,
+                    start=split_ranges[i][1],
+                    end=split_ranges[i][2],
                 )
 
     # report and save total into a file
@@ -1105,35 +1696,102 @@ def getCriteoAdData(
 
     # dictionary files
     counts = np.zeros(26, dtype=np.int32)
-    if recreate_flag:
-        # create dictionaries
+    if recreate_flag and dataset_hashing:
+        # no dictionaries, the number of categories is bounded by max_ind_range
+        for i in range(days):
+            counts = np.maximum(counts, maxDay[i] + 1)
+        counts = np.minimum(counts, max_ind_range).astype(np.int32)
+        count_file = d_path + d_file + "_fea_count.npz"
+        if not path.exists(count_file):
+            np.savez_compressed(count_file, counts=counts)
+    elif recreate_flag:
+        offsets = np.cumsum([0] + list(total_per_file))
+        uniques = [None for _ in range(26)]
+        t_start = time.time()
+        if sketch_size > 0:
+            # create dictionaries of frequent values (merge the sketches spilled
+            # by all splits, then collect the values with large enough estimated
+            # counts from the splits, in the order of the splits)
+            sketch = np.load(npzfile + "_0_sketch.npy")
+            for i in range(1, days):
+                sketch = mergeCriteoSketches(
+                    sketch, np.load(npzfile + "_{0}_sketch.npy".format(i))
+                )
+            for j in range(26):
+                uniques[j] = ([], [], [])
+            for i in range(days):
+                filename_i = npzfile + "_{0}.npz".format(i)
+                with loadCriteoArrays(filename_i, mmap_mode="r") as data:
+                    X_cat_t = data["X_cat_t"]
+                    for j in range(26):
+                        x = X_cat_t[j, :]
+                        est = queryCriteoSketch(sketch[j], x, sketch_hashes, sketch_bits)
+                        idx = np.flatnonzero(est >= min_count)
+                        unique, first = np.unique(x[idx], return_index=True)
+                        uniques[j][0].append(unique)
+                        uniques[j][1].append(idx[first] + offsets[i])
+                        uniques[j][2].append(np.zeros(unique.size, dtype=np.int64))
+            for j in range(26):
+                unique, first, _ = mergeCriteoUniques(*uniques[j])
+                count = queryCriteoSketch(
+                    sketch[j], unique, sketch_hashes, sketch_bits
+                ).astype(np.int64)
+                uniques[j] = (unique, first, count)
+            for i in range(days):
+                os.remove(npzfile + "_{0}_sketch.npy".format(i))
+        else:
+            # create dictionaries (merge unique values spilled by all splits,
+            # one feature at a time, all splits at once)
+            for j in range(26):
+                unique, first, count = [], [], []
+                for i in range(days):
+                    with np.load(npzfile + "_{0}_unique.npz".format(i)) as data:
+                        unique.append(data["unique_{0}".format(j)])
+                        first.append(data["first_{0}".format(j)] + offsets[i])
+                        count.append(data["count_{0}".format(j)])
+                uniques[j] = mergeCriteoUniques(unique, first, count)
+            for i in range(days):
+                os.remove(npzfile + "_{0}_unique.npz".format(i))
+        print("Merged dictionaries in %.2f s" % (time.time() - t_start))
+        # assign ids (and store dictionaries)
         for j in range(26):
-            for i, x in enumerate(convertDicts[j]):
-                convertDicts[j][x] = i
+            unique, first, count = uniques[j]
+            uniques[j] = None
+            unique_ordered, ids, oov = orderCriteoUniques(
+                unique, first, count, frequency_ids, min_count
+            )
             dict_file_j = d_path + d_file + "_fea_dict_{0}.npz".format(j)
             if not path.exists(dict_file_j):
-                np.savez_compressed(
-                    dict_file_j,
-                    unique=np.array(list(convertDicts[j]), dtype=np.int32)
-                )
-            counts[j] = len(convertDicts[j])
+                if oov is None:
+                    np.savez_compressed(dict_file_j, unique=unique_ordered)
+                else:
+                    np.savez_compressed(dict_file_j, unique=unique_ordered, oov=oov)
+            counts[j] = len(unique_ordered) + (0 if oov is None else 1)
+            convertDicts[j] = (unique, ids, oov)
+            print("Dictionary of feature %d: %d ids" % (j, counts[j]))
         # store (uniques and) counts
         count_file = d_path + d_file + "_fea_count.npz"
         if not path.exists(count_file):
             np.savez_compressed(count_file, counts=counts)
+    elif dataset_hashing:
+        # load counts
+        with np.load(d_path + d_file + "_fea_count.npz") as data:
+            counts = data["counts"]
     else:
         # create dictionaries (from existing files)
         for j in range(26):
             with np.load(d_path + d_file + "_fea_dict_{0}.npz".format(j)) as data:
-                unique = data["unique"]
-            for i, x in enumerate(unique):
-                convertDicts[j][x] = i
+                oov = int(data["oov"]) if "oov" in data.files else None
+                convertDicts[j] = sortCriteoDict(data["unique"]) + (oov,)
         # load (uniques and) counts
         with np.load(d_path + d_file + "_fea_count.npz") as data:
             counts = data["counts"]
 
     # process all splits
-    if dataset_multiprocessing:
+    if dataset_hashing:
+        # splits have been stored in their processed form while parsing
+        pass
+    elif dataset_multiprocessing:
         processes = [Process(target=processCriteoAdData,
                            name="processCriteoAdData:%i" % i,
                            args=(d_path,
@@ -1142,6 +1800,7 @@ def getCriteoAdData(
                                  i,
                                  convertDicts,
                                  counts,
+                                 data_format,
                                  )
                            ) for i in range(0, days)]
         for process in processes:
@@ -1151,7 +1810,9 @@ def getCriteoAdData(
 
     else:
         for i in range(days):
-            processCriteoAdData(d_path, d_file, npzfile, i, convertDicts, counts)
+            processCriteoAdData(
+                d_path, d_file, npzfile, i, convertDicts, counts, data_format
+            )
 
     o_file = concatCriteoAdData(
         d_path,
@@ -1164,12 +1825,135 @@ def getCriteoAdData(
         total_per_file,
         total_count,
         memory_map,
-        o_filename
+        o_filename,
+        data_format
     )
 
     return o_file
 
 
+def appendCriteoAdDay(
+        datafile,
+        day_file,
+        max_ind_range=-1,
+        sub_sample_rate=0.0,
+        criteo_kaggle=True,
+        memory_map=False,
+        randomize="total",
+        data_format="npz",
+):
+    # Appends a new day to a dataset pre-processed by getCriteoAdData, without
+    # reading any of the existing days. The dictionaries are extended with the
+    # new values of the day (or, if they have an OOV id, new values are mapped
+    # to it), so that the ids of existing values do not change.
+    #
+    # Inputs:
+    #    datafile (str): path to the raw data file the dataset was created from
+    #    day_file (str): path to the raw data (text) file of the new day
+    #    memory_map (bool): also create the reordered file of the new day
+    #                       (required by datasets loaded with memory mapping)
+    #    randomize (str): with memory_map, "day" or "total" shuffle the
+    #                     reordered file of the previous day within the day
+    #
+    # Output:
+    #   day (int): index of the new day
+
+    # split the datafile into path and filename
+    lstr = datafile.split("/")
+    d_path = "/".join(lstr[0:-1]) + "/"
+    d_file = lstr[-1].split(".")[0] if criteo_kaggle else lstr[-1]
+    npzfile = d_path + ((d_file + "_day") if criteo_kaggle else d_file)
+    total_file = d_path + d_file + "_day_count.npz"
+    count_file = d_path + d_file + "_fea_count.npz"
+
+    with np.load(total_file) as data:
+        total_per_file = list(data["total_per_file"])
+    with np.load(count_file) as data:
+        counts = data["counts"].astype(np.int32)
+    day = len(total_per_file)
+    filename_p = npzfile + "_{0}_processed.npz".format(day)
+    if existsCriteoArrays(filename_p):
+        sys.exit("ERROR: " + filename_p + " already exists")
+
+    # parse the new day
+    y, X_int, X_cat = [], [], []
+    t_start = time.time()
+    for block in readCriteoBlocks(day_file):
+        y_b, X_int_b, X_cat_b = parseCriteoBlock(block, max_ind_range)
+        # sub-sample data by dropping zero targets, if needed
+        if sub_sample_rate != 0.0:
+            rand_u = np.random.uniform(low=0.0, high=1.0, size=y_b.shape[0])
+            keep = (y_b != 0) | (rand_u >= sub_sample_rate)
+            y_b, X_int_b, X_cat_b = y_b[keep], X_int_b[keep], X_cat_b[keep]
+        y.append(y_b)
+        X_int.append(X_int_b)
+        X_cat.append(X_cat_b)
+    y = np.concatenate([np.zeros(0, dtype="i4")] + y)
+    X_int = np.concatenate([np.zeros((0, 13), dtype="i4")] + X_int)
+    X_cat = np.concatenate([np.zeros((0, 26), dtype="i4")] + X_cat)
+    print(
+        "Parsed day %d: %d rows in %.2f s" % (day, len(y), time.time() - t_start)
+    )
+
+    # extend the dictionaries (or counts of hashed values) by the new day
+    hashed = not path.exists(d_path + d_file + "_fea_dict_0.npz")
+    if hashed and max_ind_range <= 0:
+        sys.exit("ERROR: dictionaries of the dataset are missing")
+    for j in range(26):
+        if hashed:
+            largest = X_cat[:, j].max(initial=0) + 1
+            counts[j] = max(counts[j], min(largest, max_ind_range))
+            continue
+        dict_file_j = d_path + d_file + "_fea_dict_{0}.npz".format(j)
+        with np.load(dict_file_j) as data:
+            unique = data["unique"]
+            oov = int(data["oov"]) if "oov" in data.files else None
+        keys, ids = sortCriteoDict(unique)
+        if oov is None:
+            # append new values in the order of their first appearance
+            pos = np.minimum(np.searchsorted(keys, X_cat[:, j]), max(keys.size - 1, 0))
+            if keys.size == 0:
+                missing = np.ones(X_cat.shape[0], dtype=bool)
+            else:
+                missing = keys[pos] != X_cat[:, j]
+            if np.any(missing):
+                new, first = np.unique(X_cat[missing, j], return_index=True)
+                unique = np.concatenate((unique, new[np.argsort(first)]))
+                np.savez_compressed(dict_file_j, unique=unique)
+                keys, ids = sortCriteoDict(unique)
+            counts[j] = len(unique)
+        X_cat[:, j] = convertCriteoCategories(X_cat[:, j], keys, ids, oov)
+
+    # store the new day and update the counts
+    X_int[X_int < 0] = 0
+    saveCriteoArrays(filename_p, data_format, X_cat=X_cat, X_int=X_int, y=y)
+    if memory_map:
+        # the previous (test) day is used for training from now on, it is
+        # shuffled within the day (it is not mixed with the other training days)
+        if randomize == "day" or randomize == "total":
+            filename_r = npzfile + "_{0}_reordered.npz".format(day - 1)
+            filename_t = npzfile + "_{0}_reordered_tmp.npz".format(day - 1)
+            with loadCriteoArrays(filename_r, mmap_mode="r") as data:
+                arrays = {key: data[key] for key in ["X_cat", "X_int", "y"]}
+            saveCriteoArraysPermuted(
+                filename_t,
+                np.random.permutation(len(arrays["y"])),
+                data_format,
+                **arrays
+            )
+            del arrays
+            replaceCriteoArrays(filename_r, filename_t)
+        # the new day is used for testing, and is not shuffled
+        filename_r = npzfile + "_{0}_reordered.npz".format(day)
+        saveCriteoArrays(filename_r, data_format, X_cat=X_cat, X_int=X_int, y=y)
+    total_per_file.append(len(y))
+    np.savez_compressed(total_file, total_per_file=total_per_file)
+    np.savez_compressed(count_file, counts=counts)
+    print("Appended day %d with %d samples, counts:\n" % (day, len(y)), counts)
+
+    return day
+
+
 def loadDataset(
         dataset,
         max_ind_range,
@@ -1178,7 +1962,12 @@ def loadDataset(
         data_split,
         raw_path="",
         pro_data="",
-        memory_map=False
+        memory_map=False,
+        dataset_hashing=False,
+        data_format="npz",
+        frequency_ids=False,
+        min_count=0,
+        sketch_size=0
 ):
     # dataset
     if dataset == "kaggle":
@@ -1202,10 +1991,10 @@ def loadDataset(
     if memory_map:
         for i in range(days):
             reo_data = d_path + npzfile + "_{0}_reordered.npz".format(i)
-            if not path.exists(str(reo_data)):
+            if not existsCriteoArrays(str(reo_data)):
                 data_ready = False
     else:
-        if not path.exists(str(pro_data)):
+        if not existsCriteoArrays(str(pro_data)):
             data_ready = False
 
     # pre-process data if needed
@@ -1224,9 +2013,18 @@ def loadDataset(
             data_split,
             randomize,
             dataset == "kaggle",
-            memory_map
+            memory_map,
+            dataset_hashing=dataset_hashing,
+            data_format=data_format,
+            frequency_ids=frequency_ids,
+            min_count=min_count,
+            sketch_size=sketch_size,
         )
 
+    # days appended by appendCriteoAdDay follow the pre-processed ones
+    with np.load(d_path + d_file + "_day_count.npz") as data:
+        days = len(data["total_per_file"])
+
     return file, days
 
 
@@ -1243,18 +2041,41 @@ if __name__ == "__main__":
     parser.add_argument("--data-sub-sample-rate", type=float, default=0.0)  # in [0, 1]
     parser.add_argument("--data-randomize", type=str, default="total")  # or day or none
     parser.add_argument("--memory-map", action="store_true", default=False)
+    parser.add_argument("--dataset-hashing", action="store_true", default=False)
+    parser.add_argument("--dataset-format", type=str, default="npz")  # or npy
+    parser.add_argument("--dataset-frequency-ids", action="store_true", default=False)
+    parser.add_argument("--dataset-min-count", type=int, default=0)
+    parser.add_argument("--dataset-sketch-size", type=int, default=0)  # in MB
     parser.add_argument("--data-set", type=str, default="kaggle")  # or terabyte
     parser.add_argument("--raw-data-file", type=str, default="")
     parser.add_argument("--processed-data-file", type=str, default="")
+    parser.add_argument("--append-day-file", type=str, default="")
     args = parser.parse_args()
 
-    loadDataset(
-        args.data_set,
-        args.max_ind_range,
-        args.data_sub_sample_rate,
-        args.data_randomize,
-        "train",
-        args.raw_data_file,
-        args.processed_data_file,
-        args.memory_map
-    )
+    if args.append_day_file != "":
+        appendCriteoAdDay(
+            args.raw_data_file,
+            args.append_day_file,
+            args.max_ind_range,
+            args.data_sub_sample_rate,
+            args.data_set == "kaggle",
+            args.memory_map,
+            args.data_randomize,
+            args.dataset_format
+        )
+    else:
+        loadDataset(
+            args.data_set,
+            args.max_ind_range,
+            args.data_sub_sample_rate,
+            args.data_randomize,
+            "train",
+            args.raw_data_file,
+            args.processed_data_file,
+            args.memory_map,
+            args.dataset_hashing,
+            args.dataset_format,
+            args.dataset_frequency_ids,
+            args.dataset_min_count,
+            args.dataset_sketch_size
+        )
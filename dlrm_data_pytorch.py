@@ -21,20 +21,29 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 # others
 from os import path
 import sys
+import json
 import bisect
 import collections
+import functools
+import multiprocessing
 
 import data_utils
 
 # numpy
 import numpy as np
 from numpy import random as ra
-from collections import deque
 
 
 # pytorch
 import torch
-from torch.utils.data import Dataset, RandomSampler
+from torch.utils.data import (
+    Dataset,
+    IterableDataset,
+    Sampler,
+    RandomSampler,
+    BatchSampler,
+    SequentialSampler,
+)
 
 import data_loader_terabyte
 import mlperf_logger
@@ -47,6 +56,10 @@ import mlperf_logger
 #            "day": randomizes each day"s data (only works if split = True)
 #            "total": randomizes total dataset
 # split (bool) : to split into train, test, validation data-sets
+# memory_map (bool): reads the days lazily instead of loading the whole data,
+#            which supports random access (e.g. RandomSampler) cheaply only in
+#            the npy format (days in the npz format are decompressed as a
+#            whole, and only one is kept)
 class CriteoDataset(Dataset):
 
     def __init__(
@@ -60,6 +73,11 @@ class CriteoDataset(Dataset):
             pro_data="",
             memory_map=False,
             dataset_multiprocessing=False,
+            dataset_hashing=False,
+            data_format="npz",
+            frequency_ids=False,
+            min_count=0,
+            sketch_size=0,
     ):
         # dataset
         # tar_fea = 1   # single target
@@ -94,10 +112,10 @@ class CriteoDataset(Dataset):
         if memory_map:
             for i in range(days):
                 reo_data = self.npzfile + "_{0}_reordered.npz".format(i)
-                if not path.exists(str(reo_data)):
+                if not data_utils.existsCriteoArrays(str(reo_data)):
                     data_ready = False
         else:
-            if not path.exists(str(pro_data)):
+            if not data_utils.existsCriteoArrays(str(pro_data)):
                 data_ready = False
 
         # pre-process data if needed
@@ -118,12 +136,20 @@ class CriteoDataset(Dataset):
                 dataset == "kaggle",
                 memory_map,
                 dataset_multiprocessing,
+                dataset_hashing,
+                data_format,
+                frequency_ids,
+                min_count,
+                sketch_size,
             )
 
-        # get a number of samples per day
+        # get a number of samples per day, the days appended by
+        # data_utils.appendCriteoAdDay follow the pre-processed ones
+        # (the last day is always used for testing)
         total_file = self.d_path + self.d_file + "_day_count.npz"
         with np.load(total_file) as data:
             total_per_file = data["total_per_file"]
+        days = len(total_per_file)
         # compute offsets per file
         self.offset_per_file = np.array([0] + [x for x in total_per_file])
         for i in range(days):
@@ -132,18 +158,24 @@ class CriteoDataset(Dataset):
 
         # setup data
         if memory_map:
+            for i in range(days):
+                reo_data = self.npzfile + "_{0}_reordered.npz".format(i)
+                if not data_utils.existsCriteoArrays(reo_data):
+                    sys.exit("ERROR: " + reo_data + " is missing (a day appended "
+                             + "without memory_map?)")
             # setup the training/testing split
             self.split = split
-            if split == 'none' or split == 'train':
-                self.day = 0
-                self.max_day_range = days if split == 'none' else days - 1
-            elif split == 'test' or split == 'val':
-                self.day = days - 1
+            self.days = days
+            # arrays of days opened (lazily) by this process, see _get_day
+            self.day_cache = {}
+            self.first_day = None
+            self.last_day = None
+            if split == 'test' or split == 'val':
                 num_samples = self.offset_per_file[days] - \
                               self.offset_per_file[days - 1]
                 self.test_size = int(np.ceil(num_samples / 2.))
                 self.val_size = num_samples - self.test_size
-            else:
+            elif split != 'none' and split != 'train':
                 sys.exit("ERROR: dataset split is neither none, nor train or test.")
 
             '''
@@ -188,25 +220,33 @@ class CriteoDataset(Dataset):
             self.n_emb = len(self.counts)
             print("Sparse features= %d, Dense features= %d" % (self.n_emb, self.m_den))
 
-            # Load the test data
-            # Only a single day is used for testing
-            if self.split == 'test' or self.split == 'val':
-                # only a single day is used for testing
-                fi = self.npzfile + "_{0}_reordered.npz".format(
-                    self.day
-                )
-                with np.load(fi) as data:
-                    self.X_int = data["X_int"]  # continuous  feature
-                    self.X_cat = data["X_cat"]  # categorical feature
-                    self.y = data["y"]          # target
 
         else:
             # load and preprocess data
-            with np.load(file) as data:
+            with data_utils.loadCriteoArrays(file, mmap_mode="c") as data:
                 X_int = data["X_int"]  # continuous  feature
                 X_cat = data["X_cat"]  # categorical feature
                 y = data["y"]          # target
                 self.counts = data["counts"]
+            # the data file holds only the days pre-processed together with it,
+            # the days appended later are read from their own files
+            file_days = np.searchsorted(self.offset_per_file, len(y))
+            if self.offset_per_file[file_days] != len(y):
+                sys.exit("ERROR: " + file + " does not match the days in " + total_file)
+            if file_days < days:
+                X_int, X_cat, y = [X_int], [X_cat], [y]
+                for i in range(file_days, days):
+                    fi = self.npzfile + "_{0}_processed.npz".format(i)
+                    with data_utils.loadCriteoArrays(fi) as data:
+                        X_int.append(data["X_int"])
+                        X_cat.append(data["X_cat"])
+                        y.append(data["y"])
+                    print("Loaded appended day %d" % i)
+                X_int = np.concatenate(X_int)
+                X_cat = np.concatenate(X_cat)
+                y = np.concatenate(y)
+                with np.load(self.d_path + self.d_file + "_fea_count.npz") as data:
+                    self.counts = data["counts"]
             self.m_den = X_int.shape[1]  # den_fea
             self.n_emb = len(self.counts)
             print("Sparse fea = %d, Dense fea = %d" % (self.n_emb, self.m_den))
@@ -220,9 +260,16 @@ class CriteoDataset(Dataset):
                     indices = np.random.permutation(indices)
                     print("Randomized indices...")
 
-                X_int[indices] = X_int
-                X_cat[indices] = X_cat
-                y[indices] = y
+                    # equivalent to X[indices] = X, but without the copy of
+                    # the right hand side (gather with the inverse permutation)
+                    inverse = np.argsort(indices)
+                    X_int = X_int[inverse]
+                    X_cat = X_cat[inverse]
+                    y = y[inverse]
+
+                self.X_int = X_int
+                self.X_cat = X_cat
+                self.y = y
 
             else:
                 indices = np.array_split(indices, self.offset_per_file[1:-1])
@@ -245,18 +292,18 @@ class CriteoDataset(Dataset):
                     print("Randomized indices across days ...")
 
                 # create training, validation, and test sets
+                # (contiguous arrays, or views when the indices are a range)
                 if split == 'train':
-                    self.X_int = [X_int[i] for i in train_indices]
-                    self.X_cat = [X_cat[i] for i in train_indices]
-                    self.y = [y[i] for i in train_indices]
+                    indices = train_indices
                 elif split == 'val':
-                    self.X_int = [X_int[i] for i in val_indices]
-                    self.X_cat = [X_cat[i] for i in val_indices]
-                    self.y = [y[i] for i in val_indices]
+                    indices = val_indices
                 elif split == 'test':
-                    self.X_int = [X_int[i] for i in test_indices]
-                    self.X_cat = [X_cat[i] for i in test_indices]
-                    self.y = [y[i] for i in test_indices]
+                    indices = test_indices
+                if len(indices) > 0 and np.all(np.diff(indices) == 1):
+                    indices = slice(indices[0], indices[-1] + 1)
+                self.X_int = X_int[indices]
+                self.X_cat = X_cat[indices]
+                self.y = y[indices]
 
             print("Split data according to indices...")
 
@@ -269,35 +316,96 @@ class CriteoDataset(Dataset):
                 )
             ]
 
+        if isinstance(index, (list, np.ndarray, torch.Tensor)):
+            return self._get_batch(np.asarray(index, dtype=np.int64))
+
         if self.memory_map:
-            if self.split == 'none' or self.split == 'train':
-                # check if need to swicth to next day and load data
-                if index == self.offset_per_file[self.day]:
-                    # print("day_boundary switch", index)
-                    self.day_boundary = self.offset_per_file[self.day]
-                    fi = self.npzfile + "_{0}_reordered.npz".format(
-                        self.day
-                    )
-                    # print('Loading file: ', fi)
-                    with np.load(fi) as data:
-                        self.X_int = data["X_int"]  # continuous  feature
-                        self.X_cat = data["X_cat"]  # categorical feature
-                        self.y = data["y"]          # target
-                    self.day = (self.day + 1) % self.max_day_range
-
-                i = index - self.day_boundary
-            elif self.split == 'test' or self.split == 'val':
-                # only a single day is used for testing
-                i = index + (0 if self.split == 'test' else self.test_size)
-            else:
-                sys.exit("ERROR: dataset split is neither none, nor train or test.")
+            day, i = self._locate(index)
+            X_int, X_cat, y = self._get_day(int(day))
         else:
             i = index
+            X_int, X_cat, y = self.X_int, self.X_cat, self.y
 
         if self.max_ind_range > 0:
-            return self.X_int[i], self.X_cat[i] % self.max_ind_range, self.y[i]
+            return X_int[i], X_cat[i] % self.max_ind_range, y[i]
+        else:
+            return X_int[i], X_cat[i], y[i]
+
+    def _locate(self, index):
+        # resolves (an array of) indices into days and rows within the days
+        if self.split == 'none' or self.split == 'train':
+            day = np.searchsorted(self.offset_per_file, index, side="right") - 1
+            return day, index - self.offset_per_file[day]
+        elif self.split == 'test' or self.split == 'val':
+            # only a single day is used for testing
+            day = np.full(np.shape(index), self.days - 1)[()]
+            return day, index + (0 if self.split == 'test' else self.test_size)
         else:
-            return self.X_int[i], self.X_cat[i], self.y[i]
+            sys.exit("ERROR: dataset split is neither none, nor train or test.")
+
+    def _get_day(self, day):
+        # returns the arrays of a day, which are memory mapped (npy format) or
+        # decompressed as a whole (npz format, in which case a single day is kept,
+        # so that only sequential access is supported: the days are read in
+        # increasing order, starting over from the first day read)
+        if day not in self.day_cache:
+            fi = self.npzfile + "_{0}_reordered.npz".format(day)
+            with data_utils.loadCriteoArrays(fi, mmap_mode="r") as data:
+                arrays = (
+                    data["X_int"],  # continuous  feature
+                    data["X_cat"],  # categorical feature
+                    data["y"],      # target
+                )
+            if not isinstance(arrays[2], np.memmap):
+                if self.first_day is None:
+                    self.first_day = day
+                if self.last_day is not None and day < self.last_day and (
+                    day != self.first_day
+                ):
+                    sys.exit(
+                        "ERROR: non-sequential access to days in the npz format "
+                        + "decompresses a whole day on (almost) every access, "
+                        + "use --dataset-format=npy for random access"
+                    )
+                self.last_day = day
+                self.day_cache.clear()
+            self.day_cache[day] = arrays
+        return self.day_cache[day]
+
+    def __getstate__(self):
+        # do not send opened days to DataLoader workers (they open their own)
+        state = self.__dict__.copy()
+        if self.memory_map:
+            state["day_cache"] = {}
+        return state
+
+    def _get_batch(self, indices):
+        # returns a whole batch (X_int, X_cat, y) of arrays at once,
+        # which is a slice of the data if the indices are contiguous
+        if self.memory_map:
+            # gather the rows of each day the batch falls into
+            days, rows = self._locate(indices)
+            batch = []
+            for day in np.unique(days):
+                day_rows = rows[days == day]
+                if np.all(np.diff(day_rows) == 1):
+                    day_rows = slice(day_rows[0], day_rows[-1] + 1)
+                batch.append([x[day_rows] for x in self._get_day(int(day))])
+            if len(batch) == 1:
+                X_int, X_cat, y = batch[0]
+            else:
+                # restore the order of indices across days
+                order = np.argsort(np.argsort(days, kind="stable"), kind="stable")
+                X_int, X_cat, y = [np.concatenate(x)[order] for x in zip(*batch)]
+        else:
+            if len(indices) > 0 and np.all(np.diff(indices) == 1):
+                indices = slice(indices[0], indices[-1] + 1)
+            X_int = self.X_int[indices]
+            X_cat = self.X_cat[indices]
+            y = self.y[indices]
+        if self.max_ind_range > 0:
+            X_cat = X_cat % self.max_ind_range
+        return X_int, X_cat, y
 
     def _default_preprocess(self, X_int, X_cat, y):
         X_int = torch.log(torch.tensor(X_int, dtype=torch.float) + 1)
@@ -341,6 +449,323 @@ def collate_wrapper_criteo_offset(list_of_tuples):
     return X_int, torch.stack(lS_o), torch.stack(lS_i), T
 
 
+@functools.lru_cache(maxsize=None)
+def _criteo_batch_offsets(batch_size, feature_cnt):
+    # offsets of a batch with a single index per sample (cached per batch size)
+    return torch.arange(batch_size).repeat(feature_cnt, 1)
+
+
+@functools.lru_cache(maxsize=None)
+def _criteo_batch_lengths(batch_size, feature_cnt):
+    # lengths of a batch with a single index per sample (cached per batch size)
+    return torch.ones((feature_cnt, batch_size), dtype=torch.int32)
+
+
+def collate_wrapper_criteo_batch_offset(batch):
+    # where batch is (X_int, X_cat, y) of a whole batch, see CriteoDataset
+    X_int, X_cat, y = batch
+    X_int = torch.log(torch.as_tensor(X_int, dtype=torch.float) + 1)
+    X_cat = torch.as_tensor(X_cat, dtype=torch.long)
+    T = torch.as_tensor(y, dtype=torch.float32).view(-1, 1)
+
+    batchSize = X_cat.shape[0]
+    featureCnt = X_cat.shape[1]
+
+    lS_i = X_cat.t().contiguous()
+    # a copy of the cached offsets, batches may be modified in place
+    lS_o = _criteo_batch_offsets(batchSize, featureCnt).clone()
+
+    return X_int, lS_o, lS_i, T
+
+
+def collate_wrapper_criteo_batch_length(batch):
+    # where batch is (X_int, X_cat, y) of a whole batch, see CriteoDataset
+    X_int, lS_o, lS_i, T = collate_wrapper_criteo_batch_offset(batch)
+    lS_l = _criteo_batch_lengths(lS_i.shape[1], lS_i.shape[0]).clone()
+
+    return X_int, lS_l, lS_i, T
+
+
+def _parse_criteo_stream_block(block, max_ind_range):
+    # parses a block of raw text in a worker process of CriteoStreamDataset
+    y, X_int, X_cat = data_utils.parseCriteoBlock(block, max_ind_range)
+    X_int[X_int < 0] = 0
+    return X_int, X_cat, y
+
+
+def _count_criteo_stream_lines(datfile, start, end):
+    # counts the lines, and the lines with a positive label, of a byte range
+    # of a raw text file in a worker process of CriteoStreamDataset
+    lines = 0
+    positives = 0
+    for block in data_utils.readCriteoBlocks(datfile, start=start, end=end):
+        lines += block.count(b"\n") + (not block.endswith(b"\n"))
+        positives += block.count(b"\n1\t") + block.startswith(b"1\t")
+    return lines, positives
+
+
+class CriteoStreamDataset(IterableDataset):
+    """Criteo dataset streamed from the raw (optionally gzip) text files.
+
+    The text is read in blocks, parsed in a pool of worker processes and the
+    categorical features are hashed with max_ind_range, so that no files are
+    written. Batches are (X_int, X_cat, y) arrays, see CriteoDataset.
+
+    As in CriteoDataset, samples with a zero target are dropped with
+    probability sub_sample_rate, and the "test" and "val" splits are the first
+    and second half of the lines. The number of lines is counted (in parallel)
+    on first use and cached in a <file>_line_count.json file next to each text
+    file. With sub-sampling, the length is the expected number of batches: an
+    epoch stops after len() batches, but may also have a few batches less.
+
+    The worker processes are started on first use and reused by all epochs,
+    call close() to stop them.
+    """
+
+    def __init__(
+            self,
+            files,
+            batch_size,
+            max_ind_range,
+            processes=4,
+            block_size=1 << 24,
+            ranges=None,
+            sub_sample_rate=0.0,
+            split="none",
+    ):
+        if max_ind_range <= 0:
+            sys.exit("ERROR: dataset streaming requires a positive max_ind_range")
+        if split not in ["none", "train", "test", "val"]:
+            sys.exit("ERROR: dataset split is neither none, nor train or test.")
+        self.files = files
+        # byte range [start, end) of each file (None reads the whole file)
+        self.ranges = ranges if ranges is not None else [(0, None)] * len(files)
+        self.batch_size = batch_size
+        self.max_ind_range = max_ind_range
+        self.processes = processes
+        self.block_size = block_size
+        self.sub_sample_rate = sub_sample_rate
+        self.split = split
+        self.line_counts = None
+        self.pool = None
+
+        # the categorical features are hashed into max_ind_range ids
+        self.m_den = 13
+        self.n_emb = 26
+        self.counts = np.full(self.n_emb, max_ind_range, dtype=np.int64)
+
+    def _get_pool(self):
+        # the worker processes are started once and reused by every epoch;
+        # they are spawned rather than forked, as forking a process that has
+        # already initialized torch (threads, CUDA) is unsafe
+        if self.pool is None:
+            ctx = multiprocessing.get_context("spawn")
+            self.pool = ctx.Pool(self.processes)
+        return self.pool
+
+    def close(self):
+        # stop the worker processes (they are started again if needed)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __getstate__(self):
+        # the pool can not be pickled (e.g. into DataLoader workers)
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
+
+    def _read_blocks(self):
+        for datfile, (start, end) in zip(self.files, self.ranges):
+            print("Streaming file: ", datfile)
+            yield from data_utils.readCriteoBlocks(
+                datfile, self.block_size, start, end
+            )
+
+    def _count_lines(self):
+        # (lines, positives) of each file, read from the cache files if possible
+        if self.line_counts is not None:
+            return self.line_counts
+        counts = [None] * len(self.files)
+        cache = []
+        tasks = []
+        for i, (datfile, (start, end)) in enumerate(zip(self.files, self.ranges)):
+            cache_file = (
+                datfile[:-len(".gz")] if datfile.endswith(".gz") else datfile
+            ) + "_line_count.json"
+            key = "{}-{}".format(start, end)
+            cached = {}
+            if path.exists(cache_file):
+                with open(cache_file) as f:
+                    cached = json.load(f)
+            if cached.get("size") != path.getsize(datfile):
+                cached = {"size": path.getsize(datfile), "ranges": {}}
+            cache.append((cache_file, key, cached))
+            if key in cached["ranges"]:
+                counts[i] = cached["ranges"][key]
+            elif datfile.endswith(".gz"):
+                # compressed files are counted as a whole
+                tasks.append((i, (datfile, start, end)))
+            else:
+                offsets = data_utils.getCriteoOffsets(
+                    datfile, self.processes, start, end
+                )
+                tasks += [
+                    (i, (datfile, s, e)) for s, e in zip(offsets[:-1], offsets[1:])
+                ]
+        if tasks:
+            print("Counting the lines of the streamed files...")
+            results = self._get_pool().starmap(
+                _count_criteo_stream_lines, [t for _, t in tasks]
+            )
+            for (i, _), (lines, positives) in zip(tasks, results):
+                if counts[i] is None:
+                    counts[i] = [0, 0]
+                counts[i] = [counts[i][0] + lines, counts[i][1] + positives]
+            for i, (cache_file, key, cached) in enumerate(cache):
+                cached["ranges"][key] = counts[i]
+                try:
+                    with open(cache_file, "w") as f:
+                        json.dump(cached, f)
+                except OSError:
+                    print("WARNING: could not write " + cache_file)
+        self.line_counts = counts
+        return counts
+
+    def _split_lines(self):
+        # range [begin, end) of the lines used by the split
+        lines = sum(c[0] for c in self._count_lines())
+        if self.split == "test":
+            return 0, int(np.ceil(lines / 2.))
+        elif self.split == "val":
+            return int(np.ceil(lines / 2.)), lines
+        return 0, lines
+
+    def __iter__(self):
+        pending = collections.deque()
+        rest = None
+        begin, end = 0, None
+        if self.split == "test" or self.split == "val":
+            begin, end = self._split_lines()
+        line = 0  # index of the first line of the next block
+        # with sub-sampling an epoch is cut at len() batches (the expected
+        # number), so that it never has more batches than reported
+        limit = len(self) if self.sub_sample_rate != 0.0 else None
+        batches = 0
+        pool = self._get_pool()
+        blocks = self._read_blocks()
+        while True:
+            # keep a bounded number of blocks in flight
+            for block in blocks:
+                pending.append(pool.apply_async(
+                    _parse_criteo_stream_block, (block, self.max_ind_range)
+                ))
+                if len(pending) >= 2 * self.processes:
+                    break
+            if not pending or (end is not None and line >= end):
+                break
+            arrays = pending.popleft().get()
+            n = arrays[0].shape[0]
+            if begin > line or (end is not None and end < line + n):
+                lo = max(begin - line, 0)
+                hi = n if end is None else min(end - line, n)
+                arrays = [a[lo:hi] for a in arrays]
+            line += n
+            # sub-sample data by dropping zero targets, if needed
+            if self.sub_sample_rate != 0.0:
+                y = arrays[2]
+                rand_u = np.random.uniform(low=0.0, high=1.0, size=y.shape[0])
+                keep = (y != 0) | (rand_u >= self.sub_sample_rate)
+                arrays = [a[keep] for a in arrays]
+            if rest is not None:
+                arrays = [np.concatenate(a) for a in zip(rest, arrays)]
+            n = arrays[0].shape[0]
+            last = n - n % self.batch_size
+            for i in range(0, last, self.batch_size):
+                if limit is not None and batches >= limit:
+                    return
+                batches += 1
+                yield tuple(a[i:i + self.batch_size] for a in arrays)
+            rest = [a[last:] for a in arrays]
+        if rest is not None and rest[0].shape[0] > 0:
+            if limit is None or batches < limit:
+                yield tuple(rest)
+
+    def __len__(self):
+        counts = self._count_lines()
+        lines = sum(c[0] for c in counts)
+        positives = sum(c[1] for c in counts)
+        begin, end = self._split_lines()
+        num_samples = end - begin
+        if self.sub_sample_rate != 0.0 and lines > 0:
+            # the expected number of samples kept (in the same ratio in splits)
+            kept = positives + (1.0 - self.sub_sample_rate) * (lines - positives)
+            num_samples = int(round(num_samples * kept / lines))
+        return int(np.ceil(num_samples / self.batch_size))
+
+
+def make_criteo_stream_data_and_loaders(args, offset_to_length_converter=False):
+    # the last day (Terabyte), or the last of 7 parts of the file (Kaggle), is
+    # used for testing
+    if args.data_set == "kaggle":
+        if args.raw_data_file.endswith(".gz"):
+            sys.exit("ERROR: dataset streaming of Kaggle requires uncompressed text")
+        offsets = data_utils.getCriteoOffsets(args.raw_data_file, 7)
+        train_files, train_ranges = [args.raw_data_file], [(0, offsets[6])]
+        test_files, test_ranges = [args.raw_data_file], [(offsets[6], offsets[7])]
+    else:
+        files = []
+        for i in range(24):
+            datfile = args.raw_data_file + "_{0}".format(i)
+            if not path.exists(datfile):
+                datfile += ".gz"
+            files.append(datfile)
+        train_files, train_ranges = files[:-1], None
+        test_files, test_ranges = files[-1:], None
+
+    train_data = CriteoStreamDataset(
+        train_files,
+        args.mini_batch_size,
+        args.max_ind_range,
+        args.dataset_stream_processes,
+        ranges=train_ranges,
+        sub_sample_rate=args.data_sub_sample_rate,
+        split="train",
+    )
+    test_data = CriteoStreamDataset(
+        test_files,
+        args.test_mini_batch_size,
+        args.max_ind_range,
+        args.dataset_stream_processes,
+        ranges=test_ranges,
+        sub_sample_rate=args.data_sub_sample_rate,
+        split="test",
+    )
+
+    collate_wrapper_criteo = collate_wrapper_criteo_batch_offset
+    if offset_to_length_converter:
+        collate_wrapper_criteo = collate_wrapper_criteo_batch_length
+
+    # the parsing is done by the pool of the dataset, not by loader workers
+    train_loader = torch.utils.data.DataLoader(
+        train_data,
+        batch_size=None,
+        num_workers=0,
+        collate_fn=collate_wrapper_criteo,
+        pin_memory=False,
+    )
+    test_loader = torch.utils.data.DataLoader(
+        test_data,
+        batch_size=None,
+        num_workers=0,
+        collate_fn=collate_wrapper_criteo,
+        pin_memory=False,
+    )
+
+    return train_data, train_loader, test_data, test_loader
+
+
 def ensure_dataset_preprocessed(args, d_path):
     _ = CriteoDataset(
         args.data_set,
@@ -351,10 +776,15 @@ def ensure_dataset_preprocessed(args, d_path):
         args.raw_data_file,
         args.processed_data_file,
         args.memory_map,
-        args.dataset_multiprocessing
+        args.dataset_multiprocessing,
+        args.dataset_hashing,
+        args.dataset_format,
+        args.dataset_frequency_ids,
+        args.dataset_min_count,
+        args.dataset_sketch_size,
     )
 
-    _ = CriteoDataset(
+    dataset = CriteoDataset(
         args.data_set,
         args.max_ind_range,
         args.data_sub_sample_rate,
@@ -363,24 +793,41 @@ def ensure_dataset_preprocessed(args, d_path):
         args.raw_data_file,
         args.processed_data_file,
         args.memory_map,
-        args.dataset_multiprocessing
+        args.dataset_multiprocessing,
+        args.dataset_hashing,
+        args.dataset_format,
+        args.dataset_frequency_ids,
+        args.dataset_min_count,
+        args.dataset_sketch_size,
     )
 
     for split in ['train', 'val', 'test']:
         print('Running preprocessing for split =', split)
 
+        # the last day (including appended days) is used for testing
         train_files = ['{}_{}_reordered.npz'.format(args.raw_data_file, day)
                        for
-                       day in range(0, 23)]
+                       day in range(0, dataset.days - 1)]
 
-        test_valid_file = args.raw_data_file + '_23_reordered.npz'
+        test_valid_file = args.raw_data_file + '_{}_reordered.npz'.format(
+            dataset.days - 1
+        )
 
         output_file = d_path + '_{}.bin'.format(split)
 
         input_files = train_files if split == 'train' else [test_valid_file]
-        data_loader_terabyte.numpy_to_binary(input_files=input_files,
-                                             output_file_path=output_file,
-                                             split=split)
+        if args.mlperf_bin_compact:
+            data_loader_terabyte.numpy_to_binary(
+                input_files=input_files,
+                output_file_path=output_file,
+                split=split,
+                counts_file=args.raw_data_file + '_fea_count.npz',
+                max_ind_range=args.max_ind_range,
+            )
+        else:
+            data_loader_terabyte.numpy_to_binary(input_files=input_files,
+                                                 output_file_path=output_file,
+                                                 split=split)
 
 
 # Conversion from offset to length
@@ -416,7 +863,65 @@ def collate_wrapper_criteo_length(list_of_tuples):
     return X_int, lS_l, lS_i, T
 
 
-def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
+class RankBatchSampler(Sampler):
+    # Yields the slice of rank out of world_size ranks of every batch of a
+    # BatchSampler (split as extend_distributed.get_my_slice splits a batch).
+    # Batches whose (global) size is not a multiple of world_size are skipped
+    # on every rank, as the training loop skips them with whole batches (the
+    # ranks must agree on the batches, which they can not do from their slices).
+
+    def __init__(self, batch_sampler, rank, world_size):
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+
+    def __iter__(self):
+        for batch in self.batch_sampler:
+            if len(batch) % self.world_size != 0:
+                continue
+            k = len(batch) // self.world_size
+            yield batch[self.rank * k : (self.rank + 1) * k]
+
+    def __len__(self):
+        # all batches are full except maybe for the last one
+        n = len(self.batch_sampler)
+        if n == 0:
+            return 0
+        size = self.batch_sampler.batch_size
+        last = len(self.batch_sampler.sampler) - (n - 1) * size
+        if self.batch_sampler.drop_last:
+            last = size
+        return (n - 1) * (size % self.world_size == 0) + (
+            last % self.world_size == 0
+        )
+
+
+def _use_criteo_day_dataset(args):
+    # CriteoDayDataset workers read the days on their own, which is cheap only
+    # for memory mapped (npy) days, otherwise it must be requested explicitly
+    return args.dataset_format == "npy" or args.mlperf_day_dataset
+
+
+def make_criteo_data_and_loaders(
+        args, offset_to_length_converter=False, rank=0, world_size=1
+):
+    # with world_size > 1, the training loader returns only the slice of rank
+    # of every batch (the test loader still returns whole batches)
+    if world_size > 1 and (
+        args.dataset_streaming
+        or (
+            args.mlperf_logging and args.memory_map and args.data_set == "terabyte"
+            and (args.mlperf_bin_loader or not _use_criteo_day_dataset(args))
+        )
+    ):
+        sys.exit(
+            "ERROR: rank-local input is only supported by CriteoDataset and "
+            + "CriteoDayDataset loaders"
+        )
+
+    if args.dataset_streaming:
+        return make_criteo_stream_data_and_loaders(args, offset_to_length_converter)
+
     if args.mlperf_logging and args.memory_map and args.data_set == "terabyte":
         # more efficient for larger batches
         data_directory = path.dirname(args.raw_data_file)
@@ -434,12 +939,23 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
                                                 counts_file]):
                 ensure_dataset_preprocessed(args, d_path)
 
-            train_data = data_loader_terabyte.CriteoBinDataset(
-                data_file=train_file,
-                counts_file=counts_file,
-                batch_size=args.mini_batch_size,
-                max_ind_range=args.max_ind_range
-            )
+            if args.mlperf_bin_shuffle and args.mlperf_bin_shuffle_blocks > 0:
+                train_data = data_loader_terabyte.CriteoBinShuffleDataset(
+                    data_file=train_file,
+                    counts_file=counts_file,
+                    batch_size=args.mini_batch_size,
+                    max_ind_range=args.max_ind_range,
+                    buffer_blocks=args.mlperf_bin_shuffle_blocks,
+                    block_batches=args.mlperf_bin_shuffle_block_batches,
+                    seed=args.numpy_rand_seed,
+                )
+            else:
+                train_data = data_loader_terabyte.CriteoBinDataset(
+                    data_file=train_file,
+                    counts_file=counts_file,
+                    batch_size=args.mini_batch_size,
+                    max_ind_range=args.max_ind_range
+                )
 
             mlperf_logger.log_event(key=mlperf_logger.constants.TRAIN_SAMPLES,
                                     value=train_data.num_samples)
@@ -449,11 +965,13 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
                 batch_size=None,
                 batch_sampler=None,
                 shuffle=False,
-                num_workers=0,
+                num_workers=args.num_workers,
                 collate_fn=None,
                 pin_memory=False,
                 drop_last=False,
-                sampler=RandomSampler(train_data) if args.mlperf_bin_shuffle else None
+                sampler=RandomSampler(train_data)
+                if args.mlperf_bin_shuffle and args.mlperf_bin_shuffle_blocks <= 0
+                else None
             )
 
             test_data = data_loader_terabyte.CriteoBinDataset(
@@ -471,7 +989,7 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
                 batch_size=None,
                 batch_sampler=None,
                 shuffle=False,
-                num_workers=0,
+                num_workers=args.test_num_workers,
                 collate_fn=None,
                 pin_memory=False,
                 drop_last=False,
@@ -488,7 +1006,12 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
                 args.raw_data_file,
                 args.processed_data_file,
                 args.memory_map,
-                args.dataset_multiprocessing
+                args.dataset_multiprocessing,
+                args.dataset_hashing,
+                args.dataset_format,
+                args.dataset_frequency_ids,
+                args.dataset_min_count,
+                args.dataset_sketch_size,
             )
 
             test_data = CriteoDataset(
@@ -500,26 +1023,77 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
                 args.raw_data_file,
                 args.processed_data_file,
                 args.memory_map,
-                args.dataset_multiprocessing
+                args.dataset_multiprocessing,
+                args.dataset_hashing,
+                args.dataset_format,
+                args.dataset_frequency_ids,
+                args.dataset_min_count,
+                args.dataset_sketch_size,
             )
 
-            train_loader = data_loader_terabyte.DataLoader(
-                data_directory=data_directory,
-                data_filename=data_filename,
-                days=list(range(23)),
-                batch_size=args.mini_batch_size,
-                max_ind_range=args.max_ind_range,
-                split="train"
-            )
+            if _use_criteo_day_dataset(args) and (
+                args.num_workers > 0 or world_size > 1
+            ):
+                # the days are split across the ranks and loader workers, the
+                # ranks get (the same number of) whole batches of their slice
+                if args.mini_batch_size % world_size != 0:
+                    sys.exit(
+                        "ERROR: --mini-batch-size must be a multiple of the "
+                        + "number of ranks with rank-local input"
+                    )
+                train_loader = torch.utils.data.DataLoader(
+                    data_loader_terabyte.CriteoDayDataset(
+                        data_directory=data_directory,
+                        data_filename=data_filename,
+                        days=list(range(train_data.days - 1)),
+                        batch_size=args.mini_batch_size // world_size,
+                        max_ind_range=args.max_ind_range,
+                        split="train",
+                        drop_last_batch=world_size > 1,
+                        seed=args.numpy_rand_seed
+                        if args.mlperf_day_shuffle else None,
+                        rank=rank,
+                        world_size=world_size
+                    ),
+                    batch_size=None,
+                    num_workers=args.num_workers,
+                    pin_memory=False,
+                )
+            else:
+                train_loader = data_loader_terabyte.DataLoader(
+                    data_directory=data_directory,
+                    data_filename=data_filename,
+                    days=list(range(train_data.days - 1)),
+                    batch_size=args.mini_batch_size,
+                    max_ind_range=args.max_ind_range,
+                    split="train",
+                    prefetch_days=args.mlperf_prefetch_days
+                )
 
-            test_loader = data_loader_terabyte.DataLoader(
-                data_directory=data_directory,
-                data_filename=data_filename,
-                days=[23],
-                batch_size=args.test_mini_batch_size,
-                max_ind_range=args.max_ind_range,
-                split="test"
-            )
+            if _use_criteo_day_dataset(args) and args.test_num_workers > 0:
+                test_loader = torch.utils.data.DataLoader(
+                    data_loader_terabyte.CriteoDayDataset(
+                        data_directory=data_directory,
+                        data_filename=data_filename,
+                        days=[test_data.days - 1],
+                        batch_size=args.test_mini_batch_size,
+                        max_ind_range=args.max_ind_range,
+                        split="test"
+                    ),
+                    batch_size=None,
+                    num_workers=args.test_num_workers,
+                    pin_memory=False,
+                )
+            else:
+                test_loader = data_loader_terabyte.DataLoader(
+                    data_directory=data_directory,
+                    data_filename=data_filename,
+                    days=[test_data.days - 1],
+                    batch_size=args.test_mini_batch_size,
+                    max_ind_range=args.max_ind_range,
+                    split="test",
+                    prefetch_days=args.mlperf_prefetch_days
+                )
     else:
         train_data = CriteoDataset(
             args.data_set,
@@ -531,6 +1105,11 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
             args.processed_data_file,
             args.memory_map,
             args.dataset_multiprocessing,
+            args.dataset_hashing,
+            args.dataset_format,
+            args.dataset_frequency_ids,
+            args.dataset_min_count,
+            args.dataset_sketch_size,
         )
 
         test_data = CriteoDataset(
@@ -543,30 +1122,46 @@ def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
             args.processed_data_file,
             args.memory_map,
             args.dataset_multiprocessing,
+            args.dataset_hashing,
+            args.dataset_format,
+            args.dataset_frequency_ids,
+            args.dataset_min_count,
+            args.dataset_sketch_size,
         )
 
-        collate_wrapper_criteo = collate_wrapper_criteo_offset
+        # the dataset returns whole batches (for the indices of a batch sampler)
+        collate_wrapper_criteo = collate_wrapper_criteo_batch_offset
         if offset_to_length_converter:
-            collate_wrapper_criteo = collate_wrapper_criteo_length
+            collate_wrapper_criteo = collate_wrapper_criteo_batch_length
+
+        train_sampler = BatchSampler(
+            SequentialSampler(train_data),
+            args.mini_batch_size,
+            drop_last=False,  # True
+        )
+        if world_size > 1:
+            train_sampler = RankBatchSampler(train_sampler, rank, world_size)
 
         train_loader = torch.utils.data.DataLoader(
             train_data,
-            batch_size=args.mini_batch_size,
-            shuffle=False,
+            batch_size=None,
+            sampler=train_sampler,
             num_workers=args.num_workers,
             collate_fn=collate_wrapper_criteo,
             pin_memory=False,
-            drop_last=False,  # True
         )
 
         test_loader = torch.utils.data.DataLoader(
             test_data,
-            batch_size=args.test_mini_batch_size,
-            shuffle=False,
+            batch_size=None,
+            sampler=BatchSampler(
+                SequentialSampler(test_data),
+                args.test_mini_batch_size,
+                drop_last=False,  # True
+            ),
             num_workers=args.test_num_workers,
             collate_fn=collate_wrapper_criteo,
             pin_memory=False,
-            drop_last=False,  # True
         )
 
     return train_data, train_loader, test_data, test_loader
@@ -624,10 +1219,14 @@ class RandomDataset(Dataset):
         self.rand_data_max = rand_data_max
         self.rand_data_mu = rand_data_mu
         self.rand_data_sigma = rand_data_sigma
+        # synthetic traces of the tables, continued from batch to batch
+        self.traces = {}
 
     def reset_numpy_seed(self, numpy_rand_seed):
         np.random.seed(numpy_rand_seed)
         # torch.manual_seed(numpy_rand_seed)
+        # restart the synthetic traces as well
+        self.traces = {}
 
     def __getitem__(self, index):
 
@@ -668,7 +1267,8 @@ class RandomDataset(Dataset):
                 self.num_indices_per_lookup,
                 self.num_indices_per_lookup_fixed,
                 self.trace_file,
-                self.enable_padding
+                self.enable_padding,
+                self.traces,
             )
         else:
             sys.exit(
@@ -804,6 +1404,7 @@ def generate_random_data(
     lX = []
     lS_offsets = []
     lS_indices = []
+    traces = {}
     for j in range(0, nbatches):
         # number of data points in a batch
         n = min(mini_batch_size, data_size - (j * mini_batch_size))
@@ -826,7 +1427,8 @@ def generate_random_data(
                 num_indices_per_lookup,
                 num_indices_per_lookup_fixed,
                 trace_file,
-                enable_padding
+                enable_padding,
+                traces,
             )
         else:
             sys.exit(
@@ -855,6 +1457,45 @@ def generate_random_output_batch(n, num_targets, round_targets=False):
     return torch.tensor(P)
 
 
+def _generate_bag_sizes(n, size, num_indices_per_lookup, num_indices_per_lookup_fixed):
+    # number of sparse indices of each of the n lookups into a table of size rows
+    if num_indices_per_lookup_fixed:
+        return np.full(n, num_indices_per_lookup, dtype=np.int64)
+    # random between [1,num_indices_per_lookup])
+    r = ra.random(n)
+    return np.round(np.maximum(1.0, r * min(size, num_indices_per_lookup))).astype(
+        np.int64
+    )
+
+
+def _unique_bags(bag_sizes, values):
+    # removes the duplicate values within each bag (the values of a bag are
+    # consecutive) and sorts them, as np.unique does for each bag separately
+    n = bag_sizes.size
+    if values.size == 0:
+        return np.zeros(n, dtype=np.int64), values
+    # sort the bags as the rows of a matrix, padded with values past the maximum
+    bags = np.repeat(np.arange(n), bag_sizes)
+    starts = np.cumsum(bag_sizes) - bag_sizes
+    pos = np.arange(values.size) - np.repeat(starts, bag_sizes)
+    pad = np.inf if values.dtype.kind == "f" else values.max() + 1
+    mat = np.full((n, int(bag_sizes.max())), pad, dtype=values.dtype)
+    mat[bags, pos] = values
+    mat.sort(axis=1)
+    keep = mat != pad
+    keep[:, 1:] &= mat[:, 1:] != mat[:, :-1]
+    return keep.sum(axis=1), mat[keep]
+
+
+def _bag_offsets_or_lengths(bag_sizes, length=False):
+    # offsets of the bags (or their lengths for the caffe2 version)
+    if length:
+        return torch.tensor(bag_sizes.astype(np.int32))
+    offsets = np.zeros(bag_sizes.size, dtype=np.int64)
+    np.cumsum(bag_sizes[:-1], out=offsets[1:])
+    return torch.tensor(offsets)
+
+
 # uniform ditribution (input data)
 def generate_uniform_input_batch(
     m_den,
@@ -870,37 +1511,19 @@ def generate_uniform_input_batch(
     # sparse feature (sparse indices)
     lS_emb_offsets = []
     lS_emb_indices = []
-    # for each embedding generate a list of n lookups,
+    # for each embedding generate a batch of n lookups at once,
     # where each lookup is composed of multiple sparse indices
     for size in ln_emb:
-        lS_batch_offsets = []
-        lS_batch_indices = []
-        offset = 0
-        for _ in range(n):
-            # num of sparse indices to be used per embedding (between
-            if num_indices_per_lookup_fixed:
-                sparse_group_size = np.int64(num_indices_per_lookup)
-            else:
-                # random between [1,num_indices_per_lookup])
-                r = ra.random(1)
-                sparse_group_size = np.int64(
-                    np.round(max([1.0], r * min(size, num_indices_per_lookup)))
-                )
-            # sparse indices to be used per embedding
-            r = ra.random(sparse_group_size)
-            sparse_group = np.unique(np.round(r * (size - 1)).astype(np.int64))
-            # reset sparse_group_size in case some index duplicates were removed
-            sparse_group_size = np.int32(sparse_group.size)
-            # store lengths and indices
-            if length: # for caffe2 version
-                lS_batch_offsets += [sparse_group_size]
-            else:
-                lS_batch_offsets += [offset]
-            lS_batch_indices += sparse_group.tolist()
-            # update offset for next iteration
-            offset += sparse_group_size
-        lS_emb_offsets.append(torch.tensor(lS_batch_offsets))
-        lS_emb_indices.append(torch.tensor(lS_batch_indices))
+        bag_sizes = _generate_bag_sizes(
+            n, size, num_indices_per_lookup, num_indices_per_lookup_fixed
+        )
+        # sparse indices of all lookups
+        r = ra.random(bag_sizes.sum())
+        sparse_group = np.round(r * (size - 1)).astype(np.int64)
+        # bag sizes are reset in case some index duplicates were removed
+        bag_sizes, sparse_group = _unique_bags(bag_sizes, sparse_group)
+        lS_emb_offsets.append(_bag_offsets_or_lengths(bag_sizes, length))
+        lS_emb_indices.append(torch.tensor(sparse_group))
 
     return (Xt, lS_emb_offsets, lS_emb_indices)
 
@@ -921,48 +1544,37 @@ def generate_dist_input_batch(
     # dense feature
     Xt = torch.tensor(ra.rand(n, m_den).astype(np.float32))
 
+    if rand_data_dist == "gaussian" and rand_data_mu == -1:
+        rand_data_mu = (rand_data_max + rand_data_min) / 2.0
+
     # sparse feature (sparse indices)
     lS_emb_offsets = []
     lS_emb_indices = []
-    # for each embedding generate a list of n lookups,
+    # for each embedding generate a batch of n lookups at once,
     # where each lookup is composed of multiple sparse indices
     for size in ln_emb:
-        lS_batch_offsets = []
-        lS_batch_indices = []
-        offset = 0
-        for _ in range(n):
-            # num of sparse indices to be used per embedding (between
-            if num_indices_per_lookup_fixed:
-                sparse_group_size = np.int64(num_indices_per_lookup)
-            else:
-                # random between [1,num_indices_per_lookup])
-                r = ra.random(1)
-                sparse_group_size = np.int64(
-                    np.round(max([1.0], r * min(size, num_indices_per_lookup)))
-                )
-            # sparse indices to be used per embedding
-            if rand_data_dist == "gaussian":
-                if rand_data_mu == -1:
-                    rand_data_mu = (rand_data_max + rand_data_min) / 2.0
-                r = ra.normal(rand_data_mu, rand_data_sigma, sparse_group_size)
-                sparse_group = np.clip(r, rand_data_min, rand_data_max)
-                sparse_group = np.unique(sparse_group).astype(np.int64)
-            elif rand_data_dist == "uniform":
-                r = ra.random(sparse_group_size)
-                sparse_group = np.unique(np.round(r * (size - 1)).astype(np.int64))
-            else:
-                raise(rand_data_dist, "distribution is not supported. \
-                     please select uniform or gaussian")
-
-            # reset sparse_group_size in case some index duplicates were removed
-            sparse_group_size = np.int64(sparse_group.size)
-            # store lengths and indices
-            lS_batch_offsets += [offset]
-            lS_batch_indices += sparse_group.tolist()
-            # update offset for next iteration
-            offset += sparse_group_size
-        lS_emb_offsets.append(torch.tensor(lS_batch_offsets))
-        lS_emb_indices.append(torch.tensor(lS_batch_indices))
+        bag_sizes = _generate_bag_sizes(
+            n, size, num_indices_per_lookup, num_indices_per_lookup_fixed
+        )
+        # sparse indices of all lookups
+        if rand_data_dist == "gaussian":
+            r = ra.normal(rand_data_mu, rand_data_sigma, bag_sizes.sum())
+            sparse_group = np.clip(r, rand_data_min, rand_data_max)
+            # duplicates are removed before the conversion
+            bag_sizes, sparse_group = _unique_bags(bag_sizes, sparse_group)
+            sparse_group = sparse_group.astype(np.int64)
+        elif rand_data_dist == "uniform":
+            r = ra.random(bag_sizes.sum())
+            sparse_group = np.round(r * (size - 1)).astype(np.int64)
+            bag_sizes, sparse_group = _unique_bags(bag_sizes, sparse_group)
+        else:
+            sys.exit(
+                "ERROR: --rand-data-dist=" + rand_data_dist + " is not supported, "
+                + "please select uniform or gaussian"
+            )
+
+        lS_emb_offsets.append(_bag_offsets_or_lengths(bag_sizes))
+        lS_emb_indices.append(torch.tensor(sparse_group))
 
     return (Xt, lS_emb_offsets, lS_emb_indices)
 
@@ -976,74 +1588,195 @@ def generate_synthetic_input_batch(
     num_indices_per_lookup_fixed,
     trace_file,
     enable_padding=False,
+    traces=None,
 ):
+    # traces (dict): SyntheticTrace of each table, continued across the calls
+    # sharing it (new traces are started for the tables missing from it)
+    if traces is None:
+        traces = {}
+
     # dense feature
     Xt = torch.tensor(ra.rand(n, m_den).astype(np.float32))
 
     # sparse feature (sparse indices)
     lS_emb_offsets = []
     lS_emb_indices = []
-    # for each embedding generate a list of n lookups,
+    # for each embedding generate a batch of n lookups at once,
     # where each lookup is composed of multiple sparse indices
     for i, size in enumerate(ln_emb):
-        lS_batch_offsets = []
-        lS_batch_indices = []
-        offset = 0
-        for _ in range(n):
-            # num of sparse indices to be used per embedding (between
-            if num_indices_per_lookup_fixed:
-                sparse_group_size = np.int64(num_indices_per_lookup)
-            else:
-                # random between [1,num_indices_per_lookup])
-                r = ra.random(1)
-                sparse_group_size = np.int64(
-                    max(1, np.round(r * min(size, num_indices_per_lookup))[0])
-                )
-            # sparse indices to be used per embedding
-            file_path = trace_file
-            line_accesses, list_sd, cumm_sd = read_dist_from_file(
-                file_path.replace("j", str(i))
-            )
-            # debug prints
-            # print("input")
-            # print(line_accesses); print(list_sd); print(cumm_sd);
-            # print(sparse_group_size)
-            # approach 1: rand
-            # r = trace_generate_rand(
-            #     line_accesses, list_sd, cumm_sd, sparse_group_size, enable_padding
-            # )
-            # approach 2: lru
-            r = trace_generate_lru(
-                line_accesses, list_sd, cumm_sd, sparse_group_size, enable_padding
+        bag_sizes = _generate_bag_sizes(
+            n, size, num_indices_per_lookup, num_indices_per_lookup_fixed
+        )
+        # sparse indices of all lookups, continuing the trace of the table
+        if i not in traces:
+            traces[i] = SyntheticTrace(trace_file.replace("j", str(i)), enable_padding)
+        r = traces[i].generate(bag_sizes.sum())
+        bag_sizes, sparse_group = _unique_bags(bag_sizes, r.astype(np.int64))
+        # WARNING: if the distribution in the file is not consistent
+        # with embedding table dimensions, below mod guards against out
+        # of range access
+        if sparse_group.size > 0 and (
+            sparse_group.min() < 0 or size <= sparse_group.max()
+        ):
+            print(
+                "WARNING: distribution is inconsistent with embedding "
+                + "table size (using mod to recover and continue)"
             )
-            # WARNING: if the distribution in the file is not consistent
-            # with embedding table dimensions, below mod guards against out
-            # of range access
-            sparse_group = np.unique(r).astype(np.int64)
-            minsg = np.min(sparse_group)
-            maxsg = np.max(sparse_group)
-            if (minsg < 0) or (size <= maxsg):
-                print(
-                    "WARNING: distribution is inconsistent with embedding "
-                    + "table size (using mod to recover and continue)"
-                )
-                sparse_group = np.mod(sparse_group, size).astype(np.int64)
-            # sparse_group = np.unique(np.array(np.mod(r, size-1)).astype(np.int64))
-            # reset sparse_group_size in case some index duplicates were removed
-            sparse_group_size = np.int64(sparse_group.size)
-            # store lengths and indices
-            lS_batch_offsets += [offset]
-            lS_batch_indices += sparse_group.tolist()
-            # update offset for next iteration
-            offset += sparse_group_size
-        lS_emb_offsets.append(torch.tensor(lS_batch_offsets))
-        lS_emb_indices.append(torch.tensor(lS_batch_indices))
+            sparse_group = np.mod(sparse_group, size).astype(np.int64)
+        lS_emb_offsets.append(_bag_offsets_or_lengths(bag_sizes))
+        lS_emb_indices.append(torch.tensor(sparse_group))
 
     return (Xt, lS_emb_offsets, lS_emb_indices)
 
 
+@functools.lru_cache(maxsize=None)
+def load_dist_from_file(file_path):
+    # distribution of a table, loaded once per file and shared (read-only),
+    # binary files are memory mapped instead of parsed
+    arrays = read_trace_arrays(file_path)
+    if arrays is not None:
+        return arrays["unique_accesses"], arrays["list_sd"], arrays["cumm_sd"]
+    unique_accesses, list_sd, cumm_sd = read_dist_from_file(file_path)
+    return (
+        np.array(unique_accesses, dtype=np.uint64),
+        np.array(list_sd, dtype=np.int64),
+        np.array(cumm_sd, dtype=np.float64),
+    )
+
+
+class SyntheticTrace:
+    # LRU state of a synthetic trace (generated from the distribution of a
+    # table), so that the trace can be continued by successive calls
+
+    def __init__(self, file_path, enable_padding=False):
+        unique_accesses, list_sd, cumm_sd = load_dist_from_file(file_path)
+        self.stack = LRUStack(unique_accesses.tolist())
+        self.list_sd = list_sd.tolist()
+        self.cumm_sd = cumm_sd.tolist()
+        self.enable_padding = enable_padding
+        # number of new references generated so far
+        self.i = 0
+
+    def generate(self, out_trace_len):
+        ztrace, self.i = _trace_generate_lru(
+            self.stack,
+            self.list_sd,
+            self.cumm_sd,
+            out_trace_len,
+            self.enable_padding,
+            self.i,
+        )
+        return ztrace
+
+
+class LRUStack:
+    # LRU stack of lines (the most recently used last), kept as a Fenwick tree
+    # over the times of the last use of the lines, so that the line at a given
+    # stack distance is found (and moved to the top) in O(log n) time
+
+    def __init__(self, lines):
+        self._build(list(lines))
+
+    def _build(self, lines):
+        # times are renumbered from 0, leaving as many free times as lines
+        n = len(lines)
+        self.n = n
+        self.size = 2 * n + 1024
+        self.lines = lines + [None] * (self.size - n)
+        tree = [0] * (self.size + 1)
+        for p in range(1, self.size + 1):
+            if p <= n:
+                tree[p] += 1
+            q = p + (p & -p)
+            if q <= self.size:
+                tree[q] += tree[p]
+        self.tree = tree
+        self.top = n
+        self.mask = 1 << (self.size.bit_length() - 1)
+
+    def get_lines(self):
+        # lines from the least to the most recently used
+        return [x for x in self.lines[: self.top] if x is not None]
+
+    def _remove(self, pos):
+        # removes the line used at time pos
+        tree = self.tree
+        size = self.size
+        self.lines[pos] = None
+        p = pos + 1
+        while p <= size:
+            tree[p] -= 1
+            p += p & -p
+        self.n -= 1
+
+    def _push(self, line):
+        # puts a line on the top (used at the next time) and returns the time
+        if self.top == self.size:
+            self._build(self.get_lines())
+        tree = self.tree
+        size = self.size
+        pos = self.top
+        self.lines[pos] = line
+        p = pos + 1
+        while p <= size:
+            tree[p] += 1
+            p += p & -p
+        self.top += 1
+        self.n += 1
+        return pos
+
+    def access(self, sd):
+        # moves the line at stack distance sd (1 for the most recently used,
+        # n for the least recently used) to the top and returns it
+        tree = self.tree
+        size = self.size
+        # find the time of the k-th line from the bottom (descending the tree)
+        k = self.n - sd + 1
+        pos = 0
+        bit = self.mask
+        while bit:
+            q = pos + bit
+            if q <= size and tree[q] < k:
+                pos = q
+                k -= tree[q]
+            bit >>= 1
+        line = self.lines[pos]
+        self._remove(pos)
+        self._push(line)
+        return line
+
+
+class LRUProfiler(LRUStack):
+    # LRU stack that also maps each line to the time of its last use, so that
+    # the stack distance of an access is counted in O(log n) time
+
+    def __init__(self):
+        super(LRUProfiler, self).__init__([])
+
+    def _build(self, lines):
+        super(LRUProfiler, self)._build(lines)
+        self.last = {x: t for t, x in enumerate(lines)}
+
+    def access_line(self, line):
+        # moves line to the top and returns its stack distance (0 if new)
+        pos = self.last.get(line)
+        if pos is None:
+            sd = 0
+        else:
+            # number of lines used at time pos or later
+            tree = self.tree
+            sd = self.n
+            p = pos
+            while p > 0:
+                sd -= tree[p]
+                p -= p & -p
+            self._remove(pos)
+        self.last[line] = self._push(line)
+        return sd
+
+
 def generate_stack_distance(cumm_val, cumm_dist, max_i, i, enable_padding=False):
-    u = ra.rand(1)
+    u = ra.rand(1)[0]
     if i < max_i:
         # only generate stack distances up to the number of new references seen so far
         j = bisect.bisect(cumm_val, i) - 1
@@ -1054,9 +1787,9 @@ def generate_stack_distance(cumm_val, cumm_dist, max_i, i, enable_padding=False)
         fi = cumm_dist[0]
         u = (1.0 - fi) * u + fi  # remap distribution support to exclude first value
 
-    for (j, f) in enumerate(cumm_dist):
-        if u <= f:
-            return cumm_val[j]
+    # first value with u <= cumulative probability (binary search)
+    j = min(bisect.bisect_left(cumm_dist, u), len(cumm_dist) - 1)
+    return cumm_val[j]
 
 
 # WARNING: global define, must be consistent across all synthetic functions
@@ -1066,30 +1799,51 @@ cache_line_size = 1
 def trace_generate_lru(
     line_accesses, list_sd, cumm_sd, out_trace_len, enable_padding=False
 ):
+    # line_accesses is updated to the LRU stack at the end of the trace
+    stack = LRUStack(line_accesses)
+    ztrace, _ = _trace_generate_lru(
+        stack, list_sd, cumm_sd, out_trace_len, enable_padding
+    )
+    line_accesses.clear()
+    line_accesses.extend(stack.get_lines())
+    return ztrace
+
+
+def _trace_generate_lru(
+    stack, list_sd, cumm_sd, out_trace_len, enable_padding=False, i=0
+):
+    # i is the number of new references generated before (by a previous call
+    # on the same stack), the updated number is returned with the trace
     max_sd = list_sd[-1]
-    l = len(line_accesses)
-    i = 0
-    ztrace = deque()
-    for _ in range(out_trace_len):
-        sd = generate_stack_distance(list_sd, cumm_sd, max_sd, i, enable_padding)
+    l = stack.n
+    ztrace = np.empty(out_trace_len, dtype=np.uint64)
+    # the same random numbers as drawn one at a time by generate_stack_distance
+    u_all = ra.rand(out_trace_len).tolist()
+    last = len(cumm_sd) - 1
+    fi = cumm_sd[bisect.bisect(list_sd, i) - 1] if i < max_sd else 1.0
+    for k in range(out_trace_len):
+        u = u_all[k]
+        if i < max_sd:
+            # only generate stack distances up to the number of new references seen so far
+            u *= fi  # shrink distribution support to exclude last values
+        elif enable_padding:
+            # WARNING: disable generation of new references (once all have been seen)
+            u = (1.0 - cumm_sd[0]) * u + cumm_sd[0]
+        sd = list_sd[min(bisect.bisect_left(cumm_sd, u), last)]
         mem_ref_within_line = 0  # floor(ra.rand(1)*cache_line_size) #0
 
         # generate memory reference
-        if sd == 0:  # new reference #
-            line_ref = line_accesses[0]
-            del line_accesses[0]
-            line_accesses.append(line_ref)
-            mem_ref = np.uint64(line_ref * cache_line_size + mem_ref_within_line)
+        if sd == 0:  # new reference (the least recently used line) #
+            line_ref = stack.access(l)
             i += 1
+            if i < max_sd:
+                fi = cumm_sd[bisect.bisect(list_sd, i) - 1]
         else:  # existing reference #
-            line_ref = line_accesses[l - sd]
-            mem_ref = np.uint64(line_ref * cache_line_size + mem_ref_within_line)
-            del line_accesses[l - sd]
-            line_accesses.append(line_ref)
+            line_ref = stack.access(sd)
         # save generated memory reference
-        ztrace.append(mem_ref)
+        ztrace[k] = line_ref * cache_line_size + mem_ref_within_line
 
-    return ztrace
+    return ztrace, i
 
 
 def trace_generate_rand(
@@ -1116,35 +1870,31 @@ def trace_generate_rand(
     return ztrace
 
 
-def trace_profile(trace, enable_padding=False):
-    # number of elements in the array (assuming 1D)
-    # n = trace.size
-
-    rstack = deque()  # S
-    stack_distances = deque()  # SDS
-    line_accesses = deque()  # L
-    for x in trace:
-        r = np.uint64(x / cache_line_size)
-        l = len(rstack)
-        try:  # found #
-            i = rstack.index(r)
+def trace_profile(trace, enable_padding=False, chunk_size=1 << 20):
+    # Computes the stack (reuse) distance of every access of a trace, given as
+    # a sequence or an array (e.g. a np.memmap of a binary trace file).
+    #
+    # Outputs (in chronological order):
+    #     rstack (np.array): lines from the least to the most recently used
+    #     stack_distances (np.array): stack distance of each access (0 for the
+    #                                 first access of a line)
+    #     line_accesses (np.array): lines in the order of their first access
+    profiler = LRUProfiler()
+    stack_distances = np.empty(len(trace), dtype=np.int64)
+    line_accesses = []
+    for k in range(0, len(trace), chunk_size):
+        lines = np.asarray(trace[k : k + chunk_size], dtype=np.uint64)
+        for t, r in enumerate((lines // np.uint64(cache_line_size)).tolist(), k):
+            sd = profiler.access_line(r)
             # WARNING: I believe below is the correct depth in terms of meaning of the
             #          algorithm, but that is not what seems to be in the paper alg.
             #          -1 can be subtracted if we defined the distance between
             #          consecutive accesses (e.g. r, r) as 0 rather than 1.
-            sd = l - i  # - 1
-            # push r to the end of stack_distances
-            stack_distances.appendleft(sd)
-            # remove r from its position and insert to the top of stack
-            del rstack[i]  # rstack.remove(r)
-            rstack.append(r)
-        except ValueError:  # not found #
-            sd = 0  # -1
-            # push r to the end of stack_distances/line_accesses
-            stack_distances.appendleft(sd)
-            line_accesses.appendleft(r)
-            # push r to the top of stack
-            rstack.append(r)
+            stack_distances[t] = sd
+            if sd == 0:
+                line_accesses.append(r)
+    rstack = np.array(profiler.get_lines(), dtype=np.uint64)
+    line_accesses = np.array(line_accesses, dtype=np.uint64)
 
     if enable_padding:
         # WARNING: notice that as the ratio between the number of samples (l)
@@ -1157,42 +1907,118 @@ def trace_profile(trace, enable_padding=False):
         # Therefore, we may pad the number of new samples to be on par with
         # average number of samples l/c artificially.
         l = len(stack_distances)
-        c = max(stack_distances)
+        c = max(stack_distances.max(initial=0), 1)
         padding = int(np.ceil(l / c))
-        stack_distances = stack_distances + [0] * padding
+        stack_distances = np.concatenate(
+            [stack_distances, np.zeros(padding, dtype=np.int64)]
+        )
 
     return (rstack, stack_distances, line_accesses)
 
 
 # auxiliary read/write routines
-def read_trace_from_file(file_path):
+
+# binary container of traces and distributions, a header followed by arrays
+TRACE_MAGIC = b"DLRMTRC\0"
+TRACE_VERSION = 1
+TRACE_ALIGNMENT = 64
+
+
+def write_trace_arrays(file_path, **arrays):
+    # Writes named 1D arrays to a binary container: the magic, the version and
+    # the length of a json header (describing the arrays), the json header and
+    # the arrays (each aligned to TRACE_ALIGNMENT bytes).
+    arrays = {k: np.ascontiguousarray(a) for k, a in arrays.items()}
+    # the header size depends on the offsets, which depend on the header size
+    header_size = 0
+    while True:
+        offset = header_size
+        desc = {}
+        for k, a in arrays.items():
+            offset += -offset % TRACE_ALIGNMENT
+            desc[k] = {"dtype": a.dtype.str, "length": a.size, "offset": offset}
+            offset += a.nbytes
+        header = json.dumps({"version": TRACE_VERSION, "arrays": desc}).encode()
+        size = len(TRACE_MAGIC) + 8 + len(header)
+        if size <= header_size:
+            break
+        header_size = size + -size % TRACE_ALIGNMENT
+    with open(file_path, "wb") as f:
+        f.write(TRACE_MAGIC)
+        f.write(np.array([TRACE_VERSION, header_size - size + len(header)],
+                         dtype="<u4").tobytes())
+        f.write(header + b" " * (header_size - size))
+        for k, a in arrays.items():
+            f.write(b"\0" * (desc[k]["offset"] - f.tell()))
+            a.tofile(f)
+
+
+def read_trace_arrays(file_path):
+    # Memory maps the arrays of a binary container (see write_trace_arrays),
+    # returns None if the file is not one (e.g. a text file).
+    with open(file_path, "rb") as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            return None
+        version, length = np.frombuffer(f.read(8), dtype="<u4")
+        if version > TRACE_VERSION:
+            sys.exit("ERROR: unsupported trace file version %d" % version)
+        header = json.loads(f.read(int(length)).decode())
+    arrays = {}
+    for k, d in header["arrays"].items():
+        if d["length"] == 0:
+            arrays[k] = np.empty(0, dtype=d["dtype"])
+        else:
+            arrays[k] = np.memmap(
+                file_path, dtype=d["dtype"], mode="r", offset=d["offset"],
+                shape=(d["length"],)
+            )
+    return arrays
+
+
+def read_trace_from_file(file_path, binary=False):
+    # binary containers are recognized by their header, binary (uint64) files
+    # without header must be marked as binary
     try:
+        arrays = read_trace_arrays(file_path)
+        if arrays is not None:
+            return arrays["trace"]
+        if binary:
+            # memory mapped, so that long traces are not loaded at once
+            if path.getsize(file_path) == 0:
+                return np.empty(0, dtype=np.uint64)
+            return np.memmap(file_path, dtype=np.uint64, mode="r")
         with open(file_path) as f:
-            if args.trace_file_binary_type:
-                array = np.fromfile(f, dtype=np.uint64)
-                trace = array.astype(np.uint64).tolist()
-            else:
-                line = f.readline()
-                trace = list(map(lambda x: np.uint64(x), line.split(", ")))
+            line = f.readline()
+            trace = list(map(lambda x: np.uint64(x), line.split(", ")))
             return trace
     except Exception:
         print(f"ERROR: trace file '{file_path}' is not available.")
 
 
-def write_trace_to_file(file_path, trace):
+def write_trace_to_file(file_path, trace, binary=False, container=False):
+    # binary traces are raw uint64 values, unless they are written to a binary
+    # container (see write_trace_arrays), which is recognized when read
     try:
-        if args.trace_file_binary_type:
-            with open(file_path, "wb+") as f:
-                np.array(trace).astype(np.uint64).tofile(f)
+        if container:
+            write_trace_arrays(file_path, trace=np.asarray(trace, dtype=np.uint64))
+        elif binary:
+            np.asarray(trace, dtype=np.uint64).tofile(file_path)
         else:
             with open(file_path, "w+") as f:
-                s = str(list(trace))
-                f.write(s[1 : len(s) - 1])
+                f.write(", ".join(map(str, np.asarray(trace).tolist())))
     except Exception:
         print("ERROR: no output trace file has been provided")
 
 
 def read_dist_from_file(file_path):
+    # binary containers are recognized by their header
+    arrays = read_trace_arrays(file_path)
+    if arrays is not None:
+        return (
+            arrays["unique_accesses"].tolist(),
+            arrays["list_sd"].tolist(),
+            arrays["cumm_sd"].tolist(),
+        )
     try:
         with open(file_path, "r") as f:
             lines = f.read().splitlines()
@@ -1207,30 +2033,37 @@ def read_dist_from_file(file_path):
     return unique_accesses, list_sd, cumm_sd
 
 
-def write_dist_to_file(file_path, unique_accesses, list_sd, cumm_sd):
+def write_dist_to_file(file_path, unique_accesses, list_sd, cumm_sd, binary=False):
+    if binary:
+        write_trace_arrays(
+            file_path,
+            unique_accesses=np.asarray(unique_accesses, dtype=np.uint64),
+            list_sd=np.asarray(list_sd, dtype=np.int64),
+            cumm_sd=np.asarray(cumm_sd, dtype=np.float64),
+        )
+        return
     try:
         with open(file_path, "w") as f:
             # unique_acesses
-            s = str(list(unique_accesses))
-            f.write(s[1 : len(s) - 1] + "\n")
+            f.write(", ".join(map(str, np.asarray(unique_accesses).tolist())) + "\n")
             # list_sd
-            s = str(list_sd)
-            f.write(s[1 : len(s) - 1] + "\n")
+            f.write(", ".join(map(str, np.asarray(list_sd).tolist())) + "\n")
             # cumm_sd
-            s = str(list(cumm_sd))
-            f.write(s[1 : len(s) - 1] + "\n")
+            f.write(", ".join(map(str, np.asarray(cumm_sd).tolist())) + "\n")
     except Exception:
         print("Wrong file or file path")
 
 
 if __name__ == "__main__":
-    import operator
     import argparse
 
     ### parse arguments ###
     parser = argparse.ArgumentParser(description="Generate Synthetic Distributions")
     parser.add_argument("--trace-file", type=str, default="./input/trace.log")
     parser.add_argument("--trace-file-binary-type", type=bool, default=False)
+    parser.add_argument("--dist-file-binary-type", type=bool, default=False)
+    # write the synthetic trace to a (memory mappable) binary container
+    parser.add_argument("--trace-file-container", type=bool, default=False)
     parser.add_argument("--trace-enable-padding", type=bool, default=False)
     parser.add_argument("--dist-file", type=str, default="./input/dist.log")
     parser.add_argument(
@@ -1245,47 +2078,45 @@ if __name__ == "__main__":
     np.set_printoptions(precision=args.print_precision)
 
     ### read trace ###
-    trace = read_trace_from_file(args.trace_file)
+    trace = read_trace_from_file(args.trace_file, args.trace_file_binary_type)
     # print(trace)
 
     ### profile trace ###
     (_, stack_distances, line_accesses) = trace_profile(
         trace, args.trace_enable_padding
     )
-    stack_distances.reverse()
-    line_accesses.reverse()
     # print(line_accesses)
     # print(stack_distances)
 
     ### compute probability distribution ###
     # count items
     l = len(stack_distances)
-    dc = sorted(
-        collections.Counter(stack_distances).items(), key=operator.itemgetter(0)
-    )
+    list_sd, counts_sd = np.unique(stack_distances, return_counts=True)
 
     # create a distribution
-    list_sd = list(map(lambda tuple_x_k: tuple_x_k[0], dc))  # x = tuple_x_k[0]
-    dist_sd = list(
-        map(lambda tuple_x_k: tuple_x_k[1] / float(l), dc)
-    )  # k = tuple_x_k[1]
-    cumm_sd = deque()  # np.cumsum(dc).tolist() #prefixsum
-    for i, (_, k) in enumerate(dc):
-        if i == 0:
-            cumm_sd.append(k / float(l))
-        else:
-            # add the 2nd element of the i-th tuple in the dist_sd list
-            cumm_sd.append(cumm_sd[i - 1] + (k / float(l)))
+    dist_sd = counts_sd / float(l)
+    cumm_sd = np.cumsum(dist_sd)  # prefixsum
 
     ### write stack_distance and line_accesses to a file ###
-    write_dist_to_file(args.dist_file, line_accesses, list_sd, cumm_sd)
+    write_dist_to_file(
+        args.dist_file, line_accesses, list_sd, cumm_sd, args.dist_file_binary_type
+    )
 
     ### generate corresponding synthetic ###
     # line_accesses, list_sd, cumm_sd = read_dist_from_file(args.dist_file)
     synthetic_trace = trace_generate_lru(
-        line_accesses, list_sd, cumm_sd, len(trace), args.trace_enable_padding
+        line_accesses.tolist(),
+        list_sd.tolist(),
+        cumm_sd.tolist(),
+        len(trace),
+        args.trace_enable_padding,
     )
     # synthetic_trace = trace_generate_rand(
     #     line_accesses, list_sd, cumm_sd, len(trace), args.trace_enable_padding
     # )
-    write_trace_to_file(args.synthetic_file, synthetic_trace)
+    write_trace_to_file(
+        args.synthetic_file,
+        synthetic_trace,
+        args.trace_file_binary_type,
+        args.trace_file_container,
+    )
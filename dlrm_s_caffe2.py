@@ -1199,6 +1199,54 @@ if __name__ == "__main__":
                         The Terabyte dataset can be multiprocessed in an environment \
                         with more than 24 CPU cores and at least 1 TB of memory.",
     )
+    parser.add_argument(
+        "--dataset-hashing",
+        action="store_true",
+        default=False,
+        help="Use the categorical features modulo --max-ind-range as ids \
+                        directly, skipping the dictionaries and the remap pass.",
+    )
+    parser.add_argument(
+        "--dataset-format",
+        type=str,
+        default="npz",
+        help="Format of the preprocessed day files, compressed npz or raw \
+                        npy files (memory mapped by the data loaders).",
+    )
+    parser.add_argument(
+        "--dataset-frequency-ids",
+        action="store_true",
+        default=False,
+        help="Assign ids of categorical features in descending order of \
+                        their frequency, instead of their order of appearance.",
+    )
+    parser.add_argument(
+        "--dataset-min-count",
+        type=int,
+        default=0,
+        help="Map categorical values occurring less than this many times \
+                        to a single out-of-vocabulary id of their feature.",
+    )
+    parser.add_argument(
+        "--dataset-sketch-size",
+        type=int,
+        default=0,
+        help="Estimate the counts for --dataset-min-count with count-min \
+                        sketches of this many MB per day, instead of counting exactly.",
+    )
+    parser.add_argument(
+        "--dataset-streaming",
+        action="store_true",
+        default=False,
+        help="Stream the raw (optionally gzip) text files, hashing the categorical \
+                        features with --max-ind-range, instead of preprocessing them.",
+    )
+    parser.add_argument(
+        "--dataset-stream-processes",
+        type=int,
+        default=4,
+        help="Number of processes parsing the text with --dataset-streaming.",
+    )
     # inference
     parser.add_argument("--inference-only", action="store_true", default=False)
     # onnx (or protobuf with shapes)
@@ -117,7 +117,7 @@ def time_wrap(use_gpu):
     return time.time()
 
 
-def dlrm_wrap(X, lS_o, lS_i, use_gpu, device, ndevices=1):
+def dlrm_wrap(X, lS_o, lS_i, use_gpu, device, ndevices=1, local_input=False):
     with record_function("DLRM forward"):
         if use_gpu:  # .cuda()
             # lS_i can be either a list of tensors or a stacked tensor.
@@ -133,6 +133,8 @@ def dlrm_wrap(X, lS_o, lS_i, use_gpu, device, ndevices=1):
                     if isinstance(lS_o, list)
                     else lS_o.to(device)
                 )
+        if local_input:
+            return dlrm(X.to(device), lS_o, lS_i, local_input=True)
         return dlrm(X.to(device), lS_o, lS_i)
 
 
@@ -505,10 +507,10 @@ class DLRM_Net(nn.Module):
 
         return R
 
-    def forward(self, dense_x, lS_o, lS_i):
+    def forward(self, dense_x, lS_o, lS_i, local_input=False):
         if ext_dist.my_size > 1:
             # multi-node multi-device run
-            return self.distributed_forward(dense_x, lS_o, lS_i)
+            return self.distributed_forward(dense_x, lS_o, lS_i, local_input)
         elif self.ndevices <= 1:
             # single device run
             return self.sequential_forward(dense_x, lS_o, lS_i)
@@ -516,8 +518,14 @@ class DLRM_Net(nn.Module):
             # single-node multi-device run
             return self.parallel_forward(dense_x, lS_o, lS_i)
 
-    def distributed_forward(self, dense_x, lS_o, lS_i):
-        batch_size = dense_x.size()[0]
+    def distributed_forward(self, dense_x, lS_o, lS_i, local_input=False):
+        if local_input:
+            # the inputs are this rank's slice of the batch, the sparse features
+            # of the local tables are gathered for the whole batch
+            lS_o, lS_i = ext_dist.alltoall_sparse_input(
+                lS_o, lS_i, self.n_emb_per_rank
+            )
+        batch_size = lS_o[0].size()[0] if local_input else dense_x.size()[0]
         # WARNING: # of ranks must be <= batch size in distributed_forward call
         if batch_size < ext_dist.my_size:
             sys.exit(
@@ -530,9 +538,10 @@ class DLRM_Net(nn.Module):
                 % (batch_size, ext_dist.my_size)
             )
 
-        dense_x = dense_x[ext_dist.get_my_slice(batch_size)]
-        lS_o = lS_o[self.local_emb_slice]
-        lS_i = lS_i[self.local_emb_slice]
+        if not local_input:
+            dense_x = dense_x[ext_dist.get_my_slice(batch_size)]
+            lS_o = lS_o[self.local_emb_slice]
+            lS_i = lS_i[self.local_emb_slice]
 
         if (len(self.emb_l) != len(lS_o)) or (len(self.emb_l) != len(lS_i)):
             sys.exit(
@@ -967,6 +976,54 @@ def run():
                         The Terabyte dataset can be multiprocessed in an environment \
                         with more than 24 CPU cores and at least 1 TB of memory.",
     )
+    parser.add_argument(
+        "--dataset-hashing",
+        action="store_true",
+        default=False,
+        help="Use the categorical features modulo --max-ind-range as ids \
+                        directly, skipping the dictionaries and the remap pass.",
+    )
+    parser.add_argument(
+        "--dataset-format",
+        type=str,
+        default="npz",
+        help="Format of the preprocessed day files, compressed npz or raw \
+                        npy files (memory mapped by the data loaders).",
+    )
+    parser.add_argument(
+        "--dataset-frequency-ids",
+        action="store_true",
+        default=False,
+        help="Assign ids of categorical features in descending order of \
+                        their frequency, instead of their order of appearance.",
+    )
+    parser.add_argument(
+        "--dataset-min-count",
+        type=int,
+        default=0,
+        help="Map categorical values occurring less than this many times \
+                        to a single out-of-vocabulary id of their feature.",
+    )
+    parser.add_argument(
+        "--dataset-sketch-size",
+        type=int,
+        default=0,
+        help="Estimate the counts for --dataset-min-count with count-min \
+                        sketches of this many MB per day, instead of counting exactly.",
+    )
+    parser.add_argument(
+        "--dataset-streaming",
+        action="store_true",
+        default=False,
+        help="Stream the raw (optionally gzip) text files, hashing the categorical \
+                        features with --max-ind-range, instead of preprocessing them.",
+    )
+    parser.add_argument(
+        "--dataset-stream-processes",
+        type=int,
+        default=4,
+        help="Number of processes parsing the text with --dataset-streaming.",
+    )
     # inference
     parser.add_argument("--inference-only", action="store_true", default=False)
     # quantize
@@ -979,6 +1036,18 @@ def run():
     # distributed
     parser.add_argument("--local_rank", type=int, default=-1)
     parser.add_argument("--dist-backend", type=str, default="")
+    parser.add_argument(
+        "--rank-local-input",
+        action="store_true",
+        default=False,
+        help="Each rank batches and collates only its slice of the training \
+                        batches (Criteo datasets), instead of whole batches. The \
+                        dataset is still opened by every rank: without --memory-map \
+                        every rank loads all the preprocessed data, with --memory-map \
+                        the days are opened lazily and only the rows of the rank are \
+                        read (npy days are memory mapped, npz days are decompressed \
+                        as a whole).",
+    )
     # debugging and profiling
     parser.add_argument("--print-freq", type=int, default=1)
     parser.add_argument("--test-freq", type=int, default=-1)
@@ -1001,6 +1070,23 @@ def run():
     parser.add_argument("--mlperf-auc-threshold", type=float, default=0.0)
     parser.add_argument("--mlperf-bin-loader", action="store_true", default=False)
     parser.add_argument("--mlperf-bin-shuffle", action="store_true", default=False)
+    # write the bin files in the compact format (transformed, narrow types)
+    parser.add_argument("--mlperf-bin-compact", action="store_true", default=False)
+    # shuffle samples through a buffer of random contiguous blocks of batches
+    # (the buffer holds blocks * block-batches * mini-batch-size samples)
+    parser.add_argument("--mlperf-bin-shuffle-blocks", type=int, default=0)
+    parser.add_argument("--mlperf-bin-shuffle-block-batches", type=int, default=1)
+    # split the Terabyte days across loader workers also for npz days (each
+    # worker decompresses its own days, and keeps up to two days in memory)
+    parser.add_argument("--mlperf-day-dataset", action="store_true", default=False)
+    # shuffle the order of the days and of the batches within each day (per
+    # epoch, with --numpy-rand-seed) in the Terabyte day loader with workers or
+    # rank-local input, otherwise the batches come in the DataLoader order
+    # (a batch spanning two days then also reads the start of the next day)
+    parser.add_argument("--mlperf-day-shuffle", action="store_true", default=False)
+    # days read ahead by the Terabyte day loader, each costs a day of memory
+    # (about 30 GB decompressed from npz) on top of the day being read
+    parser.add_argument("--mlperf-prefetch-days", type=int, default=0)
     # mlperf gradient accumulation iterations
     parser.add_argument("--mlperf-grad-accum-iter", type=int, default=1)
     # LR policy
@@ -1087,8 +1173,18 @@ def run():
         mlperf_logger.log_start(key=mlperf_logger.constants.RUN_START)
         mlperf_logger.barrier()
 
+    if args.rank_local_input and ext_dist.my_size <= 1:
+        args.rank_local_input = False
+    if args.rank_local_input and args.data_generation != "dataset":
+        sys.exit("ERROR: --rank-local-input requires --data-generation=dataset")
+
     if args.data_generation == "dataset":
-        train_data, train_ld, test_data, test_ld = dp.make_criteo_data_and_loaders(args)
+        if args.rank_local_input:
+            train_data, train_ld, test_data, test_ld = dp.make_criteo_data_and_loaders(
+                args, rank=ext_dist.my_rank, world_size=ext_dist.my_size
+            )
+        else:
+            train_data, train_ld, test_data, test_ld = dp.make_criteo_data_and_loaders(args)
         table_feature_map = {idx: idx for idx in range(len(train_data.counts))}
         nbatches = args.num_batches if args.num_batches > 0 else len(train_ld)
         nbatches_test = len(test_ld)
@@ -1493,6 +1589,10 @@ def run():
             k = 0
             total_time_begin = 0
             while k < args.nepochs:
+                # loaders that shuffle differently every epoch
+                if hasattr(getattr(train_ld, "dataset", None), "set_epoch"):
+                    train_ld.dataset.set_epoch(k)
+
                 if args.mlperf_logging:
                     mlperf_logger.barrier()
                     mlperf_logger.log_start(
@@ -1538,7 +1638,12 @@ def run():
                         break
 
                     # Skip the batch if batch size not multiple of total ranks
-                    if ext_dist.my_size > 1 and X.size(0) % ext_dist.my_size != 0:
+                    # (rank-local batches are skipped by the RankBatchSampler)
+                    if (
+                        ext_dist.my_size > 1
+                        and not args.rank_local_input
+                        and X.size(0) % ext_dist.my_size != 0
+                    ):
                         print(
                             "Warning: Skiping the batch %d with size %d"
                             % (j, X.size(0))
@@ -1555,9 +1660,10 @@ def run():
                         use_gpu,
                         device,
                         ndevices=ndevices,
+                        local_input=args.rank_local_input,
                     )
 
-                    if ext_dist.my_size > 1:
+                    if ext_dist.my_size > 1 and not args.rank_local_input:
                         T = T[ext_dist.get_my_slice(mbs)]
                         W = W[ext_dist.get_my_slice(mbs)]
 
@@ -1870,6 +1976,10 @@ def run():
         dlrm_pytorch_onnx = onnx.load("dlrm_s_pytorch.onnx")
         # check the onnx model
         onnx.checker.check_model(dlrm_pytorch_onnx)
+    # stop the worker processes parsing the streamed text
+    if args.data_generation == "dataset" and args.dataset_streaming:
+        train_data.close()
+        test_data.close()
     total_time_end = time_wrap(use_gpu)
 
 
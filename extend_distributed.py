@@ -576,6 +576,93 @@ def alltoall(inputs, per_rank_table_splits):
     return myreq
 
 
+def _alltoallv(input, output_split_sizes, input_split_sizes):
+    # exchanges the parts of a 1D tensor, part i of the input goes to rank i
+    output = input.new_empty([sum(output_split_sizes)])
+    if alltoall_supported:
+        dist.all_to_all_single(output, input, output_split_sizes, input_split_sizes)
+        return output
+    inputs = input.split(input_split_sizes)
+    outputs = output.split(output_split_sizes)
+    req_list = []
+    for i in range(my_size):
+        if i == my_rank:
+            outputs[i].copy_(inputs[i])
+        else:
+            req_list.append(dist.isend(inputs[i].contiguous(), i))
+            req_list.append(dist.irecv(outputs[i], i))
+    for req in req_list:
+        req.wait()
+    return output
+
+
+def alltoall_sparse_input(lS_o, lS_i, per_rank_table_splits):
+    # Distributes the sparse features of rank-local batches (the slices of a
+    # global batch, in rank order) to the ranks owning their tables, so that
+    # each rank gets its tables for the whole global batch. Dense features and
+    # targets stay on the rank that loaded them.
+    with record_function("DLRM alltoall_sparse_input"):
+        lS_o = list(lS_o)
+        lS_i = list(lS_i)
+        table_splits = (
+            per_rank_table_splits
+            if per_rank_table_splits
+            else [len(lS_i) // my_size] * my_size
+        )
+        local_table_num = table_splits[my_rank]
+        local_batch_num = lS_o[0].numel()
+
+        # batch sizes of all ranks
+        batch_nums = lS_o[0].new_tensor([local_batch_num], dtype=torch.int64)
+        batch_nums = all_gather(batch_nums, None).tolist()
+
+        # lengths (table-major), then indices
+        lengths = torch.stack(
+            [
+                torch.diff(
+                    S_o.to(torch.int64),
+                    append=S_o.new_tensor([S_i.numel()], dtype=torch.int64),
+                )
+                for S_o, S_i in zip(lS_o, lS_i)
+            ]
+        )
+        recv_lengths = _alltoallv(
+            lengths.view([-1]),
+            [local_table_num * n for n in batch_nums],
+            [e * local_batch_num for e in table_splits],
+        )
+        table_starts = [sum(table_splits[:i]) for i in range(my_size + 1)]
+        send_index_nums = [
+            sum(S_i.numel() for S_i in lS_i[table_starts[i] : table_starts[i + 1]])
+            for i in range(my_size)
+        ]
+        recv_lengths = [
+            ln.view([local_table_num, -1])
+            for ln in recv_lengths.split([local_table_num * n for n in batch_nums])
+        ]
+        recv_index_nums = [ln.sum(dim=1) for ln in recv_lengths]
+        recv_indices = _alltoallv(
+            torch.cat([S_i.to(torch.int64) for S_i in lS_i]),
+            [int(n.sum()) for n in recv_index_nums],
+            send_index_nums,
+        )
+        recv_indices = [
+            ind.split(n.tolist())
+            for ind, n in zip(
+                recv_indices.split([int(n.sum()) for n in recv_index_nums]),
+                recv_index_nums,
+            )
+        ]
+
+        # concatenate the batches of the ranks, per local table
+        lengths = torch.cat(recv_lengths, dim=1)
+        offsets = torch.cumsum(lengths, dim=1) - lengths
+        indices = [
+            torch.cat([ind[t] for ind in recv_indices]) for t in range(local_table_num)
+        ]
+        return offsets, indices
+
+
 def all_gather(input, lengths, dim=0):
     if not lengths:
         lengths = [input.size(0)] * my_size
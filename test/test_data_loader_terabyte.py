@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import contextlib
+import io
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+import weakref
+from unittest import mock
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import data_loader_terabyte  # noqa: E402
+import data_utils  # noqa: E402
+
+
+class CriteoDayDatasetTest(unittest.TestCase):
+    # days of 50, 30, 45 and 20 samples, sample i has X_int[:, 0] == i
+    day_samples = [50, 30, 45, 20]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.d_path = self.tmpdir.name
+        start = 0
+        for day, n in enumerate(self.day_samples):
+            x_int = np.zeros((n, 13), dtype=np.int32)
+            x_int[:, 0] = np.arange(start, start + n)
+            data_utils.saveCriteoArrays(
+                os.path.join(self.d_path, "day_{}_reordered.npz".format(day)),
+                "npy",
+                X_int=x_int,
+                X_cat=np.zeros((n, 26), dtype=np.int32),
+                y=np.zeros(n, dtype=np.int32),
+            )
+            start += n
+        np.savez(
+            os.path.join(self.d_path, "day_day_count.npz"),
+            total_per_file=np.array(self.day_samples),
+        )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _dataset(self, **kwargs):
+        return data_loader_terabyte.CriteoDayDataset(
+            data_filename="day",
+            data_directory=self.d_path,
+            days=list(range(len(self.day_samples))),
+            batch_size=8,
+            **kwargs
+        )
+
+    @staticmethod
+    def _samples(batch):
+        # the log transform of the dense features is exact for small integers
+        return torch.round(torch.exp(batch[0][:, 0]) - 1).long().tolist()
+
+    def _read_worker(self, dataset, worker_id, num_workers):
+        # batches of a worker, and the days it loads
+        worker_info = types.SimpleNamespace(id=worker_id, num_workers=num_workers)
+        loaded = []
+        load_day = data_loader_terabyte._load_day
+
+        def record(filepath):
+            loaded.append(os.path.basename(filepath))
+            return load_day(filepath)
+
+        with mock.patch.object(
+            torch.utils.data, "get_worker_info", return_value=worker_info
+        ), mock.patch.object(data_loader_terabyte, "_load_day", side_effect=record):
+            batches = [self._samples(b) for b in dataset]
+        return batches, loaded
+
+    def test_sequential(self):
+        batches = [self._samples(b) for b in self._dataset()]
+        self.assertEqual(len(batches), len(self._dataset()))
+        self.assertEqual(sum(batches, []), list(range(sum(self.day_samples))))
+
+    def test_workers_read_contiguous_days(self):
+        total = sum(self.day_samples)
+        for seed in [None, 3]:
+            dataset = self._dataset(seed=seed)
+            dataset.set_epoch(1)
+            samples = []
+            for worker_id in range(4):
+                batches, loaded = self._read_worker(dataset, worker_id, 4)
+                samples += sum(batches, [])
+                # 19 batches over 4 workers, a worker loads at most 2-3 days
+                # (instead of all of them)
+                self.assertLessEqual(len(set(loaded)), 3)
+                self.assertEqual(len(loaded), len(set(loaded)))
+            # every sample is read once
+            self.assertEqual(sorted(samples), list(range(total)))
+
+    def test_ranks_and_workers(self):
+        # 145 samples in 18 full batches, 6 batches for each of 3 ranks
+        samples = []
+        for rank in range(3):
+            dataset = self._dataset(
+                seed=5, rank=rank, world_size=3, drop_last_batch=True
+            )
+            self.assertEqual(len(dataset), 6)
+            rank_batches = []
+            for worker_id in range(2):
+                batches, _ = self._read_worker(dataset, worker_id, 2)
+                rank_batches += batches
+            self.assertEqual(len(rank_batches), 6)
+            self.assertEqual({len(b) for b in rank_batches}, {8})
+            samples += sum(rank_batches, [])
+        self.assertEqual(len(set(samples)), 18 * 8)
+
+    def test_epoch_order(self):
+        dataset = self._dataset(seed=7)
+        dataset.set_epoch(0)
+        order0 = [self._samples(b) for b in dataset]
+        self.assertEqual(order0, [self._samples(b) for b in dataset])
+        dataset.set_epoch(1)
+        order1 = [self._samples(b) for b in dataset]
+        self.assertNotEqual(order0, order1)
+        self.assertEqual(sorted(sum(order0, [])), sorted(sum(order1, [])))
+
+    def test_dataloader_workers(self):
+        loader = torch.utils.data.DataLoader(
+            self._dataset(seed=1), batch_size=None, num_workers=2
+        )
+        samples = sum([self._samples(b) for b in loader], [])
+        self.assertEqual(sorted(samples), list(range(sum(self.day_samples))))
+
+
+class CriteoBinDatasetTest(unittest.TestCase):
+    # 103 samples in 11 batches of up to 10, sample i has X_int[:, 0] == i
+    num_samples = 103
+    batch_size = 10
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rs = np.random.RandomState(0)
+        self.X_int = rs.randint(0, 1000, (self.num_samples, 13)).astype(np.int32)
+        self.X_int[:, 0] = np.arange(self.num_samples)
+        self.counts = np.array([5, 300, 70000, 10 ** 7] * 6 + [1, 2])
+        self.X_cat = (
+            rs.randint(0, 1 << 30, (self.num_samples, 26)) % self.counts
+        ).astype(np.int32)
+        self.y = rs.randint(0, 2, self.num_samples).astype(np.int32)
+        self.day_file = self._file("day_0_reordered.npz")
+        data_utils.saveCriteoArrays(
+            self.day_file, "npy", X_int=self.X_int, X_cat=self.X_cat, y=self.y
+        )
+        self.counts_file = self._file("day_fea_count.npz")
+        np.savez(self.counts_file, counts=self.counts)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _file(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def _bin_file(self, split="train", counts_file=None, max_ind_range=-1):
+        bin_file = self._file("{}_{}.bin".format(split, counts_file is not None))
+        with contextlib.redirect_stdout(io.StringIO()):
+            data_loader_terabyte.numpy_to_binary(
+                [self.day_file], bin_file, split, counts_file, max_ind_range
+            )
+        return bin_file
+
+    def _dataset(self, bin_file, max_ind_range=-1):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return data_loader_terabyte.CriteoBinDataset(
+                bin_file, self.counts_file, self.batch_size, max_ind_range
+            )
+
+    def _expected(self, lo, hi, max_ind_range=-1):
+        return data_loader_terabyte._transform_features(
+            self.X_int[lo:hi], self.X_cat[lo:hi], self.y[lo:hi], max_ind_range
+        )
+
+    def _assert_batches_equal(self, batch, expected):
+        self.assertEqual(len(batch), len(expected))
+        for a, b in zip(batch, expected):
+            self.assertEqual(a.dtype, b.dtype)
+            self.assertTrue(torch.equal(a, b))
+
+    def test_batches(self):
+        for max_ind_range in [-1, 1000]:
+            dataset = self._dataset(self._bin_file(), max_ind_range)
+            self.assertEqual(len(dataset), 11)
+            self.assertEqual(dataset.num_samples, self.num_samples)
+            for k in range(len(dataset)):
+                lo = k * self.batch_size
+                hi = min(lo + self.batch_size, self.num_samples)
+                self._assert_batches_equal(
+                    dataset[k], self._expected(lo, hi, max_ind_range)
+                )
+            # the file is memory mapped, and the mapping is not pickled
+            self.assertIsInstance(dataset.data, np.memmap)
+            self.assertIsNone(pickle.loads(pickle.dumps(dataset)).data)
+
+    def test_test_val_splits(self):
+        # the test (val) split is the first (second) half of the day
+        for split, lo, hi in [("test", 0, 52), ("val", 52, 103)]:
+            dataset = self._dataset(self._bin_file(split))
+            self.assertEqual(dataset.num_samples, hi - lo)
+            batches = [dataset[k] for k in range(len(dataset))]
+            expected = self._expected(lo, hi)
+            for i in [0, 3]:  # dense features and labels
+                self.assertTrue(
+                    torch.equal(torch.cat([b[i] for b in batches]), expected[i])
+                )
+
+    def test_dataloader_workers(self):
+        dataset = self._dataset(self._bin_file())
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=None, num_workers=2
+        )
+        batches = list(loader)
+        self.assertEqual(len(batches), len(dataset))
+        for k, batch in enumerate(batches):
+            self._assert_batches_equal(batch, dataset[k])
+
+
+    def test_compact_format(self):
+        for max_ind_range in [-1, 1000]:
+            bin_file = self._bin_file("train", self.counts_file, max_ind_range)
+            # the records are smaller than the 160 bytes of the int32 format
+            header, offset = data_loader_terabyte._read_bin_header(bin_file)
+            self.assertEqual(header["sparse_dtypes"][:4], (
+                ["uint8", "uint16", "uint32", "uint32"] if max_ind_range < 0
+                else ["uint8", "uint16", "uint16", "uint16"]
+            ))
+            self.assertEqual(
+                os.path.getsize(bin_file) - offset,
+                self.num_samples * data_loader_terabyte._compact_bin_dtype(
+                    header
+                ).itemsize,
+            )
+            self.assertEqual(offset % data_loader_terabyte.BIN_ALIGNMENT, 0)
+            for read_range in [-1, 30]:
+                dataset = self._dataset(bin_file, read_range)
+                self.assertEqual(len(dataset), 11)
+                self.assertEqual(dataset.num_samples, self.num_samples)
+                # the ids are reduced when stored, and again when read
+                X_cat = self.X_cat
+                for r in [max_ind_range, read_range]:
+                    X_cat = X_cat % r if r > 0 else X_cat
+                for k in range(len(dataset)):
+                    lo = k * self.batch_size
+                    hi = min(lo + self.batch_size, self.num_samples)
+                    batch = dataset[k]
+                    expected = data_loader_terabyte._transform_features(
+                        self.X_int[lo:hi], X_cat[lo:hi], self.y[lo:hi], -1
+                    )
+                    # labels, offsets and ids are exact
+                    for i in [1, 2, 3]:
+                        self.assertEqual(batch[i].dtype, expected[i].dtype)
+                        self.assertTrue(torch.equal(batch[i], expected[i]))
+                    # dense features within the precision of float16
+                    self.assertEqual(batch[0].dtype, torch.float32)
+                    np.testing.assert_allclose(
+                        batch[0].numpy(), expected[0].numpy(), rtol=1e-3
+                    )
+
+    def test_unsupported_version(self):
+        bin_file = self._bin_file("train", self.counts_file)
+        with open(bin_file, "r+b") as f:
+            f.seek(len(data_loader_terabyte.BIN_MAGIC))
+            f.write(np.array([data_loader_terabyte.BIN_VERSION + 1], "<u4").tobytes())
+        with self.assertRaises(SystemExit):
+            data_loader_terabyte._read_bin_header(bin_file)
+
+    def _shuffle_dataset(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return data_loader_terabyte.CriteoBinShuffleDataset(
+                self._bin_file(), self.counts_file, self.batch_size,
+                buffer_blocks=2, block_batches=2, seed=3,
+            )
+
+    @staticmethod
+    def _samples(batches):
+        # the log transform of the dense features is exact for small integers
+        return [torch.round(torch.exp(b[0][:, 0]) - 1).long().tolist() for b in batches]
+
+    def _read_worker(self, dataset, worker_id, num_workers):
+        # the seeds torch draws for workers (per epoch) must not matter
+        worker_info = types.SimpleNamespace(
+            id=worker_id, num_workers=num_workers, seed=np.random.randint(1 << 62)
+        )
+        with mock.patch.object(
+            torch.utils.data, "get_worker_info", return_value=worker_info
+        ):
+            return self._samples(dataset)
+
+    def test_shuffle_epochs(self):
+        dataset = self._shuffle_dataset()
+        epochs = [self._samples(dataset) for _ in range(3)]
+        for batches in epochs:
+            # every sample once per epoch, in as many batches as without shuffling
+            self.assertEqual(len(batches), len(dataset))
+            self.assertEqual(sorted(sum(batches, [])), list(range(self.num_samples)))
+        self.assertNotEqual(epochs[0], epochs[1])
+        self.assertNotEqual(epochs[1], epochs[2])
+        # the order of an epoch is reproduced
+        dataset.set_epoch(1)
+        self.assertEqual(self._samples(dataset), epochs[1])
+
+    def test_shuffle_workers(self):
+        dataset = self._shuffle_dataset()
+        for epoch in [0, 1]:
+            dataset.set_epoch(epoch)
+            workers = [self._read_worker(dataset, i, 3) for i in range(3)]
+            samples = [sum(batches, []) for batches in workers]
+            # the workers read disjoint samples, all of them together
+            self.assertEqual(sorted(sum(samples, [])), list(range(self.num_samples)))
+            # the batches of the epoch without workers
+            dataset.set_epoch(epoch)
+            self.assertEqual(
+                sorted(sum(workers, [])), sorted(self._samples(dataset))
+            )
+        # a DataLoader with workers
+        dataset.set_epoch(1)
+        loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2)
+        batches = self._samples(loader)
+        self.assertEqual(len(batches), len(dataset))
+        self.assertEqual(sorted(sum(batches, [])), list(range(self.num_samples)))
+
+
+class ReadDaysTest(unittest.TestCase):
+    def _max_live_days(self, prefetch_days, num_days=6):
+        # largest number of days alive at once while they are consumed slowly
+        lock = threading.Lock()
+        live = [0, 0]  # current, maximum
+
+        def released():
+            with lock:
+                live[0] -= 1
+
+        def load_day(filepath):
+            day = tuple(np.full(4, int(filepath)) for _ in range(3))
+            with lock:
+                live[0] += 1
+                live[1] = max(live[1], live[0])
+            weakref.finalize(day[0], released)
+            return day
+
+        days = []
+        with mock.patch.object(data_loader_terabyte, "_load_day", load_day):
+            for x_int, _, _ in data_loader_terabyte._read_days(
+                [str(i) for i in range(num_days)], prefetch_days
+            ):
+                days.append(int(x_int[0]))
+                time.sleep(0.05)
+                x_int = None
+        self.assertEqual(days, list(range(num_days)))
+        return live[1]
+
+    def test_memory_bound(self):
+        for prefetch_days in [0, 1, 2]:
+            self.assertLessEqual(
+                self._max_live_days(prefetch_days), prefetch_days + 1
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import data_utils  # noqa: E402
+from dlrm_data_pytorch import CriteoDataset  # noqa: E402
+
+
+def write_criteo_text(filename, num_samples, seed, label=0):
+    # Criteo text: label, 13 dense and 26 (hex) categorical features per line,
+    # the first dense feature of the samples of a file is label
+    rs = np.random.RandomState(seed)
+    with open(filename, "w") as f:
+        for _ in range(num_samples):
+            dense = [str(label)] + [str(x) for x in rs.randint(0, 10, 12)]
+            cat = ["%08x" % x for x in rs.randint(0, 50, 26)]
+            f.write("\t".join([str(rs.randint(2))] + dense + cat) + "\n")
+
+
+def parse_criteo_naive(text, max_ind_range=-1):
+    # reference parser, a line at a time (missing fields are 0)
+    y, X_int, X_cat = [], [], []
+    for line in text.splitlines():
+        fields = line.split("\t")
+        y.append(int(fields[0] or 0))
+        X_int.append([int(x or 0) for x in fields[1:14]])
+        X_cat.append([int(x or "0", 16) for x in fields[14:]])
+    X_cat = np.array(X_cat, dtype=np.int64).reshape(-1, 26)
+    if max_ind_range > 0:
+        X_cat %= max_ind_range
+    return (
+        np.array(y, dtype=np.int32),
+        np.array(X_int, dtype=np.int32).reshape(-1, 13),
+        X_cat.astype(np.int32),
+    )
+
+
+class ParseCriteoBlockTest(unittest.TestCase):
+    def _lines(self, num_lines, seed):
+        # dense fields of up to 10 digits (longer than the 8 characters
+        # converted at once, within int32), negative and empty fields, hex
+        # fields of up to 8 digits, in both cases and without leading zeros
+        rs = np.random.RandomState(seed)
+        lines = []
+        for _ in range(num_lines):
+            dense = []
+            for _ in range(13):
+                x = str(rs.randint(0, min(10 ** rs.randint(1, 11), 1 << 31)))
+                kind = rs.randint(4)
+                dense.append("" if kind == 0 else "-" + x if kind == 1 else x)
+            cat = []
+            for _ in range(26):
+                x = rs.randint(0, 1 << 31)
+                kind = rs.randint(4)
+                cat.append(
+                    "" if kind == 0
+                    else "%08x" % x if kind == 1
+                    else "%08X" % x if kind == 2
+                    else "%x" % (x >> rs.randint(32))
+                )
+            lines.append("\t".join([str(rs.randint(2))] + dense + cat))
+        return lines
+
+    def _check(self, text, max_ind_range=-1):
+        result = data_utils.parseCriteoBlock(text.encode(), max_ind_range)
+        expected = parse_criteo_naive(text.replace("\r", ""), max_ind_range)
+        for a, b in zip(result, expected):
+            self.assertEqual(a.dtype, np.int32)
+            np.testing.assert_array_equal(a, b)
+
+    def test_random_lines(self):
+        text = "\n".join(self._lines(500, seed=0)) + "\n"
+        self._check(text)
+        self._check(text, max_ind_range=1000)
+        # without the final newline, and with CRLF line endings
+        self._check(text[:-1])
+        self._check(text.replace("\n", "\r\n"))
+
+    def test_long_fields(self):
+        # all dense fields need the fallback for more than 8 digits
+        fields = ["1"] + ["-123456789", "2147483647", "0000000001"] * 4 + [
+            "000000012"
+        ] + ["00000000a", "7fffffff", "0"] * 8 + ["", "ABCDEF"]
+        self._check("\t".join(fields) + "\n")
+
+    def test_empty_fields(self):
+        self._check("\t" * 39 + "\n" + "1" + "\t" * 39 + "\n")
+
+    def test_convert_fields(self):
+        # int64 values of 8 digits at once and of the fallback
+        values = [0, 7, 12345678, 99999999, 123456789, -98765432, 10 ** 17 + 3]
+        text = "\t".join(str(x) for x in values) + "\n"
+        buf = np.frombuffer(text.encode() + b"\0" * 8, dtype=np.uint8)
+        sep = np.flatnonzero((buf == ord("\t")) | (buf == ord("\n")))
+        starts = np.concatenate(([0], sep[:-1] + 1))
+        out = data_utils.convertCriteoFields(buf, starts, sep - starts, 10)
+        self.assertEqual(out.tolist(), values)
+        hex_values = [0, 0xA, 0xDEADBEEF, 0xFFFFFFFF, 0x123456789, 0xABCDEF0123]
+        text = "\t".join("%x" % x for x in hex_values) + "\n"
+        buf = np.frombuffer(text.encode() + b"\0" * 8, dtype=np.uint8)
+        sep = np.flatnonzero((buf == ord("\t")) | (buf == ord("\n")))
+        starts = np.concatenate(([0], sep[:-1] + 1))
+        out = data_utils.convertCriteoFields(buf, starts, sep - starts, 16)
+        self.assertEqual(out.tolist(), hex_values)
+
+
+class CriteoDictTest(unittest.TestCase):
+    def test_convert_categories(self):
+        rs = np.random.RandomState(0)
+        # a dictionary in order of appearance (as built from the data)
+        unique = rs.choice(np.arange(-1000, 1000, dtype=np.int32), 300, replace=False)
+        reference = {int(v): i for i, v in enumerate(unique)}
+        keys, ids = data_utils.sortCriteoDict(unique)
+        self.assertTrue(np.all(np.diff(keys) > 0))
+        self.assertEqual(ids.dtype, np.int32)
+        # values of the dictionary
+        x = rs.choice(unique, 1000)
+        out = data_utils.convertCriteoCategories(x, keys, ids)
+        self.assertEqual(out.tolist(), [reference[v] for v in x.tolist()])
+        # values missing from the dictionary (below, between and above the
+        # keys) are mapped to the OOV id
+        x = rs.randint(-1100, 1100, 1000).astype(np.int32)
+        out = data_utils.convertCriteoCategories(x, keys, ids, oov=300)
+        self.assertEqual(
+            out.tolist(), [reference.get(v, 300) for v in x.tolist()]
+        )
+        # an empty dictionary
+        keys, ids = data_utils.sortCriteoDict(np.zeros(0, dtype=np.int32))
+        out = data_utils.convertCriteoCategories(x, keys, ids, oov=0)
+        self.assertEqual(out.tolist(), [0] * 1000)
+
+
+class MergeCriteoUniquesTest(unittest.TestCase):
+    def test_merge_splits(self):
+        # merge the unique values of splits, as getCriteoAdData does, against a
+        # dict of the first appearance and count of each value
+        rs = np.random.RandomState(0)
+        splits = [rs.randint(0, n, n).astype(np.int32) for n in [0, 50, 400, 7, 1000]]
+        first_ref, count_ref = {}, {}
+        for k, v in enumerate(np.concatenate(splits).tolist()):
+            first_ref.setdefault(v, k)
+            count_ref[v] = count_ref.get(v, 0) + 1
+
+        parts = ([], [], [])
+        offset = 0
+        for x in splits:
+            uniques = data_utils.uniqueCriteoCategories(x[:, None])
+            parts[0].append(uniques["unique_0"])
+            parts[1].append(uniques["first_0"] + offset)
+            parts[2].append(uniques["count_0"])
+            offset += len(x)
+        unique, first, count = data_utils.mergeCriteoUniques(*parts)
+        self.assertEqual(unique.dtype, np.int32)
+        self.assertEqual(unique.tolist(), sorted(first_ref))
+        self.assertEqual(first.tolist(), [first_ref[v] for v in unique.tolist()])
+        self.assertEqual(count.tolist(), [count_ref[v] for v in unique.tolist()])
+
+        # merging the merged values of the first splits with the others
+        merged = data_utils.mergeCriteoUniques(*[p[:3] for p in parts])
+        merged = data_utils.mergeCriteoUniques(
+            *[[m] + p[3:] for m, p in zip(merged, parts)]
+        )
+        for a, b in zip(merged, (unique, first, count)):
+            np.testing.assert_array_equal(a, b)
+
+        # only empty splits
+        unique, first, count = data_utils.mergeCriteoUniques(
+            *[p[:1] for p in parts]
+        )
+        self.assertEqual((unique.size, first.size, count.size), (0, 0, 0))
+
+
+class CriteoHashingTest(unittest.TestCase):
+    def test_hashed_ids(self):
+        # the ids are the categorical values modulo max_ind_range, and the
+        # counts are bounded by the largest id of each feature (+1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raw_file = os.path.join(tmpdir, "train.txt")
+            rs = np.random.RandomState(0)
+            with open(raw_file, "w") as f:
+                for _ in range(7 * 30):
+                    dense = [str(x) for x in rs.randint(-5, 10, 13)]
+                    # feature j takes values below 5 * j + 1 (+ 2^30 for odd j),
+                    # the larger features wrap around max_ind_range
+                    values = rs.randint(0, 1000, 26) % (5 * np.arange(26) + 1)
+                    cat = ["%08x" % (1 << 30 | x) if j % 2 else "%x" % x
+                           for j, x in enumerate(values)]
+                    f.write("\t".join([str(rs.randint(2))] + dense + cat) + "\n")
+            with contextlib.redirect_stdout(io.StringIO()):
+                data = CriteoDataset(
+                    "kaggle", 64, 0.0, "none", "none", raw_file,
+                    os.path.join(tmpdir, "processed.npz"),
+                    dataset_hashing=True,
+                )
+            with open(raw_file) as f:
+                y, X_int, X_cat = parse_criteo_naive(f.read(), 64)
+        np.testing.assert_array_equal(data.y, y)
+        np.testing.assert_array_equal(data.X_int, np.maximum(X_int, 0))
+        np.testing.assert_array_equal(data.X_cat, X_cat)
+        self.assertTrue(np.all((data.X_cat >= 0) & (data.X_cat < data.counts)))
+        self.assertEqual(data.counts.tolist(), (X_cat.max(axis=0) + 1).tolist())
+        self.assertTrue(np.all(data.counts <= 64))
+
+
+class CriteoArraysTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rs = np.random.RandomState(0)
+        self.arrays = {
+            "X_int": rs.randint(0, 100, (20, 13)).astype(np.int32),
+            "X_cat_t": rs.randint(0, 100, (26, 20)).astype(np.int32),
+            "y": rs.randint(0, 2, 20).astype(np.int8),
+            "counts": np.arange(26, dtype=np.int64),
+        }
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        for data_format in ["npz", "npy"]:
+            filename = os.path.join(self.tmpdir.name, data_format + ".npz")
+            self.assertFalse(data_utils.existsCriteoArrays(filename))
+            data_utils.saveCriteoArrays(filename, data_format, **self.arrays)
+            self.assertTrue(data_utils.existsCriteoArrays(filename))
+            with data_utils.loadCriteoArrays(filename, mmap_mode="r") as data:
+                self.assertEqual(sorted(data.keys()), sorted(self.arrays))
+                for key, x in self.arrays.items():
+                    self.assertEqual(data[key].dtype, x.dtype)
+                    np.testing.assert_array_equal(data[key], x)
+                    # npy arrays are memory mapped
+                    self.assertEqual(
+                        isinstance(data[key], np.memmap), data_format == "npy"
+                    )
+        with data_utils.loadCriteoArrays(
+            os.path.join(self.tmpdir.name, "npy.npz")
+        ) as data:
+            self.assertIn("y", data)
+            self.assertNotIn("X_cat", data)
+            with self.assertRaises(KeyError):
+                data["X_cat"]
+
+    def test_manifest_written_last(self):
+        # the data is not complete (does not exist) until all arrays are saved
+        filename = os.path.join(self.tmpdir.name, "npy.npz")
+        save = np.save
+        saved = []
+
+        def save_and_fail(fi, x):
+            if len(saved) == 2:
+                raise IOError("disk full")
+            saved.append(fi)
+            save(fi, x)
+            self.assertFalse(data_utils.existsCriteoArrays(filename))
+
+        with mock.patch.object(np, "save", side_effect=save_and_fail):
+            with self.assertRaises(IOError):
+                data_utils.saveCriteoArrays(filename, "npy", **self.arrays)
+        self.assertEqual(len(saved), 2)
+        self.assertFalse(data_utils.existsCriteoArrays(filename))
+        data_utils.saveCriteoArrays(filename, "npy", **self.arrays)
+        self.assertTrue(data_utils.existsCriteoArrays(filename))
+
+
+class CriteoOffsetsTest(unittest.TestCase):
+    def test_line_alignment(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raw_file = os.path.join(tmpdir, "train.txt")
+            # lines of very different lengths
+            rs = np.random.RandomState(0)
+            with open(raw_file, "wb") as f:
+                for n in rs.randint(1, 300, 40) * rs.randint(1, 4, 40) ** 4:
+                    f.write(b"x" * int(n) + b"\n")
+            with open(raw_file, "rb") as f:
+                text = f.read()
+            line_starts = [0] + [k + 1 for k in range(len(text)) if text[k] == ord("\n")]
+            ranges = [(0, None), (0, len(text)), (line_starts[5], line_starts[30])]
+            for start, end in ranges:
+                for splits in [1, 2, 7, 39, 100]:
+                    offsets = data_utils.getCriteoOffsets(raw_file, splits, start, end)
+                    self.assertEqual(len(offsets), splits + 1)
+                    self.assertEqual(offsets[0], start)
+                    self.assertEqual(offsets[-1], len(text) if end is None else end)
+                    self.assertEqual(offsets, sorted(offsets))
+                    self.assertTrue(set(offsets) <= set(line_starts))
+                    # the blocks of the ranges make up the text
+                    blocks = [
+                        block
+                        for i in range(splits)
+                        for block in data_utils.readCriteoBlocks(
+                            raw_file, 100, offsets[i], offsets[i + 1]
+                        )
+                    ]
+                    self.assertTrue(all(b.endswith(b"\n") for b in blocks))
+                    self.assertEqual(b"".join(blocks), text[offsets[0]:offsets[-1]])
+
+
+def order_criteo_naive(x, frequency_ids, min_count):
+    # reference ids of the values of a feature, in order of appearance or of
+    # descending counts (ties in order of appearance), rare values get the OOV id
+    first, count = {}, {}
+    for k, v in enumerate(x.tolist()):
+        first.setdefault(v, k)
+        count[v] = count.get(v, 0) + 1
+    if frequency_ids:
+        order = sorted(first, key=lambda v: (-count[v], first[v]))
+    else:
+        order = sorted(first, key=lambda v: first[v])
+    order = [v for v in order if count[v] >= min_count]
+    ids = {v: i for i, v in enumerate(order)}
+    return [ids.get(v, len(order)) for v in x.tolist()], len(order)
+
+
+class CriteoFrequencyIdsTest(unittest.TestCase):
+    def test_order(self):
+        rs = np.random.RandomState(0)
+        # many ties of counts
+        x = rs.randint(0, 60, 300).astype(np.int32)
+        unique, first, count = np.unique(x, return_index=True, return_counts=True)
+        for frequency_ids in [False, True]:
+            for min_count in [0, 1, 5, 1000]:
+                unique_ordered, ids, oov = data_utils.orderCriteoUniques(
+                    unique, first, count, frequency_ids, min_count
+                )
+                expected, num_ids = order_criteo_naive(x, frequency_ids, min_count)
+                keys, sorted_ids = data_utils.sortCriteoDict(unique_ordered)
+                out = data_utils.convertCriteoCategories(x, keys, sorted_ids, oov)
+                self.assertEqual(out.tolist(), expected)
+                self.assertEqual(len(unique_ordered), num_ids)
+                self.assertEqual(oov, num_ids if min_count > 0 else None)
+                # ids of all (sorted) unique values
+                self.assertEqual(ids[np.searchsorted(unique, x)].tolist(), expected)
+
+    def test_preprocessed_ids(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raw_file = os.path.join(tmpdir, "train.txt")
+            write_criteo_text(raw_file, 7 * 30, seed=0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                data = CriteoDataset(
+                    "kaggle", -1, 0.0, "none", "none", raw_file,
+                    os.path.join(tmpdir, "processed.npz"),
+                    frequency_ids=True, min_count=5,
+                )
+            with open(raw_file) as f:
+                _, _, X_cat = parse_criteo_naive(f.read())
+        for j in range(26):
+            expected, num_ids = order_criteo_naive(X_cat[:, j], True, 5)
+            self.assertEqual(data.X_cat[:, j].tolist(), expected)
+            self.assertEqual(data.counts[j], num_ids + 1)
+
+
+class CriteoSketchTest(unittest.TestCase):
+    def test_no_underestimate(self):
+        rs = np.random.RandomState(0)
+        hashes = data_utils.getCriteoSketchHashes()
+        # skewed values (negative ones too), in two splits
+        X_cat = (rs.zipf(1.3, (5000, 3)) % 100000 - 50).astype(np.int32)
+        splits = [X_cat[:2000], X_cat[2000:]]
+        for bits in [4, 8, 20]:
+            sketch = data_utils.mergeCriteoSketches(
+                *[data_utils.sketchCriteoCategories(x, hashes, bits, chunk_size=700)
+                  for x in splits]
+            )
+            np.testing.assert_array_equal(
+                sketch, data_utils.sketchCriteoCategories(X_cat, hashes, bits)
+            )
+            for j in range(3):
+                unique, count = np.unique(X_cat[:, j], return_counts=True)
+                est = data_utils.queryCriteoSketch(
+                    sketch[j], unique, hashes, bits, chunk_size=300
+                )
+                self.assertTrue(np.all(est >= count))
+                if bits == 20:
+                    # (almost) no collisions in a wide sketch
+                    self.assertGreater(np.mean(est == count), 0.99)
+
+    def test_saturation(self):
+        sketch = np.full((1, 4, 16), np.iinfo(np.uint32).max - 1, dtype=np.uint32)
+        merged = data_utils.mergeCriteoSketches(sketch, sketch)
+        self.assertTrue(np.all(merged == np.iinfo(np.uint32).max))
+
+
+class SaveCriteoArraysPermutedTest(unittest.TestCase):
+    def test_permuted(self):
+        rs = np.random.RandomState(0)
+        arrays = {
+            "X_int": rs.randint(0, 100, (53, 13)).astype(np.int32),
+            "X_cat": rs.randint(0, 100, (53, 26)).astype(np.int32),
+            "y": rs.randint(0, 2, 53).astype(np.int8),
+        }
+        indices = rs.permutation(53)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for data_format in ["npz", "npy"]:
+                filename = os.path.join(tmpdir, data_format + ".npz")
+                data_utils.saveCriteoArraysPermuted(
+                    filename, indices, data_format, chunk_size=10, **arrays
+                )
+                with data_utils.loadCriteoArrays(filename) as data:
+                    for key, x in arrays.items():
+                        self.assertEqual(data[key].dtype, x.dtype)
+                        np.testing.assert_array_equal(data[key], x[indices])
+            # no temporary files are left behind
+            self.assertEqual(
+                sorted(os.listdir(tmpdir)),
+                ["npy.json", "npy_X_cat.npy", "npy_X_int.npy", "npy_y.npy",
+                 "npz.npz"],
+            )
+
+
+class AppendCriteoAdDayTest(unittest.TestCase):
+    num_samples = 7 * 40
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.raw_file = os.path.join(self.tmpdir.name, "train.txt")
+        self.pro_file = os.path.join(
+            self.tmpdir.name, "kaggleAdDisplayChallenge_processed.npz"
+        )
+        write_criteo_text(self.raw_file, self.num_samples, seed=0)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _dataset(self, split, memory_map):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return CriteoDataset(
+                "kaggle",
+                -1,
+                0.0,
+                "none",
+                split,
+                self.raw_file,
+                self.pro_file,
+                memory_map,
+            )
+
+    def _append(self, num_samples, memory_map, randomize="none"):
+        day_file = os.path.join(self.tmpdir.name, "new_day.txt")
+        write_criteo_text(day_file, num_samples, seed=1, label=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            return data_utils.appendCriteoAdDay(
+                self.raw_file, day_file, memory_map=memory_map, randomize=randomize
+            )
+
+    @staticmethod
+    def _rows(dataset):
+        X_int, X_cat, y = dataset[np.arange(len(dataset))]
+        return np.hstack([X_int, X_cat, y[:, None]])
+
+    def _check_append(self, memory_map):
+        train = self._dataset("train", memory_map)
+        test = self._dataset("test", memory_map)
+        val = self._dataset("val", memory_map)
+        test_day = len(test) + len(val)
+        self.assertEqual(len(train) + test_day, self.num_samples)
+
+        self.assertEqual(self._append(25, memory_map), 7)
+
+        # the new day is used for testing, the previous test day for training
+        new_train = self._dataset("train", memory_map)
+        new_test = self._dataset("test", memory_map)
+        new_val = self._dataset("val", memory_map)
+        self.assertEqual(len(new_train), len(train) + test_day)
+        self.assertEqual(len(new_test), 13)
+        self.assertEqual(len(new_val), 12)
+        # the samples of the new day are the ones with a first dense feature 1
+        for dataset, expected in [(new_train, 0), (new_test, 1), (new_val, 1)]:
+            X_int = dataset[np.arange(len(dataset))][0]
+            self.assertTrue(np.all(X_int[:, 0] == expected))
+        self.assertEqual(len(new_train.counts), 26)
+
+    def test_append_memory_map(self):
+        self._check_append(memory_map=True)
+
+    def test_append_memory_map_shuffle(self):
+        test_day = np.vstack(
+            [self._rows(self._dataset(split, True)) for split in ["test", "val"]]
+        )
+        self._append(25, True, randomize="day")
+        # the new test day is not shuffled
+        new_test_day = np.vstack(
+            [self._rows(self._dataset(split, True)) for split in ["test", "val"]]
+        )
+        day_file = os.path.join(self.tmpdir.name, "train_day_7_processed.npz")
+        with data_utils.loadCriteoArrays(day_file) as data:
+            np.testing.assert_array_equal(
+                new_test_day,
+                np.hstack([data["X_int"], data["X_cat"], data["y"][:, None]]),
+            )
+        # the previous test day is shuffled (within the day) for training
+        train_day = self._rows(self._dataset("train", True))[-len(test_day):]
+        self.assertFalse(np.array_equal(train_day, test_day))
+        self.assertEqual(
+            sorted(map(tuple, train_day.tolist())),
+            sorted(map(tuple, test_day.tolist())),
+        )
+
+    def test_append_processed_file(self):
+        self._check_append(memory_map=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+#
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import bisect
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, SequentialSampler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import data_utils  # noqa: E402
+import dlrm_data_pytorch  # noqa: E402
+from dlrm_data_pytorch import CriteoDataset, CriteoStreamDataset  # noqa: E402
+from dlrm_data_pytorch import RankBatchSampler  # noqa: E402
+
+
+def write_criteo_text(filename, num_samples):
+    # Criteo text, the first dense feature of sample k is k
+    rs = np.random.RandomState(0)
+    with open(filename, "w") as f:
+        for k in range(num_samples):
+            dense = [str(k)] + [str(x) for x in rs.randint(0, 10, 12)]
+            cat = ["%08x" % x for x in rs.randint(0, 50, 26)]
+            f.write("\t".join([str(rs.randint(2))] + dense + cat) + "\n")
+
+
+class CollateTest(unittest.TestCase):
+    num_samples = 7 * 20
+
+    def test_batch_collate(self):
+        # whole batches of CriteoDataset with the batch collate functions give
+        # the same tensors as samples collated one at a time
+        with tempfile.TemporaryDirectory() as tmpdir:
+            raw_file = os.path.join(tmpdir, "train.txt")
+            write_criteo_text(raw_file, self.num_samples)
+            for memory_map, max_ind_range in [(False, -1), (True, 30)]:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    data = CriteoDataset(
+                        "kaggle", max_ind_range, 0.0, "total", "train", raw_file,
+                        os.path.join(tmpdir, "processed.npz"),
+                        memory_map=memory_map, data_format="npy",
+                    )
+                for batch_fn, sample_fn in [
+                    (dlrm_data_pytorch.collate_wrapper_criteo_batch_offset,
+                     dlrm_data_pytorch.collate_wrapper_criteo_offset),
+                    (dlrm_data_pytorch.collate_wrapper_criteo_batch_length,
+                     dlrm_data_pytorch.collate_wrapper_criteo_length),
+                ]:
+                    batch_loader = torch.utils.data.DataLoader(
+                        data,
+                        batch_size=None,
+                        sampler=BatchSampler(SequentialSampler(data), 16, False),
+                        collate_fn=batch_fn,
+                    )
+                    sample_loader = torch.utils.data.DataLoader(
+                        data, batch_size=16, collate_fn=sample_fn
+                    )
+                    self.assertEqual(len(batch_loader), len(sample_loader))
+                    for batch, expected in zip(batch_loader, sample_loader):
+                        for a, b in zip(batch, expected):
+                            self.assertEqual(a.dtype, b.dtype)
+                            self.assertTrue(torch.equal(a, b))
+                        # batches do not share (cached) tensors
+                        batch[1].add_(1)
+
+
+class RankBatchSamplerTest(unittest.TestCase):
+    def _check(self, num_samples, batch_size, world_size, drop_last=False):
+        batch_sampler = BatchSampler(
+            SequentialSampler(range(num_samples)), batch_size, drop_last
+        )
+        ranks = [
+            list(RankBatchSampler(batch_sampler, rank, world_size))
+            for rank in range(world_size)
+        ]
+        # the ranks agree on the batches (and on the number of batches)
+        expected = [b for b in batch_sampler if len(b) % world_size == 0]
+        for rank in range(world_size):
+            self.assertEqual(len(ranks[rank]), len(expected))
+            self.assertEqual(
+                len(RankBatchSampler(batch_sampler, rank, world_size)),
+                len(expected),
+            )
+        # the slices of a batch are even and make up the whole batch
+        for j, batch in enumerate(expected):
+            slices = [ranks[rank][j] for rank in range(world_size)]
+            self.assertEqual(
+                {len(s) for s in slices}, {len(batch) // world_size}
+            )
+            self.assertEqual(sum(slices, []), batch)
+        return expected
+
+    def test_uneven_last_batch(self):
+        # last batch of 1006 - 3 * 256 = 238 samples (60/60/59/59) is skipped
+        expected = self._check(1006, 256, 4)
+        self.assertEqual([len(b) for b in expected], [256, 256, 256])
+
+    def test_local_size_not_multiple_of_ranks(self):
+        # local batches of 256 on 6 ranks are kept (1536 % 6 == 0)
+        expected = self._check(3 * 1536, 1536, 6)
+        self.assertEqual(len(expected), 3)
+
+    def test_batch_size_not_multiple_of_ranks(self):
+        # every full batch is skipped, the last one (of 8 samples) is kept
+        expected = self._check(3 * 10 + 8, 10, 4)
+        self.assertEqual([len(b) for b in expected], [8])
+
+    def test_drop_last(self):
+        self._check(1006, 256, 4, drop_last=True)
+        self._check(1006, 250, 5, drop_last=True)
+
+
+class CriteoStreamDatasetTest(unittest.TestCase):
+    num_samples = 7 * 41
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.raw_file = os.path.join(self.tmpdir.name, "train.txt")
+        write_criteo_text(self.raw_file, self.num_samples)
+        offsets = data_utils.getCriteoOffsets(self.raw_file, 7)
+        self.ranges = {
+            "train": (0, offsets[6]),
+            "test": (offsets[6], offsets[7]),
+            "val": (offsets[6], offsets[7]),
+        }
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _stream(self, split, sub_sample_rate=0.0):
+        stream = CriteoStreamDataset(
+            [self.raw_file],
+            10,
+            100,
+            processes=2,
+            block_size=256,
+            ranges=[self.ranges[split]],
+            sub_sample_rate=sub_sample_rate,
+            split=split,
+        )
+        self.addCleanup(stream.close)
+        return stream
+
+    def _read(self, dataset):
+        with contextlib.redirect_stdout(io.StringIO()):
+            batches = list(dataset)
+        return [np.concatenate(a) for a in zip(*batches)], len(batches)
+
+    def test_splits_match_criteo_dataset(self):
+        for split in ["train", "test", "val"]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                data = CriteoDataset(
+                    "kaggle", -1, 0.0, "none", split, self.raw_file,
+                    os.path.join(self.tmpdir.name, "processed.npz"),
+                )
+            stream = self._stream(split)
+            (X_int, _, y), num_batches = self._read(stream)
+            self.assertEqual(len(stream), num_batches)
+            self.assertEqual(len(stream), int(np.ceil(len(data) / 10)))
+            np.testing.assert_array_equal(X_int, data.X_int)
+            np.testing.assert_array_equal(y, data.y)
+
+    def test_line_count_cache(self):
+        stream = self._stream("train")
+        with contextlib.redirect_stdout(io.StringIO()):
+            length = len(stream)
+        cache_file = os.path.join(self.tmpdir.name, "train.txt_line_count.json")
+        self.assertTrue(os.path.exists(cache_file))
+        # the cached count is used by new datasets
+        with mock.patch(
+            "dlrm_data_pytorch._count_criteo_stream_lines",
+            side_effect=AssertionError("counted again"),
+        ):
+            self.assertEqual(len(self._stream("train")), length)
+
+    def test_sub_sample(self):
+        # with a rate of 1 exactly the positive samples are kept
+        stream = self._stream("test", sub_sample_rate=1.0)
+        (X_int, _, y), num_batches = self._read(stream)
+        self.assertTrue(np.all(y == 1))
+        self.assertEqual(len(stream), num_batches)
+        (X_int_all, _, y_all), _ = self._read(self._stream("test"))
+        np.testing.assert_array_equal(X_int, X_int_all[y_all == 1])
+
+    def test_sub_sample_stops_at_len(self):
+        # more samples kept than expected: the epoch stops after len() batches
+        stream = self._stream("train", sub_sample_rate=0.5)
+        with mock.patch(
+            "numpy.random.uniform", side_effect=lambda low, high, size: np.ones(size)
+        ):
+            _, num_batches = self._read(stream)
+        self.assertEqual(num_batches, len(stream))
+        self.assertLess(num_batches, int(np.ceil(6 * 41 / 10)))
+
+    def test_pool_reused(self):
+        stream = self._stream("test")
+        (X_int, _, _), _ = self._read(stream)
+        pool = stream.pool
+        self.assertIsNotNone(pool)
+        # the next epoch (and a partially read one) use the same workers
+        np.testing.assert_array_equal(self._read(stream)[0][0], X_int)
+        with contextlib.redirect_stdout(io.StringIO()):
+            next(iter(stream))
+        self.assertIs(stream.pool, pool)
+        stream.close()
+        self.assertIsNone(stream.pool)
+        # and they are started again after close
+        np.testing.assert_array_equal(self._read(stream)[0][0], X_int)
+
+
+class CriteoDatasetMemoryMapTest(unittest.TestCase):
+    num_samples = 7 * 20
+
+    def setUp(self):
+        # the days of each format are pre-processed in their own directory
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for data_format in ["npz", "npy"]:
+            os.mkdir(os.path.join(self.tmpdir.name, data_format))
+            write_criteo_text(
+                os.path.join(self.tmpdir.name, data_format, "train.txt"),
+                self.num_samples,
+            )
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _read(self, data_format, indices):
+        # dense features read one sample at a time
+        d_path = os.path.join(self.tmpdir.name, data_format)
+        with contextlib.redirect_stdout(io.StringIO()):
+            data = CriteoDataset(
+                "kaggle", -1, 0.0, "none", "train",
+                os.path.join(d_path, "train.txt"),
+                os.path.join(d_path, "processed.npz"),
+                memory_map=True, data_format=data_format,
+            )
+            return [data[int(i)][0][0] for i in indices]
+
+    def test_random_access(self):
+        indices = np.random.RandomState(1).permutation(6 * 20)
+        for data_format in ["npz", "npy"]:
+            # the first dense feature is the index (randomize is none)
+            X_int = self._read(data_format, range(6 * 20))
+            self.assertEqual(X_int, list(range(6 * 20)))
+        X_int = self._read("npy", indices)
+        self.assertEqual(X_int, indices.tolist())
+
+    def test_npz_sequential_access(self):
+        # several passes, also starting from a later day (or skipping days)
+        indices = list(range(50, 6 * 20)) + list(range(50, 70)) + [110]
+        self.assertEqual(self._read("npz", indices), indices)
+        # random access is refused
+        indices = np.random.RandomState(1).permutation(6 * 20)
+        with self.assertRaises(SystemExit):
+            self._read("npz", indices)
+
+
+def generate_bags_naive(ln_emb, n, num_indices, dist="uniform", length=False):
+    # reference: the lookups of fixed size generated one at a time (as the
+    # generators did before drawing a whole table at once)
+    lS_o, lS_i = [], []
+    for size in ln_emb:
+        offsets, indices = [], []
+        for _ in range(n):
+            if dist == "gaussian":
+                r = np.random.normal(size / 2.0, size / 4.0, num_indices)
+                bag = np.unique(np.clip(r, 0, size - 1)).astype(np.int64)
+            else:
+                r = np.random.random(num_indices)
+                bag = np.unique(np.round(r * (size - 1)).astype(np.int64))
+            offsets.append(len(bag) if length else sum(map(len, indices)))
+            indices.append(bag)
+        lS_o.append(offsets)
+        lS_i.append(np.concatenate(indices).tolist())
+    return lS_o, lS_i
+
+
+class RandomInputTest(unittest.TestCase):
+    ln_emb = [1, 3, 50, 10000]
+
+    def _check_bags(self, lS_o, lS_i, n, num_indices, length=False):
+        # indices of each lookup are unique, sorted and in the range of the table
+        for size, offsets, indices in zip(self.ln_emb, lS_o, lS_i):
+            offsets, indices = offsets.numpy(), indices.numpy()
+            if length:
+                offsets = np.cumsum(offsets) - offsets
+            self.assertEqual(len(offsets), n)
+            bounds = np.append(offsets, len(indices))
+            sizes = np.diff(bounds)
+            self.assertTrue(np.all((sizes >= 1) & (sizes <= min(size, num_indices))))
+            for k in range(n):
+                bag = indices[bounds[k]:bounds[k + 1]]
+                self.assertTrue(np.all(np.diff(bag) > 0))
+                self.assertTrue(np.all((bag >= 0) & (bag < size)))
+
+    def test_unique_bags(self):
+        rs = np.random.RandomState(0)
+        for values in [rs.randint(0, 5, 300), rs.normal(0, 2, 300).round(1)]:
+            # 60 bags (some of them empty)
+            bag_sizes = rs.multinomial(300, [1 / 60.0] * 60)
+            sizes, unique = dlrm_data_pytorch._unique_bags(bag_sizes, values)
+            bags = np.split(values, np.cumsum(bag_sizes)[:-1])
+            self.assertEqual(sizes.tolist(), [len(np.unique(b)) for b in bags])
+            np.testing.assert_array_equal(
+                unique, np.concatenate([np.unique(b) for b in bags])
+            )
+
+    def test_uniform(self):
+        for length in [False, True]:
+            np.random.seed(1)
+            _, lS_o, lS_i = dlrm_data_pytorch.generate_uniform_input_batch(
+                4, self.ln_emb, 64, 10, False, length
+            )
+            self._check_bags(lS_o, lS_i, 64, 10, length)
+            # lookups of a fixed size match the lookups generated one at a time
+            np.random.seed(2)
+            _, lS_o, lS_i = dlrm_data_pytorch.generate_uniform_input_batch(
+                4, self.ln_emb, 64, 10, True, length
+            )
+            np.random.seed(2)
+            np.random.rand(64, 4)
+            ref_o, ref_i = generate_bags_naive(self.ln_emb, 64, 10, length=length)
+            self.assertEqual([o.tolist() for o in lS_o], ref_o)
+            self.assertEqual([i.tolist() for i in lS_i], ref_i)
+
+    def test_dist(self):
+        for dist in ["uniform", "gaussian"]:
+            args = (dist, 0, 10000 - 1, 10000 / 2.0, 10000 / 4.0)
+            ln_emb = [10000] * 3
+            np.random.seed(1)
+            _, lS_o, lS_i = dlrm_data_pytorch.generate_dist_input_batch(
+                4, ln_emb, 64, 10, True, *args
+            )
+            np.random.seed(1)
+            np.random.rand(64, 4)
+            ref_o, ref_i = generate_bags_naive(ln_emb, 64, 10, dist)
+            self.assertEqual([o.tolist() for o in lS_o], ref_o)
+            self.assertEqual([i.tolist() for i in lS_i], ref_i)
+
+
+def trace_generate_lru_naive(line_accesses, list_sd, cumm_sd, out_trace_len,
+                             enable_padding=False):
+    # reference: LRU stack as a list (most recently used line last), with a
+    # random number drawn for every reference (line_accesses is updated)
+    max_sd = list_sd[-1]
+    l = len(line_accesses)
+    i = 0
+    ztrace = []
+    for _ in range(out_trace_len):
+        u = np.random.rand(1)[0]
+        if i < max_sd:
+            u *= cumm_sd[bisect.bisect(list_sd, i) - 1]
+        elif enable_padding:
+            u = (1.0 - cumm_sd[0]) * u + cumm_sd[0]
+        sd = next(
+            (v for v, f in zip(list_sd, cumm_sd) if u <= f), list_sd[-1]
+        )
+        if sd == 0:
+            line_ref = line_accesses.pop(0)
+            i += 1
+        else:
+            line_ref = line_accesses.pop(l - sd)
+        line_accesses.append(line_ref)
+        ztrace.append(line_ref)
+    return ztrace
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rs = np.random.RandomState(0)
+        # a trace of 3000 accesses with reuse at all distances
+        self.trace = np.concatenate(
+            [rs.randint(0, 50, 1000), rs.randint(0, 500, 1000),
+             rs.zipf(1.5, 1000) % 2000]
+        ).astype(np.uint64)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _file(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_profile(self):
+        # reference: LRU stack as a list (most recently used line last)
+        rstack, stack_distances, line_accesses = [], [], []
+        for r in self.trace.tolist():
+            if r in rstack:
+                stack_distances.append(len(rstack) - rstack.index(r))
+                rstack.remove(r)
+            else:
+                stack_distances.append(0)
+                line_accesses.append(r)
+            rstack.append(r)
+        result = dlrm_data_pytorch.trace_profile(self.trace, chunk_size=700)
+        self.assertEqual(result[0].tolist(), rstack)
+        self.assertEqual(result[1].tolist(), stack_distances)
+        self.assertEqual(result[2].tolist(), line_accesses)
+
+    def _dist(self):
+        # distribution of the trace, as written by dlrm_data_pytorch
+        _, stack_distances, line_accesses = dlrm_data_pytorch.trace_profile(
+            self.trace
+        )
+        list_sd, counts = np.unique(stack_distances, return_counts=True)
+        cumm_sd = (np.cumsum(counts) / len(stack_distances)).tolist()
+        return line_accesses.tolist(), list_sd.tolist(), cumm_sd
+
+    def test_generate_lru(self):
+        line_accesses, list_sd, cumm_sd = self._dist()
+        # long enough for the LRU stack to be rebuilt (renumbering the times)
+        for enable_padding in [False, True]:
+            np.random.seed(3)
+            lines = list(line_accesses)
+            trace = dlrm_data_pytorch.trace_generate_lru(
+                lines, list_sd, cumm_sd, 5000, enable_padding
+            )
+            np.random.seed(3)
+            ref_lines = list(line_accesses)
+            ref_trace = trace_generate_lru_naive(
+                ref_lines, list_sd, cumm_sd, 5000, enable_padding
+            )
+            self.assertEqual(trace.tolist(), ref_trace)
+            self.assertEqual(lines, ref_lines)
+
+    def test_synthetic_trace(self):
+        # a trace generated in several calls continues the LRU stack (and the
+        # number of new references) as if generated in a single call
+        line_accesses, list_sd, cumm_sd = self._dist()
+        fi = self._file("dist.log")
+        dlrm_data_pytorch.write_dist_to_file(fi, line_accesses, list_sd, cumm_sd)
+        np.random.seed(4)
+        trace = dlrm_data_pytorch.SyntheticTrace(fi)
+        parts = [trace.generate(n).tolist() for n in [1, 200, 0, 1799]]
+        np.random.seed(4)
+        ref_trace = trace_generate_lru_naive(
+            list(line_accesses), list_sd, cumm_sd, 2000
+        )
+        self.assertEqual(sum(parts, []), ref_trace)
+
+    def test_trace_files(self):
+        # text, raw (uint64) binary and binary container traces
+        for binary, container in [(False, False), (True, False), (False, True)]:
+            fi = self._file("trace_{}_{}.log".format(binary, container))
+            dlrm_data_pytorch.write_trace_to_file(fi, self.trace, binary, container)
+            trace = dlrm_data_pytorch.read_trace_from_file(fi, binary)
+            np.testing.assert_array_equal(np.asarray(trace), self.trace)
+        # raw binary traces have no header, binary containers are memory mapped
+        self.assertEqual(
+            os.path.getsize(self._file("trace_True_False.log")), self.trace.nbytes
+        )
+        np.testing.assert_array_equal(
+            np.fromfile(self._file("trace_True_False.log"), dtype=np.uint64),
+            self.trace,
+        )
+        self.assertIsInstance(trace, np.memmap)
+        # empty traces
+        for binary, container in [(True, False), (False, True)]:
+            fi = self._file("empty_{}.bin".format(container))
+            dlrm_data_pytorch.write_trace_to_file(fi, [], binary, container)
+            trace = dlrm_data_pytorch.read_trace_from_file(fi, binary)
+            self.assertEqual(len(trace), 0)
+
+    def test_dist_files(self):
+        _, stack_distances, line_accesses = dlrm_data_pytorch.trace_profile(
+            self.trace
+        )
+        list_sd, counts = np.unique(stack_distances, return_counts=True)
+        cumm_sd = (np.cumsum(counts) / len(stack_distances)).tolist()
+        dist = (line_accesses.tolist(), list_sd.tolist(), cumm_sd)
+        for binary in [False, True]:
+            fi = self._file("dist_{}.log".format(binary))
+            dlrm_data_pytorch.write_dist_to_file(fi, *dist, binary=binary)
+            self.assertEqual(dlrm_data_pytorch.read_dist_from_file(fi), dist)
+            # loaded as typed arrays (memory mapped from binary containers)
+            arrays = dlrm_data_pytorch.load_dist_from_file(fi)
+            self.assertEqual(
+                [a.dtype for a in arrays], [np.uint64, np.int64, np.float64]
+            )
+            for a, b in zip(arrays, dist):
+                np.testing.assert_array_equal(a, b)
+        arrays = dlrm_data_pytorch.read_trace_arrays(self._file("dist_True.log"))
+        self.assertTrue(all(isinstance(a, np.memmap) for a in arrays.values()))
+        self.assertIsNone(
+            dlrm_data_pytorch.read_trace_arrays(self._file("dist_False.log"))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()